@@ -1,19 +1,15 @@
 import os
+import time
 import streamlit as st
-import boto3
 from dotenv import load_dotenv
-from langchain.vectorstores import FAISS
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import PromptTemplate
-from langchain.schema.runnable import RunnableLambda
-from langchain.embeddings import OpenAIEmbeddings
-from pydantic import BaseModel, ValidationError
-import re
-import pandas as pd
-from util.llm_util import evaluate_sources, ANSWER_QUESTION_PROMPT, EVALUATE_SOURCES_PROMPT
 from util.utility import check_password, get_custom_css_modifier
-from tavily import TavilyClient
-from langchain.schema import Document
+from util.warmup_util import start_app_warmup
+
+# pandas, LangChain, OpenAI, Tavily and the index are loaded by the background warm-up
+# (or on first use), so the page renders without waiting for them
+
+# Start of this script run; a session's first run is timed until its page is rendered
+run_started = time.time()
 
 # Load environment variables
 if load_dotenv('.env'):
@@ -21,72 +17,25 @@ if load_dotenv('.env'):
    OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 else:
    OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-if not OPENAI_API_KEY:
+# When set, answers come from the answer service (rag_service.py) instead of being computed in this process
+RAG_SERVICE_URL = os.getenv("RAG_SERVICE_URL")
+if not OPENAI_API_KEY and not RAG_SERVICE_URL:
     st.error("OPENAI_API_KEY not found in secrets.")
     st.stop()
 
 st.set_page_config(layout="wide")
 
-def load_vectorstore():
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small", openai_api_key=os.getenv("OPENAI_API_KEY"))
-    s3_bucket_name = os.getenv("s3_bucket_name")
-    
-    if s3_bucket_name:
-        local_path = "nhb_vectorstore"
-        if not os.path.exists(f"{local_path}/index.faiss") or not os.path.exists(f"{local_path}/index.pkl"):
-            s3 = boto3.resource("s3")
-            os.makedirs(local_path, exist_ok=True)
-            s3.Bucket(s3_bucket_name).download_file("index.faiss", f"{local_path}/index.faiss")
-            s3.Bucket(s3_bucket_name).download_file("index.pkl", f"{local_path}/index.pkl")
-
-            #s3.Bucket(s3_bucket_name).download_file("nhb-history-teacher/index.faiss", f"{local_path}/index.faiss")
-            #s3.Bucket(s3_bucket_name).download_file("nhb-history-teacher/index.pkl", f"{local_path}/index.pkl")
-        return FAISS.load_local(local_path, embeddings, allow_dangerous_deserialization=True)
-    else:
-        return FAISS.load_local("faiss_index_infopedia", embeddings, allow_dangerous_deserialization=True)
-
-
-class AnswerFormat(BaseModel):
-    perspectives: list[str]
-    discussion_questions: list[str]
-
-def validate_answer_format(answer: str) -> bool:
-    perspectives = re.findall(r"Perspective \d+: (.*?)\n", answer)
-    discussion_questions = re.findall(r"\d+\. (.*?)\n", answer.split("Discussion Questions:")[1] if "Discussion Questions:" in answer else "")
-    
-    try:
-        AnswerFormat(perspectives=perspectives, discussion_questions=discussion_questions)
-        return True
-    except ValidationError:
-        return False
-
-
-def filter_docs_by_source(docs, include_infopedia, include_textbooks, include_roots):
-    """Filter retrieved documents based on selected sources, allowing partial matches and better debugging."""
-    
-    filtered_docs = []
-    unmatched_sources = set()  # Track sources that don't match any filter
-
-    for doc in docs:
-        source = doc.metadata.get("source", "").lower().strip()  # Normalize case & remove whitespace
+# Once per process: imports the pipeline and loads the index in the background
+warmup = start_app_warmup()
 
-        if not source:
-            unmatched_sources.add("(Missing Source)")
-            continue  # Skip documents with no source metadata
 
-        # Apply filter conditions with broader matching
-        if (include_infopedia and "infopedia" in source) or \
-           (include_textbooks and ("sec1" in source or "sec2" in source or "textbook" in source)) or \
-           (include_roots and ("roots website" in source)):  # Fix: Match "Roots Website"
-            filtered_docs.append(doc)
-        else:
-            unmatched_sources.add(source)  # Track sources that didn’t match
-
-    # Debugging: Show unmatched sources
-    if not filtered_docs:
-        st.warning(f"Warning: No sources matched your filters. Unmatched sources found: {', '.join(unmatched_sources)}")
-
-    return filtered_docs
+def load_vectorstore():
+    """
+    Returns the current shared vector store, waiting for the warm-up if it is still loading.
+    Every session shares the same read-only copy; when the index comes from S3, new versions
+    can be polled for and swapped in without a restart.
+    """
+    return warmup.wait()["load index"]["store"]
 
 
 # def answer_question_from_vector_store(vector_store, input_question, include_infopedia, include_textbooks, include_roots):
@@ -119,59 +68,22 @@ def filter_docs_by_source(docs, include_infopedia, include_textbooks, include_ro
 
 
 
-# Initialize Tavily Client
-tavily_client = TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
-
-def hybrid_search(vector_store, query, include_infopedia, include_textbooks, include_roots, faiss_top_k=10, tavily_top_k=3):
-    """
-    Combines vector retrieval from FAISS with real-time search from Tavily.
-    """
-    retriever = vector_store.as_retriever(search_kwargs={"k": faiss_top_k})
-    faiss_results = retriever.invoke(query)
-
-    # Filter FAISS results based on user-selected sources
-    filtered_faiss_results = filter_docs_by_source(faiss_results, include_infopedia, include_textbooks, include_roots)
-
-    # Tavily Retrieval
-    tavily_response = tavily_client.search(query, search_depth="advanced")
-    tavily_results = tavily_response.get("results", [])[:tavily_top_k]
-
-    # Convert Tavily results into Document format
-    tavily_docs = [
-        Document(page_content=entry["content"], metadata={"source": entry["url"], "score": entry["score"]})
-        for entry in tavily_results
-    ]
-
-    # Combine and Sort Results
-    all_results = filtered_faiss_results + tavily_docs
-    sorted_results = sorted(all_results, key=lambda x: x.metadata.get("score", 1), reverse=True)
-
-    return sorted_results  # Return sorted documents
-
-
-def answer_question_hybrid_search(vector_store, input_question, include_infopedia, include_textbooks, include_roots):
-    retrieved_docs = hybrid_search(vector_store, input_question, include_infopedia, include_textbooks, include_roots)
-
-    if not retrieved_docs:
-        return {"answer": "No relevant sources found based on your filters.", "context": []}
+def stream_answer(user_input, include_infopedia, include_textbooks, include_roots):
+    """Streams the answer from the answer service if RAG_SERVICE_URL is set, otherwise computes it here."""
+    if RAG_SERVICE_URL:
+        from util.service_util import stream_answer_remote
+        return stream_answer_remote(RAG_SERVICE_URL, user_input, include_infopedia, include_textbooks, include_roots)
+    from util.rag_util import stream_answer_hybrid_search
+    return stream_answer_hybrid_search(load_vectorstore(), user_input, include_infopedia, include_textbooks, include_roots)
 
-    formatted_context = "\n\n".join(
-        f"{' | '.join(f'{key}: {value}' for key, value in doc.metadata.items())}\n{doc.page_content[:500]}"
-        for doc in retrieved_docs
-    )
 
-    rag_chain = (
-        RunnableLambda(lambda x: {"context": x["context"], "question": x["question"]})
-        | ANSWER_QUESTION_PROMPT
-        | ChatOpenAI(model="gpt-4o", temperature=0, openai_api_key=os.getenv("OPENAI_API_KEY"))
-    )
+def remember_response(response):
+    """Keeps the response and its sources table in session state, computed once per question."""
+    import pandas as pd
+    from util.rag_util import sources_table
 
-    result = rag_chain.invoke({"context": formatted_context, "question": input_question})
-
-    if not validate_answer_format(result.content):
-        return {"answer": "Validation failed. Please try again.", "context": []}
-
-    return {"answer": result.content, "context": retrieved_docs}
+    st.session_state.response = {**response}
+    st.session_state.sources_df = pd.DataFrame(sources_table(response["context"])) if response["context"] else None
 
 
 def render_ui():
@@ -193,6 +105,8 @@ def render_ui():
         include_roots = st.checkbox("Roots Articles", value=True)
     
     user_input = st.text_input("Enter your question:", key="query_input")
+    if not (include_infopedia or include_textbooks or include_roots):
+        st.warning("Warning: No sources selected. Tick at least one source to search the knowledge base.")
     
     # if st.button("Get Answer"):
     #     if user_input:
@@ -204,43 +118,69 @@ def render_ui():
 
 
     # Update UI to Use Hybrid Search
+    if not warmup.is_ready():
+        st.caption("Loading the knowledge base in the background, so the first answer may take a little longer.")
+
     if st.button("Get Answer"):
         if user_input:
-            st.session_state.response = answer_question_hybrid_search(
-                st.session_state.vectorstore, user_input, include_infopedia, include_textbooks, include_roots
-            )
+            if not warmup.is_ready():
+                with st.spinner("Loading the knowledge base..."):
+                    warmup.wait()
+            from util.rag_util import wait_for_evaluation
+            # Stream the answer into a placeholder so the first perspective shows while the rest is generated
+            answer_placeholder = st.empty()
+            # The source evaluation runs in the background and is shown here as soon as it is ready
+            evaluation_placeholder = st.empty()
+            evaluation_future = None
+            evaluation_shown = False
+            for event, value in stream_answer(user_input, include_infopedia, include_textbooks, include_roots):
+                if event == "evaluation":
+                    evaluation_future = value
+                elif event == "token":
+                    with answer_placeholder.container():
+                        st.subheader("Answer:")
+                        st.markdown(value + "▌")
+                elif event == "retry":
+                    answer_placeholder.info("The answer was not in the expected format, regenerating...")
+                elif event == "done":
+                    remember_response(value)
+                if evaluation_future is not None and evaluation_future.done() and not evaluation_shown:
+                    with evaluation_placeholder.container():
+                        st.subheader("Source Evaluation")
+                        st.write(wait_for_evaluation({}, evaluation_future))
+                    evaluation_shown = True
+            st.session_state.evaluation_future = evaluation_future
+            answer_placeholder.empty()
+            evaluation_placeholder.empty()
         else:
             st.warning("Please enter a question.")
     
+    # Everything below is read from session state, so reruns (filters, expanders, typing) make no LLM calls
     if 'response' in st.session_state and st.session_state.response:
         st.subheader("Answer:")
         st.write(st.session_state.response['answer'])
+        if st.session_state.response.get('cached'):
+            st.caption("Served from the answer cache.")
+        elif st.session_state.response.get('retrieval'):
+            st.caption("Retrieved from: " + ", ".join(
+                f"{name}: {status}" for name, status in st.session_state.response['retrieval'].items()
+            ))
 
         with st.expander("Referenced Sources"):
             if st.session_state.response['context']:
-                sources_data = []
-                
-                for doc in st.session_state.response['context']:
-                    source_info = {
-                        "Title": doc.metadata.get("title", "Unknown"),
-                        "Source": doc.metadata.get("source", "Unknown"),
-                        "Page": doc.metadata.get("page", "N/A"),  # Include Page Number
-                        "Page Content": doc.page_content[:300] + "...",
-                        "URL": doc.metadata.get("url","N/A")
-                    }
-
-                    sources_data.append(source_info)
-
-                df_sources = pd.DataFrame(sources_data)
-
-                # Drop the "URL" column since it’s empty
-                st.table(df_sources)
+                st.table(st.session_state.get("sources_df"))
                 
                 st.subheader("Source Evaluation")
-                evaluation = evaluate_sources(df_sources.reset_index(drop=True))
-                st.write(evaluation)
-
-if 'vectorstore' not in st.session_state:
-    st.session_state.vectorstore = load_vectorstore()
+                if st.session_state.response.get("evaluation") is None:
+                    from util.rag_util import wait_for_evaluation
+                    # Only the first render after a question waits; the result is then kept with the response
+                    with st.spinner("Evaluating sources..."):
+                        wait_for_evaluation(st.session_state.response, st.session_state.get("evaluation_future"))
+                    st.session_state.evaluation_future = None
+                st.write(st.session_state.response.get("evaluation") or "No source evaluation available.")
 
 render_ui()
+# Time from the start of the session to its first interactive page, recorded once per session
+if not st.session_state.get("first_page_recorded"):
+    st.session_state.first_page_recorded = True
+    warmup.record_first_page(run_started)
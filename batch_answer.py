@@ -0,0 +1,136 @@
+# Answer a whole list of questions (e.g. a term's inquiry questions) without the web UI
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from util.batch_util import completed_ids, question_id, read_questions
+from util.rag_util import answer_question_hybrid_search, retrieval_degraded, sources_table
+from util.retrieval_util import selected_categories
+from util.vectorstore_util import open_vectorstore
+
+load_dotenv()
+
+INDEX_PATH = "faiss_index_infopedia"
+
+
+def answer_one(vector_store, row, query_vector, include_infopedia, include_textbooks, include_roots):
+    """Answers one question and returns its output record; failures are recorded so a rerun retries them.
+
+    An answer that failed validation, whose source evaluation failed, or that was built while a search
+    timed out or failed, is written with an error as well, so a rerun asks again.
+    """
+    start = time.perf_counter()
+    record = {"id": row["id"], "question": row["question"], "input": row["input"]}
+    try:
+        response = answer_question_hybrid_search(
+            vector_store, row["question"], include_infopedia, include_textbooks, include_roots,
+            query_vector=query_vector, with_evaluation=True
+        )
+        degraded = retrieval_degraded(response.get("retrieval") or {})
+        error = None
+        if response.get("validation_failed"):
+            error = "answer failed validation"
+        elif response.get("evaluation_failed"):
+            error = "source evaluation failed"
+        elif degraded:
+            error = f"partial retrieval ({', '.join(degraded)} unavailable)"
+        record.update(
+            answer=response["answer"],
+            sources=sources_table(response["context"]),
+            evaluation=response.get("evaluation"),
+            retrieval=response.get("retrieval"),
+            cached=bool(response.get("cached")),
+            error=error
+        )
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["elapsed_s"] = round(time.perf_counter() - start, 2)
+    return record
+
+
+def main(input_path, output_path, concurrency=4, include_infopedia=True, include_textbooks=True, include_roots=True,
+         index_path=INDEX_PATH, embed_batch_size=500, embeddings=None):
+    filters = selected_categories(include_infopedia, include_textbooks, include_roots)
+    done = completed_ids(output_path)
+
+    # Questions already answered in a previous run, and repeats within the file, are skipped
+    pending = {}
+    for row in read_questions(input_path):
+        question = str(row["question"]).strip()
+        row_id = str(row["id"]) if row.get("id") is not None else question_id(question, filters)
+        if row_id not in done and row_id not in pending:
+            pending[row_id] = {"id": row_id, "question": question, "input": row}
+    print(f"{len(pending)} questions to answer ({len(done)} already done)")
+    if not pending:
+        return
+
+    vector_store = open_vectorstore(index_path, embeddings)
+
+    # Embed the questions in a few large requests instead of one request per question
+    rows = list(pending.values())
+    query_vectors = []
+    for start in range(0, len(rows), embed_batch_size):
+        query_vectors += vector_store.embeddings.embed_documents(
+            [row["question"] for row in rows[start:start + embed_batch_size]]
+        )
+
+    # A killed run can leave a partial last line; start on a fresh line so new records stay readable
+    if os.path.exists(output_path) and os.path.getsize(output_path):
+        with open(output_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+        if needs_newline:
+            with open(output_path, "a", encoding="utf-8") as f:
+                f.write("\n")
+
+    write_lock = threading.Lock()
+    answered = failed = 0
+    batch_start = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as output, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(answer_one, vector_store, row, query_vector, include_infopedia, include_textbooks, include_roots)
+            for row, query_vector in zip(rows, query_vectors)
+        ]
+        # Records are written as each question finishes, so an interrupted batch keeps its progress
+        for future in as_completed(futures):
+            record = future.result()
+            with write_lock:
+                output.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                output.flush()
+            if record["error"]:
+                failed += 1
+                print(f"Failed: {record['question'][:60]} ({record['error']})")
+            else:
+                answered += 1
+            print(f"[{answered + failed}/{len(rows)}] {record['question'][:60]} ({record['elapsed_s']}s)")
+
+    elapsed = time.perf_counter() - batch_start
+    print(f"✅ {answered} answered, {failed} failed in {elapsed:.0f}s ({answered / elapsed * 60:.1f} questions/min)")
+    if failed:
+        print("Run the same command again to retry the failed questions.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer a list of questions and write the results as JSONL.")
+    parser.add_argument("input", help="Questions as CSV/XLSX (a 'question' column, else the first column), JSONL or text.")
+    parser.add_argument("output", help="JSONL file the answers are appended to; rerunning skips answered questions.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of questions answered at the same time.")
+    parser.add_argument("--no-infopedia", action="store_true", help="Do not retrieve from Infopedia.")
+    parser.add_argument("--no-textbooks", action="store_true", help="Do not retrieve from the textbooks.")
+    parser.add_argument("--no-roots", action="store_true", help="Do not retrieve from Roots articles.")
+    parser.add_argument("--index-path", default=INDEX_PATH, help="Folder of the vector store to search.")
+    args = parser.parse_args()
+    main(
+        args.input,
+        args.output,
+        concurrency=args.concurrency,
+        include_infopedia=not args.no_infopedia,
+        include_textbooks=not args.no_textbooks,
+        include_roots=not args.no_roots,
+        index_path=args.index_path
+    )
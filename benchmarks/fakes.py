@@ -0,0 +1,86 @@
+# filename: fakes.py
+# """
+# Offline stand-ins for the services the answer pipeline calls, for benchmarks.
+# Replies are deterministic (derived from the prompt) and follow the formats the
+# pipeline validates, and each stand-in sleeps for a configurable latency so the
+# benchmark can model the real services' response times without network access.
+# """
+import hashlib
+import re
+import time
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+def _seed(text):
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:4], "little")
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model that answers the answer and source-evaluation prompts in their expected formats.
+
+    first_token_latency is slept before the reply starts, token_latency per streamed word.
+    """
+
+    first_token_latency: float = 0.0
+    token_latency: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def _reply(self, prompt):
+        if "reliability of information sources" in prompt:
+            count = len(re.findall(r"^Source \d+:", prompt, flags=re.MULTILINE))
+            return "\n\n".join(
+                f"### Source {number}: Source {number}\n"
+                f"1. **Reliability Rating**: {('High', 'Medium', 'Low')[_seed(f'{prompt}{number}') % 3]}\n"
+                f"2. **Justification**: The source is an established reference on Singapore's history.\n"
+                f"3. **Any Potential Biases or Limitations**: Coverage of the topic is brief."
+                for number in range(1, count + 1)
+            )
+        question = prompt.rsplit("Question:", 1)[-1].strip()
+        perspectives = 3 + _seed(prompt) % 3
+        lines = [
+            f"Perspective {number}: One view of \"{question[:80]}\" is that it was shaped by factor {number}.\n"
+            f"Page: {number * 7}, Book Title: Sec{1 + number % 2}\n"
+            for number in range(1, perspectives + 1)
+        ]
+        lines.append("Discussion Questions:\n")
+        lines += [f"{number}. How does perspective {number} change your view of the question?\n" for number in (1, 2, 3)]
+        return "\n".join(lines)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        text = self._reply(messages[-1].content)
+        time.sleep(self.first_token_latency + self.token_latency * len(text.split()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        text = self._reply(messages[-1].content)
+        time.sleep(self.first_token_latency)
+        for word in re.findall(r"\S+\s*", text):
+            time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+
+class FakeTavilyClient:
+    """Tavily client returning deterministic web results after latency seconds."""
+
+    def __init__(self, latency=0.0, results=5):
+        self.latency = latency
+        self.results = results
+
+    def search(self, query, search_depth="basic", **kwargs):
+        time.sleep(self.latency)
+        key = hashlib.sha256(query.encode("utf-8")).hexdigest()[:8]
+        return {"query": query, "results": [
+            {
+                "title": f"Web result {rank} for {query[:40]}",
+                "url": f"https://example.org/{key}/{rank}",
+                "content": f"A web page discussing {query}. " * 8,
+                "score": round(0.9 - 0.1 * rank, 2),
+            }
+            for rank in range(self.results)
+        ]}
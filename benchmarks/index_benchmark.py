@@ -0,0 +1,114 @@
+# filename: index_benchmark.py
+# """
+# Recall vs latency vs memory benchmark for the FAISS index types generate_vectordb.py can build.
+# Ground truth is the exact (flat) index; recall@k is the share of its top-k each
+# approximate configuration also returns.
+#
+# Usage (from the repo root):
+#     python benchmarks/index_benchmark.py --index-path faiss_index_infopedia
+#     python benchmarks/index_benchmark.py --synthetic 100000     # projected corpus size, random vectors
+# """
+import argparse
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util.index_util import EXACT_INDEX_FILE, build_ann_index, index_memory_bytes  # noqa: E402
+
+# (index type, build parameters, query-time parameter swept, values)
+DEFAULT_CONFIGS = [
+    ("flat", {}, None, [None]),
+    ("hnsw", {"hnsw_m": 32}, "ef_search", [16, 32, 64, 128, 256]),
+    ("ivfflat", {}, "nprobe", [1, 4, 16, 32, 64]),
+    ("ivfsq8", {}, "nprobe", [4, 16, 32, 64]),
+    ("ivfpq", {"pq_m": 64}, "nprobe", [4, 16, 32, 64]),
+    ("ivfpq", {"pq_m": 96}, "nprobe", [16, 32, 64]),
+]
+
+
+def load_vectors(index_path):
+    """Reads every stored vector from the exact index of a build."""
+    exact_path = os.path.join(index_path, EXACT_INDEX_FILE)
+    if not os.path.exists(exact_path):
+        exact_path = os.path.join(index_path, "index.faiss")
+    index = faiss.read_index(exact_path)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def sample_queries(vectors, count, noise, seed=0):
+    """Perturbs randomly chosen stored vectors so queries resemble, but do not equal, indexed chunks."""
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=count, replace=False)].copy()
+    queries += rng.normal(scale=noise, size=queries.shape).astype(np.float32)
+    faiss.normalize_L2(queries)
+    return queries
+
+
+def set_query_param(index, name, value):
+    if name == "ef_search":
+        faiss.downcast_index(index).hnsw.efSearch = value
+    elif name == "nprobe":
+        faiss.extract_index_ivf(index).nprobe = value
+
+
+def measure(index, queries, ground_truth, k):
+    """Returns (recall@k, p50 ms, p95 ms), timing one query at a time like the app does."""
+    latencies = []
+    hits = 0
+    for query, truth in zip(queries, ground_truth):
+        start = time.perf_counter()
+        _, indices = index.search(query[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(set(indices[0]) & set(truth))
+    return hits / (len(queries) * k), float(np.percentile(latencies, 50)), float(np.percentile(latencies, 95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FAISS index types for recall, latency and memory.")
+    parser.add_argument("--index-path", default="faiss_index_infopedia", help="Folder written by generate_vectordb.py.")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="Benchmark N random unit vectors instead of a built index (to project growth).")
+    parser.add_argument("--dim", type=int, default=1536, help="Vector size for --synthetic.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.02, help="Perturbation applied to sampled query vectors.")
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        vectors = np.random.default_rng(1).standard_normal((args.synthetic, args.dim)).astype(np.float32)
+        faiss.normalize_L2(vectors)
+    else:
+        vectors = load_vectors(args.index_path)
+    queries = sample_queries(vectors, min(args.queries, len(vectors)), args.noise)
+    print(f"{len(vectors)} vectors of size {vectors.shape[1]}, {len(queries)} queries, recall@{args.k}\n")
+
+    exact = build_ann_index(vectors, "flat")
+    _, ground_truth = exact.search(queries, args.k)
+
+    print(f"{'index':<10} {'build params':<14} {'query param':<16} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'memory MB':>10} {'build s':>8}")
+    for index_type, build_params, param_name, values in DEFAULT_CONFIGS:
+        try:
+            start = time.perf_counter()
+            index = exact if index_type == "flat" else build_ann_index(vectors, index_type, **build_params)
+            build_seconds = time.perf_counter() - start
+        except Exception as e:
+            print(f"{index_type:<10} skipped: {e}")
+            continue
+        memory_mb = index_memory_bytes(index) / 1e6
+        build_label = ",".join(f"{key}={value}" for key, value in build_params.items()) or "-"
+        for value in values:
+            if param_name:
+                set_query_param(index, param_name, value)
+            recall, p50, p95 = measure(index, queries, ground_truth, args.k)
+            query_label = f"{param_name}={value}" if param_name else "-"
+            print(f"{index_type:<10} {build_label:<14} {query_label:<16} {recall:>7.3f} {p50:>8.3f} {p95:>8.3f} "
+                  f"{memory_mb:>10.1f} {build_seconds:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
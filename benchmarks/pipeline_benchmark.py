@@ -0,0 +1,202 @@
+# filename: pipeline_benchmark.py
+# """
+# Offline stage-level benchmark of the answer pipeline.
+# Replays a question set through the real retrieval, context formatting, answer
+# validation and source evaluation code, with deterministic local stand-ins for
+# gpt-4o, the OpenAI embeddings and Tavily (each with a configurable latency).
+# Reports p50/p95 per stage, end-to-end latency and throughput at N concurrent
+# users, and peak RSS. Nothing is sent over the network.
+#
+# The index must be built with the fake embeddings so query and index vectors match, in a scratch
+# folder so the real index is left alone:
+#     python generate_vectordb.py --fake-embeddings --tokens-per-minute 0 --index-path faiss_index_fake
+#     python benchmarks/pipeline_benchmark.py --users 1,4,16
+# """
+import argparse
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakes import FakeChatModel, FakeTavilyClient  # noqa: E402
+from util import rag_util  # noqa: E402
+from util.batch_util import read_questions  # noqa: E402
+from util.cache_util import AnswerCache  # noqa: E402
+from util.embedding_util import FakeEmbeddings  # noqa: E402
+from util.index_util import load_manifest  # noqa: E402
+from util.llm_util import SourceEvaluationCache, evaluate_sources_cached, validate_answer_format  # noqa: E402
+from util.rerank_util import RERANK_CANDIDATES  # noqa: E402
+from util.retrieval_util import selected_categories  # noqa: E402
+from util.vectorstore_util import load_local_faiss  # noqa: E402
+
+DEFAULT_INDEX_PATH = "faiss_index_fake"
+DEFAULT_QUESTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "questions.jsonl")
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def timed(timings, stage, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    timings.setdefault(stage, []).append((time.perf_counter() - start) * 1000)
+    return result
+
+
+def measure_stages(vector_store, questions):
+    """Runs each pipeline stage on its own, one question at a time. Returns {stage: [ms]}."""
+    timings = {}
+    categories = selected_categories(True, True, True)
+    evaluation_cache = SourceEvaluationCache(":memory:", ttl_seconds=0)
+    for question in questions:
+        query_vector = timed(timings, "embed query", vector_store.embeddings.embed_query, question)
+        timed(timings, "faiss search", rag_util.faiss_search, vector_store, question, categories, RERANK_CANDIDATES,
+              query_vector)
+        timed(timings, "keyword search", rag_util.keyword_search, vector_store, question, categories, RERANK_CANDIDATES)
+        timed(timings, "tavily search", rag_util.tavily_search, question, 5)
+        docs, _ = timed(timings, "hybrid search", rag_util.hybrid_search, vector_store, question, True, True, True,
+                        RERANK_CANDIDATES, 5, query_vector)
+        context = timed(timings, "format context", rag_util.format_context, docs)
+
+        start = time.perf_counter()
+        answer = ""
+        for chunk in rag_util.answer_chain().stream({"context": context, "question": question}):
+            if not answer:
+                timings.setdefault("first token", []).append((time.perf_counter() - start) * 1000)
+            answer += chunk.content
+        timings.setdefault("generation", []).append((time.perf_counter() - start) * 1000)
+
+        timed(timings, "validate answer", validate_answer_format, answer)
+        timed(timings, "evaluate sources", evaluate_sources_cached, rag_util.sources_table(docs), evaluation_cache,
+              rag_util.get_chat_model())
+    return timings
+
+
+def run_request(vector_store, question):
+    """Answers one question like the app does, including the background source evaluation."""
+    return rag_util.answer_question_hybrid_search(vector_store, question, True, True, True, with_evaluation=True)
+
+
+def measure_concurrency(vector_store, questions, users, rounds):
+    """Each simulated user asks every question `rounds` times, starting at a different offset.
+
+    Returns (end-to-end latencies in ms, requests per second, failures).
+    """
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def user(offset):
+        for position in range(len(questions) * rounds):
+            question = questions[(offset + position) % len(questions)]
+            start = time.perf_counter()
+            try:
+                run_request(vector_store, question)
+            except Exception as e:
+                with lock:
+                    failures.append(f"{type(e).__name__}: {e}")
+                continue
+            with lock:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        for future in [executor.submit(user, offset) for offset in range(users)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+    return latencies, len(latencies) / elapsed, failures
+
+
+def percentiles(values):
+    return float(np.percentile(values, 50)), float(np.percentile(values, 95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency/throughput benchmark of the answer pipeline.")
+    parser.add_argument("--index-path", default=DEFAULT_INDEX_PATH,
+                        help="Folder written by generate_vectordb.py --fake-embeddings --index-path.")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS, help="JSONL, text, CSV or XLSX question set.")
+    parser.add_argument("--users", default="1,4,16", help="Comma-separated concurrent user counts to measure.")
+    parser.add_argument("--rounds", type=int, default=1, help="Passes over the question set per user.")
+    parser.add_argument("--embedding-ms", type=float, default=80, help="Simulated query embedding latency.")
+    parser.add_argument("--llm-first-token-ms", type=float, default=500, help="Simulated gpt-4o time to first token.")
+    parser.add_argument("--llm-token-ms", type=float, default=10, help="Simulated gpt-4o time per streamed word.")
+    parser.add_argument("--tavily-ms", type=float, default=1500, help="Simulated Tavily search latency.")
+    parser.add_argument("--tavily-mode", choices=("always", "fallback", "off"), default=rag_util.TAVILY_MODE)
+    parser.add_argument("--warm-caches", action="store_true",
+                        help="Keep the answer and source-evaluation caches on (by default every request misses).")
+    parser.add_argument("--max-p95-ms", type=float, default=None,
+                        help="Exit with an error if the single-user end-to-end p95 exceeds this (for release gates).")
+    parser.add_argument("--json", metavar="PATH", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    user_counts = [int(value) for value in args.users.split(",")]
+    manifest = load_manifest(os.path.join(args.index_path, "manifest.json"))
+    if not manifest or manifest.get("embedding_model") != "fake-embeddings":
+        parser.error(f"{args.index_path} was not built with --fake-embeddings; build one with\n"
+                     f"  python generate_vectordb.py --fake-embeddings --tokens-per-minute 0 --index-path {args.index_path}")
+    # Request traces would drown out the report
+    os.environ.setdefault("TRACE_STDOUT", "0")
+    questions = [row["question"] for row in read_questions(args.questions)]
+
+    rag_util.TAVILY_MODE = args.tavily_mode
+    rag_util.configure(
+        chat_model=FakeChatModel(first_token_latency=args.llm_first_token_ms / 1000,
+                                 token_latency=args.llm_token_ms / 1000),
+        tavily_client=FakeTavilyClient(latency=args.tavily_ms / 1000),
+    )
+    if not args.warm_caches:
+        rag_util.configure(
+            answer_cache=AnswerCache(max_entries=0),
+            source_evaluation_cache=SourceEvaluationCache(":memory:", ttl_seconds=0),
+        )
+    else:
+        rag_util.configure(source_evaluation_cache=SourceEvaluationCache(":memory:"))
+
+    start = time.perf_counter()
+    vector_store = load_local_faiss(args.index_path, FakeEmbeddings(latency=args.embedding_ms / 1000))
+    load_seconds = time.perf_counter() - start
+    print(f"{vector_store.index.ntotal} vectors loaded in {load_seconds:.2f}s, peak RSS {peak_rss_mb():.0f} MB, "
+          f"{len(questions)} questions, Tavily mode {args.tavily_mode}\n")
+
+    results = {"load_seconds": load_seconds, "stages": {}, "concurrency": {}}
+    print(f"{'stage':<18} {'p50 ms':>9} {'p95 ms':>9}")
+    for stage, values in measure_stages(vector_store, questions).items():
+        p50, p95 = percentiles(values)
+        results["stages"][stage] = {"p50_ms": p50, "p95_ms": p95}
+        print(f"{stage:<18} {p50:>9.2f} {p95:>9.2f}")
+
+    print(f"\n{'users':>5} {'requests':>9} {'p50 ms':>9} {'p95 ms':>9} {'req/s':>7} {'failed':>7} {'peak RSS MB':>12}")
+    for users in user_counts:
+        latencies, throughput, failures = measure_concurrency(vector_store, questions, users, args.rounds)
+        p50, p95 = percentiles(latencies) if latencies else (float("nan"), float("nan"))
+        results["concurrency"][users] = {
+            "requests": len(latencies), "p50_ms": p50, "p95_ms": p95, "requests_per_second": throughput,
+            "failures": len(failures), "peak_rss_mb": peak_rss_mb(),
+        }
+        print(f"{users:>5} {len(latencies):>9} {p50:>9.1f} {p95:>9.1f} {throughput:>7.2f} {len(failures):>7} "
+              f"{peak_rss_mb():>12.0f}")
+        for failure in sorted(set(failures))[:3]:
+            print(f"      {failure}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    single_user = results["concurrency"].get(1)
+    if args.max_p95_ms is not None and single_user and not single_user["p95_ms"] <= args.max_p95_ms:
+        print(f"\nFAIL: single-user p95 {single_user['p95_ms']:.1f} ms exceeds {args.max_p95_ms:.1f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# filename: startup_benchmark.py
+# """
+# Cold-start benchmark of the History Assistant page.
+# Starts fresh Python processes; each one renders the page once with Streamlit's
+# AppTest (the same script run a browser session triggers) and reports the time from
+# process start to the end of the first render (the first interactive page) and to
+# the end of the background warm-up (ready to answer), with the time of each warm-up
+# step. Nothing is sent to OpenAI: the index is only loaded, never queried.
+#
+#     python benchmarks/startup_benchmark.py --runs 5
+# """
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child(timeout):
+    """Runs in the fresh process: renders the page once, then waits for the warm-up."""
+    sys.path.insert(0, ROOT)
+    from streamlit.testing.v1 import AppTest
+
+    from util.warmup_util import process_start_time, start_app_warmup
+
+    app = AppTest.from_file(os.path.join(ROOT, "History_Assistant.py"), default_timeout=timeout)
+    app.run()
+    first_page = time.time() - process_start_time()
+    warmup = start_app_warmup()
+    warmup.wait(timeout)
+    print(json.dumps({
+        "first_page_s": first_page,
+        "ready_s": warmup.ready_after,
+        "steps_s": warmup.timings,
+        "page_errors": [str(error.value) for error in app.exception],
+    }))
+
+
+def run_once(timeout):
+    env = {**os.environ, "PYTHONPATH": ROOT, "TRACE_STDOUT": "0"}
+    # The page stops early without a key; it is never used here
+    env.setdefault("OPENAI_API_KEY", "sk-startup-benchmark")
+    output = subprocess.run(
+        [sys.executable, "-W", "ignore", os.path.abspath(__file__), "--child", "--timeout", str(timeout)],
+        cwd=ROOT, env=env, capture_output=True, text=True, timeout=timeout * 2
+    )
+    if output.returncode != 0:
+        raise RuntimeError(f"start-up run failed:\n{output.stderr[-2000:]}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time from process start to the first page and to ready.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of cold starts to measure.")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for the page and the warm-up.")
+    parser.add_argument("--json", metavar="PATH", help="Also write the results to this JSON file.")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.timeout)
+        return
+
+    runs = [run_once(args.timeout) for _ in range(args.runs)]
+    for run in runs:
+        for error in run["page_errors"]:
+            print(f"Page error: {error}")
+
+    print(f"{'':<22} {'p50 s':>8} {'max s':>8}")
+    rows = {"first interactive page": [run["first_page_s"] for run in runs],
+            "ready to answer": [run["ready_s"] for run in runs]}
+    for step in runs[0]["steps_s"]:
+        rows[f"  {step}"] = [run["steps_s"].get(step, 0.0) for run in runs]
+    for name, values in rows.items():
+        print(f"{name:<22} {np.percentile(values, 50):>8.2f} {max(values):>8.2f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"runs": runs}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
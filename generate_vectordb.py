@@ -4,96 +4,410 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.vectorstores import FAISS
 from langchain.schema import Document
+import argparse
+import faiss
 import os
 import pickle
+import shutil
 import pandas as pd
 from langchain.schema.runnable import RunnableLambda
 from langchain.chat_models import ChatOpenAI
 from dotenv import load_dotenv
+from util.embedding_util import BatchEmbedder, FakeEmbeddings
+from util.retrieval_util import document_categories, source_category
+from util.docstore_util import DOCSTORE_FILE, SQLiteDocstore, SQLiteIndexMapping, write_sqlite_docstore
+from util.s3_util import upload_index
+from util.lexical_util import LEXICAL_FILE, LexicalIndex, write_lexical_index
+from util.dedup_util import CATEGORY_PRIORITY, NearDuplicateFinder, chunk_provenance, merge_provenance
+from util.index_util import (
+    EXACT_INDEX_FILE, INDEX_TYPES, EmbeddingCache, FlatIndexWriter, build_ann_index, chunk_id, diff_manifest,
+    embed_with_cache, load_manifest, read_flat_vectors, save_manifest
+)
 
 # Load environment variables from .env file
 
 load_dotenv()
 
+EMBEDDING_MODEL = "text-embedding-3-small"
+INDEX_PATH = "faiss_index_infopedia"
+MANIFEST_FILE = "manifest.json"
+EMBEDDING_CACHE_PATH = "embedding_cache.sqlite"
+EMBEDDING_CHECKPOINT_DIR = "embedding_checkpoints"
+DEDUP_STATE_PATH = "dedup_state.sqlite"
+CSV_CHUNK_ROWS = 200
+
 
 # Function to sanitize metadata (ensures valid data types for FAISS)
 def sanitize_metadata(metadata):
     return {k: (v if isinstance(v, (str, int, float, bool)) else "Unknown") for k, v in metadata.items()}
 
-# Step 1: Load Articles from CSV
-csv_file = "data/roots_sg_articles_cleaned.csv"
-df = pd.read_csv(csv_file)
-
-# Fill NaN values and ensure text is string type
-df['text'] = df['text'].fillna('missing content').astype(str)
-
-# Convert CSV data into LangChain Document objects
-articles = []
-for _, row in df.iterrows():
-    articles.append(Document(
-        page_content=row['text'],
-        metadata=sanitize_metadata({
-            'title': row['title'],
-            'source': row['source'],
-            'url': row['url']
-        })
-    ))
-
-# Step 2: Load Processed PDF Documents from Pickle File
-with open('data/textbooks.pkl', 'rb') as f:
-    pdf_documents = pickle.load(f)
-
-# Ensure PDF documents have sanitized metadata
-pdf_documents = [
-    Document(page_content=doc.page_content, metadata=sanitize_metadata(doc.metadata))
-    for doc in pdf_documents
-]
-
-# Step 3: Load Infopedia Articles from Pickle File
-with open("data/infopedia.pickle", "rb") as f:
-    infopedia_data = pickle.load(f)
-
-# Convert Infopedia data into LangChain Document objects
-infopedia_articles = []
-for title, details in infopedia_data.items():
-    infopedia_articles.append(Document(
-        page_content=details["content"],
-        metadata=sanitize_metadata({
-            'title': title,
-            'source': details.get('source', 'Unknown'),
-            'url': details.get('url', 'No URL'),
-            'last_update_date': details.get('last_update_date', 'Unknown')
-        })
-    ))
-
-# Combine all document sources (CSV, PDF, Infopedia)
-all_documents = articles + pdf_documents + infopedia_articles
-
-# Step 4: Chunk the Documents
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=800, chunk_overlap=100
-)
-chunks = []
-
-for doc in all_documents:
-    splits = text_splitter.split_text(doc.page_content)
-    for split in splits:
-        chunks.append({
-            "text": split,
-            "metadata": doc.metadata
-        })
-
-# Step 5: Generate Embeddings
-embeddings = OpenAIEmbeddings(model="text-embedding-3-small", openai_api_key=os.getenv("OPENAI_API_KEY"))
-
-# Step 6: Create FAISS Vector Store
-faiss_index = FAISS.from_texts(
-    [chunk["text"] for chunk in chunks], 
-    embeddings, 
-    metadatas=[chunk["metadata"] for chunk in chunks]
-)
 
-# Step 7: Save the FAISS Vector Store
-faiss_index.save_local("faiss_index_infopedia")
+def iter_documents():
+    """Yields every source document as (source_key, Document) pairs, one source row at a time.
+
+    The source key identifies the row a document came from, so a rebuild can tell
+    which chunks belong to which article or textbook page.
+    """
+    # Step 1: Stream Articles from CSV a few hundred rows at a time
+    csv_file = "data/roots_sg_articles_cleaned.csv"
+    for df in pd.read_csv(csv_file, chunksize=CSV_CHUNK_ROWS):
+        # Fill NaN values and ensure text is string type
+        df['text'] = df['text'].fillna('missing content').astype(str)
+
+        # Convert CSV data into LangChain Document objects
+        for row in df.itertuples(index=False):
+            yield f"roots:{row.url if pd.notna(row.url) else row.title}", Document(
+                page_content=row.text,
+                metadata=sanitize_metadata({
+                    'title': row.title,
+                    'source': row.source,
+                    'url': row.url
+                })
+            )
+
+    # Step 2: Load Processed PDF Documents from Pickle File
+    # (the pickle has to be read in one go, but each page is released once it has been chunked)
+    with open('data/textbooks.pkl', 'rb') as f:
+        pdf_documents = pickle.load(f)
+
+    # Ensure PDF documents have sanitized metadata
+    pdf_documents.reverse()
+    while pdf_documents:
+        doc = pdf_documents.pop()
+        metadata = sanitize_metadata(doc.metadata)
+        yield (
+            f"textbook:{metadata.get('source')}:{metadata.get('page')}",
+            Document(page_content=doc.page_content, metadata=metadata)
+        )
+
+    # Step 3: Load Infopedia Articles from Pickle File
+    with open("data/infopedia.pickle", "rb") as f:
+        infopedia_data = pickle.load(f)
+
+    # Convert Infopedia data into LangChain Document objects
+    while infopedia_data:
+        title, details = infopedia_data.popitem()
+        yield f"infopedia:{title}", Document(
+            page_content=details["content"],
+            metadata=sanitize_metadata({
+                'title': title,
+                'source': details.get('source', 'Unknown'),
+                'url': details.get('url', 'No URL'),
+                'last_update_date': details.get('last_update_date', 'Unknown')
+            })
+        )
+
+
+def iter_chunks(documents, sources):
+    """Splits documents into chunks as they arrive, recording {source_key: [vector IDs]} in sources."""
+    # Step 4: Chunk the Documents
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=800, chunk_overlap=100
+    )
+
+    for source_key, doc in documents:
+        # Rows without a unique key (e.g. articles with no URL) are told apart by order of appearance
+        if source_key in sources:
+            duplicate = 2
+            while f"{source_key}#{duplicate}" in sources:
+                duplicate += 1
+            source_key = f"{source_key}#{duplicate}"
+        sources[source_key] = []
+        splits = text_splitter.split_text(doc.page_content)
+        for chunk_index, split in enumerate(splits):
+            vector_id = chunk_id(source_key, chunk_index, split)
+            sources[source_key].append(vector_id)
+            yield {
+                "id": vector_id,
+                "source_key": source_key,
+                "text": split,
+                "metadata": {
+                    **doc.metadata,
+                    "chunk_index": chunk_index,
+                    # Precomputed so retrieval can search only the partitions a teacher selected
+                    "source_category": source_category(doc.metadata.get("source")) or "other"
+                }
+            }
+
+
+def find_near_duplicates(threshold):
+    """First pass over the corpus: finds near-duplicate chunks, keeping their MinHash signatures and source records
+    (not their texts) in a SQLite file. Returns (finder, total chunks, duplicates dropped, kept chunks with copies)."""
+    if os.path.exists(DEDUP_STATE_PATH):
+        os.remove(DEDUP_STATE_PATH)
+    finder = NearDuplicateFinder(threshold=threshold, path=DEDUP_STATE_PATH)
+    total = 0
+    for chunk in iter_chunks(iter_documents(), {}):
+        metadata = chunk["metadata"]
+        finder.add(
+            chunk["id"], chunk["text"], CATEGORY_PRIORITY.get(metadata["source_category"], 0), chunk_provenance(metadata)
+        )
+        total += 1
+    duplicates, with_copies = finder.resolve()
+    return finder, total, duplicates, with_copies
+
+
+def drop_near_duplicates(chunks, sources, finder):
+    """Skips duplicate chunks and records where each kept chunk's dropped copies came from."""
+    for chunk in chunks:
+        if finder.duplicate_of(chunk["id"]) is not None:
+            # Only indexed chunks go in the manifest, so incremental builds never try to delete a dropped one
+            sources[chunk["source_key"]].remove(chunk["id"])
+            continue
+        copies = finder.copies_of(chunk["id"])
+        if copies:
+            chunk = {**chunk, "metadata": merge_provenance(chunk["metadata"], copies)}
+        yield chunk
+
+
+def report_shrink(total, duplicates, with_copies, dimension):
+    """Prints how much near-duplicate removal shrank the index."""
+    kept = total - duplicates
+    print(f"🧹 Near-duplicates: {duplicates} of {total} chunks dropped ({duplicates / max(total, 1):.1%}), "
+          f"{kept} kept; {with_copies} kept chunks carry the sources of their copies")
+    print(f"   Index about {duplicates * dimension * 4 / 1e6:.1f} MB smaller, "
+          f"{duplicates} fewer chunks to embed and to crowd out other results")
+
+
+def iter_shards(chunks, shard_size):
+    """Groups the chunk stream into lists of at most shard_size chunks."""
+    shard = []
+    for chunk in chunks:
+        shard.append(chunk)
+        if len(shard) >= shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def embed_shard(shard, embedder, cache):
+    """Returns (text, vector) pairs for a shard of chunks."""
+    texts = [chunk["text"] for chunk in shard]
+    return list(zip(texts, embed_with_cache(texts, embedder, cache)))
+
+
+def build_full(chunks, embedder, cache, shard_size, build_path):
+    """Builds a new vector store in build_path shard by shard, writing each shard's vectors, documents and keyword
+    index entries to disk before the next one is embedded. Returns (number of vectors, dimension)."""
+    index_writer = FlatIndexWriter(os.path.join(build_path, "index.faiss"))
+    docstore = SQLiteDocstore(os.path.join(build_path, DOCSTORE_FILE), read_only=False)
+    lexical_index = LexicalIndex(os.path.join(build_path, LEXICAL_FILE), read_only=False)
+    for shard_number, shard in enumerate(iter_shards(chunks, shard_size), start=1):
+        vectors = [vector for _, vector in embed_shard(shard, embedder, cache)]
+        ids = [chunk["id"] for chunk in shard]
+        index_writer.add(vectors)
+        docstore.add({chunk["id"]: Document(page_content=chunk["text"], metadata=chunk["metadata"]) for chunk in shard})
+        # Vectors are appended in shard order, so this shard's positions follow on from the previous ones
+        docstore.add_positions(list(enumerate(ids, start=index_writer.ntotal - len(ids))))
+        lexical_index.add([
+            (chunk["id"], chunk["text"], ",".join(sorted(document_categories(chunk["metadata"])))) for chunk in shard
+        ])
+        print(f"Shard {shard_number}: {len(shard)} chunks indexed")
+
+    index_writer.close()
+    for store in (docstore, lexical_index):
+        store.compact()
+        store.conn.close()
+    return index_writer.ntotal, index_writer.dimension
+
+
+def load_for_update(index_path, embeddings):
+    """Loads the existing vector store in index_path for an incremental update, with its exact index.
+
+    The docstore is updated in place when the build wrote docstore.sqlite; an older build's index.pkl is
+    loaded into memory and converted to docstore.sqlite when the update is saved.
+    """
+    exact_path = os.path.join(index_path, EXACT_INDEX_FILE)
+    # The served index may be approximate; updates are applied to the exact one and the approximate one rebuilt
+    index = faiss.read_index(exact_path if os.path.exists(exact_path) else os.path.join(index_path, "index.faiss"))
+    sqlite_path = os.path.join(index_path, DOCSTORE_FILE)
+    if os.path.exists(sqlite_path):
+        docstore = SQLiteDocstore(sqlite_path, read_only=False)
+        # The position mapping is rewritten after the update, since deleting vectors renumbers the rest
+        return FAISS(embeddings, index, docstore, dict(SQLiteIndexMapping(docstore)))
+    faiss_index = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
+    faiss_index.index = index
+    return faiss_index
+
+
+def build_incremental(index_path, chunks, sources, previous_sources, embeddings, embedder, cache, shard_size):
+    """Updates the FAISS vector store in index_path, embedding only new chunks and deleting stale ones.
+
+    The updated exact index is written to index.faiss and the docstore to docstore.sqlite.
+    Returns (number of vectors, dimension, the updated vector store).
+    """
+    faiss_index = load_for_update(index_path, embeddings)
+    previous_ids = {vector_id for ids in previous_sources.values() for vector_id in ids}
+
+    added = 0
+    for shard in iter_shards(chunks, shard_size):
+        new_chunks = [chunk for chunk in shard if chunk["id"] not in previous_ids]
+        if new_chunks:
+            faiss_index.add_embeddings(
+                embed_shard(new_chunks, embedder, cache),
+                metadatas=[chunk["metadata"] for chunk in new_chunks],
+                ids=[chunk["id"] for chunk in new_chunks]
+            )
+            added += len(new_chunks)
+
+    # The chunk stream has been fully consumed, so sources now describes the whole corpus
+    _, ids_to_delete = diff_manifest(previous_sources, sources)
+    if ids_to_delete:
+        faiss_index.delete(list(ids_to_delete))
+
+    faiss.write_index(faiss_index.index, os.path.join(index_path, "index.faiss"))
+    if isinstance(faiss_index.docstore, SQLiteDocstore):
+        faiss_index.docstore.replace_positions(sorted(faiss_index.index_to_docstore_id.items()))
+        faiss_index.docstore.compact()
+    else:
+        write_sqlite_docstore(faiss_index, index_path)
+        os.remove(os.path.join(index_path, "index.pkl"))
+    write_lexical_index(faiss_index, index_path)
+
+    print(f"🔁 Incremental update: {added} chunks added, {len(ids_to_delete)} stale chunks deleted")
+    return faiss_index.index.ntotal, faiss_index.index.d, faiss_index
+
+
+def serve_index_type(folder_path, index_type, index_params):
+    """Swaps in an approximate index for serving, keeping the exact one for updates and benchmarks."""
+    index_path = os.path.join(folder_path, "index.faiss")
+    exact_path = os.path.join(folder_path, EXACT_INDEX_FILE)
+    if index_type == "flat":
+        if os.path.exists(exact_path):
+            os.remove(exact_path)
+        return
+    os.replace(index_path, exact_path)
+    # Read straight from the exact index file; the approximate index itself is built in memory
+    vectors = read_flat_vectors(exact_path)
+    faiss.write_index(build_ann_index(vectors, index_type, **(index_params or {})), index_path)
+    print(f"Built a {index_type} index for serving (exact index kept in {EXACT_INDEX_FILE})")
+
+
+def install_build(build_path, index_path):
+    """Moves a finished build into index_path, replacing the previous build's files."""
+    os.makedirs(index_path, exist_ok=True)
+    for name in os.listdir(build_path):
+        os.replace(os.path.join(build_path, name), os.path.join(index_path, name))
+    # Left over from an older build, and would not line up with the new index
+    for name in ("index.pkl", EXACT_INDEX_FILE):
+        stale = os.path.join(index_path, name)
+        if os.path.exists(stale) and not os.path.exists(os.path.join(build_path, name)):
+            os.remove(stale)
+    os.rmdir(build_path)
+
+
+def main(incremental=False, batch_size=256, workers=4, tokens_per_minute=1_000_000, fake_embeddings=False,
+         shard_size=5000, upload_bucket=None, index_type="flat", index_params=None, dedupe_threshold=0.8,
+         index_path=INDEX_PATH):
+    # Documents are loaded, chunked, embedded and written to disk as a stream, one shard at a time, so a full
+    # build's memory is bounded by the shard size (incremental updates still load the existing index)
+    sources = {}
+    chunks = iter_chunks(iter_documents(), sources)
+
+    # Step 4b: Drop near-duplicate chunks (syndicated articles, quoted passages, boilerplate) before embedding
+    finder = None
+    if dedupe_threshold:
+        finder, total_chunks, duplicates, with_copies = find_near_duplicates(dedupe_threshold)
+        chunks = drop_near_duplicates(chunks, sources, finder)
+
+    # Step 5: Generate Embeddings (cached by chunk text and model, so unchanged chunks are never re-embedded)
+    if fake_embeddings:
+        embedding_model = "fake-embeddings"
+        embeddings = FakeEmbeddings()
+    else:
+        embedding_model = EMBEDDING_MODEL
+        embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL, openai_api_key=os.getenv("OPENAI_API_KEY"))
+    embedder = BatchEmbedder(
+        embeddings,
+        batch_size=batch_size,
+        max_workers=workers,
+        tokens_per_minute=tokens_per_minute,
+        checkpoint_dir=EMBEDDING_CHECKPOINT_DIR
+    )
+    cache = EmbeddingCache(EMBEDDING_CACHE_PATH, embedding_model)
+
+    # Step 6: Create or update the FAISS Vector Store, its SQLite docstore and the BM25 keyword index
+    manifest_path = os.path.join(index_path, MANIFEST_FILE)
+    manifest = load_manifest(manifest_path) if incremental else None
+    if manifest and manifest.get("embedding_model") == embedding_model:
+        total_vectors, dimension, _ = build_incremental(
+            index_path, chunks, sources, manifest["sources"], embeddings, embedder, cache, shard_size
+        )
+        output_path = index_path
+    else:
+        if incremental:
+            print("No compatible previous build found, rebuilding the whole index.")
+        # Built next to the index and only moved into place once complete
+        output_path = f"{index_path}.building"
+        shutil.rmtree(output_path, ignore_errors=True)
+        os.makedirs(output_path)
+        total_vectors, dimension = build_full(chunks, embedder, cache, shard_size, output_path)
+    cache.close()
+    if finder is not None:
+        finder.close()
+        os.remove(DEDUP_STATE_PATH)
+        report_shrink(total_chunks, duplicates, with_copies, dimension)
+
+    # Step 7: Swap in an approximate index for serving if asked, and save the manifest
+    serve_index_type(output_path, index_type, index_params)
+    save_manifest(os.path.join(output_path, MANIFEST_FILE), embedding_model, sources)
+    if output_path != index_path:
+        install_build(output_path, index_path)
+
+    # Step 8: Publish the new version; running apps polling S3 verify it and swap it in
+    if upload_bucket:
+        upload_index(index_path, upload_bucket, prefix=os.getenv("s3_index_prefix", ""))
+        print(f"☁️ Uploaded the vector database to s3://{upload_bucket}")
+
+    print(f"✅ Vector database created successfully! Total documents stored: {total_vectors}")
+
 
-print(f"✅ Vector database created successfully! Total documents stored: {len(chunks)}")
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the FAISS vector database.")
+    parser.add_argument("--index-path", default=INDEX_PATH,
+                        help="Folder the vector database is written to (and read from with --incremental).")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only embed new or changed chunks and delete stale ones from the existing index.")
+    parser.add_argument("--batch-size", type=int, default=256, help="Number of chunks per embedding request.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of embedding requests run in parallel.")
+    parser.add_argument("--tokens-per-minute", type=int, default=1_000_000,
+                        help="Token budget for the embedding API (0 disables throttling).")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Use deterministic local embeddings instead of OpenAI (offline testing only).")
+    parser.add_argument("--shard-size", type=int, default=5000,
+                        help="Number of chunks embedded and written to disk at a time; bounds a full build's memory.")
+    # The docstore is always docstore.sqlite now; accepted so existing build scripts keep working
+    parser.add_argument("--sqlite-docstore", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--upload-s3", metavar="BUCKET",
+                        help="Upload the finished index to this S3 bucket, with checksums for verified downloads.")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default="flat",
+                        help="FAISS index served by the app; see benchmarks/index_benchmark.py to pick one.")
+    parser.add_argument("--hnsw-m", type=int, default=32, help="HNSW: graph neighbours per node.")
+    parser.add_argument("--ef-search", type=int, default=64, help="HNSW: search breadth (higher = better recall).")
+    parser.add_argument("--nlist", type=int, default=None, help="IVF: number of lists (default about 4 * sqrt(n)).")
+    parser.add_argument("--nprobe", type=int, default=16, help="IVF: lists scanned per query (higher = better recall).")
+    parser.add_argument("--pq-m", type=int, default=64, help="IVF-PQ: sub-quantizers; must divide the embedding size.")
+    parser.add_argument("--dedupe-threshold", type=float, default=0.8,
+                        help="Chunks at least this similar (estimated Jaccard of word 5-grams) are stored once.")
+    parser.add_argument("--keep-duplicates", action="store_true", help="Index every chunk, even near-duplicates.")
+    args = parser.parse_args()
+    main(
+        incremental=args.incremental,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        tokens_per_minute=args.tokens_per_minute,
+        fake_embeddings=args.fake_embeddings,
+        shard_size=args.shard_size,
+        upload_bucket=args.upload_s3,
+        index_type=args.index_type,
+        index_params={
+            "hnsw_m": args.hnsw_m,
+            "ef_search": args.ef_search,
+            "nlist": args.nlist,
+            "nprobe": args.nprobe,
+            "pq_m": args.pq_m
+        },
+        dedupe_threshold=None if args.keep_duplicates else args.dedupe_threshold,
+        index_path=args.index_path
+    )
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import streamlit as st
+from util.tracing_util import recent_traces
+from util.utility import check_password
+
+
+if not check_password():
+    st.stop()
+
+st.title("Admin: Pipeline Metrics")
+st.write("Latency, tokens and cost of recent requests. Set `TRACE_LOG_PATH` to include every worker process.")
+
+all_traces = recent_traces()
+
+# Start-up: how long new sessions wait for their first page, and how long processes take until questions can be answered
+startups = [trace for trace in all_traces if trace.get("name") in ("startup", "first page")]
+if startups:
+    st.subheader("Start-up")
+    startup_df = pd.json_normalize(startups)
+    startup_df["started"] = pd.to_datetime(startup_df["started"], unit="s")
+    col1, col2 = st.columns(2)
+    for col, column, label in [(col1, "first_page_render_s", "Session's first page render (s, latest)"),
+                               (col2, "time_to_ready_s", "Time to ready (s, latest)")]:
+        values = startup_df[column].dropna() if column in startup_df.columns else []
+        col.metric(label, f"{values.iloc[-1]:.1f}" if len(values) else "-")
+    with st.expander("Recent start-ups"):
+        st.dataframe(startup_df.drop(columns=["tokens", "cost_usd", "duration_ms"], errors="ignore").iloc[::-1],
+                     hide_index=True, use_container_width=True)
+
+traces = [trace for trace in all_traces if trace.get("name") == "answer"]
+if not traces:
+    st.info("No requests traced yet.")
+    st.stop()
+
+df = pd.json_normalize(traces)
+df["started"] = pd.to_datetime(df["started"], unit="s")
+for column in ["answer_cache", "outcome"]:
+    if column not in df.columns:
+        df[column] = None
+
+col1, col2, col3, col4 = st.columns(4)
+col1.metric("Requests", len(df))
+col2.metric("p50 / p95 (s)", f"{df['duration_ms'].quantile(0.5) / 1000:.1f} / {df['duration_ms'].quantile(0.95) / 1000:.1f}")
+col3.metric("Answer cache hit rate", f"{df['answer_cache'].eq('hit').mean():.0%}")
+col4.metric("Estimated cost (USD)", f"{df['cost_usd'].sum():.2f}")
+
+# Per-stage latency percentiles
+stage_columns = [column for column in df.columns if column.startswith("stages_ms.")]
+st.subheader("Stage latency (ms)")
+stage_summary = pd.DataFrame({
+    "stage": [column.removeprefix("stages_ms.") for column in stage_columns],
+    "requests": [int(df[column].count()) for column in stage_columns],
+    "p50": [df[column].quantile(0.5) for column in stage_columns],
+    "p95": [df[column].quantile(0.95) for column in stage_columns],
+    "max": [df[column].max() for column in stage_columns],
+}).sort_values("p95", ascending=False)
+st.dataframe(stage_summary, hide_index=True, use_container_width=True)
+
+# Rolling latency histogram for one stage (or the whole request)
+st.subheader("Latency histogram")
+choice = st.selectbox("Stage", ["whole request"] + list(stage_summary["stage"]))
+values = df["duration_ms"] if choice == "whole request" else df[f"stages_ms.{choice}"]
+values = values.dropna() / 1000
+if len(values):
+    counts, edges = np.histogram(values, bins=min(30, max(5, len(values) // 5)))
+    st.bar_chart(pd.DataFrame({"requests": counts}, index=[f"{edge:.2f}s" for edge in edges[:-1]]))
+
+st.subheader("Outcomes")
+st.bar_chart(df["outcome"].fillna("unknown").value_counts())
+
+# Latency over time, in one-minute buckets
+st.subheader("Latency over time (p95, s)")
+st.line_chart(df.set_index("started")["duration_ms"].resample("1min").quantile(0.95).dropna() / 1000)
+
+st.subheader("Recent requests")
+columns = [column for column in ["started", "trace_id", "outcome", "answer_cache", "duration_ms", "documents",
+                                 "tavily_results", "validation_failures", "cost_usd"] if column in df.columns]
+st.dataframe(df.sort_values("started", ascending=False)[columns].head(200), hide_index=True, use_container_width=True)
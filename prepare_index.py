@@ -0,0 +1,59 @@
+# Fetches the vector store (from S3 if s3_bucket_name is set) and validates it, e.g. while building the container
+# image, so replicas start with a known-good index on disk instead of downloading it on start-up
+import argparse
+import json
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from util.embedding_util import FakeEmbeddings
+from util.s3_util import S3IndexFetcher, file_sha256
+from util.vectorstore_util import load_local_faiss, validate_vectorstore
+
+load_dotenv()
+
+SNAPSHOT_FILE = "snapshot.json"
+
+
+def check_index(index_path):
+    # Validation only reads stored vectors, so no embedding API calls are made
+    return validate_vectorstore(load_local_faiss(index_path, FakeEmbeddings()))
+
+
+def main(index_path, bucket=None, prefix=""):
+    start = time.perf_counter()
+    summary = None
+    try:
+        if bucket:
+            # Installs the version exactly as the app would (validated before it is made current),
+            # so at start-up the app finds it already current
+            fetcher = S3IndexFetcher(bucket, local_root="nhb_vectorstore", prefix=prefix)
+            index_path, downloaded, summary = fetcher.fetch(prepare=check_index)
+            print(f"{'Downloaded' if downloaded else 'Already have'} index version {os.path.basename(index_path)}")
+        if summary is None:
+            summary = check_index(index_path)
+    except ValueError as e:
+        print(f"❌ Index {f's3://{bucket}/{prefix}' if bucket else f'at {index_path}'} failed validation: {e}")
+        sys.exit(1)
+
+    summary.update(
+        validated_at=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        files={name: file_sha256(os.path.join(index_path, name))
+               for name in sorted(os.listdir(index_path)) if name != SNAPSHOT_FILE},
+    )
+    with open(os.path.join(index_path, SNAPSHOT_FILE), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    print(f"✅ Index at {index_path} is valid: {summary['vectors']} vectors, {summary['categories']} "
+          f"(checked in {time.perf_counter() - start:.1f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch and validate the vector store snapshot the app will serve.")
+    parser.add_argument("--index-path", default="faiss_index_infopedia",
+                        help="Local index folder to validate when no S3 bucket is given.")
+    parser.add_argument("--s3-bucket", default=os.getenv("s3_bucket_name"), help="Bucket to fetch the index from.")
+    parser.add_argument("--s3-prefix", default=os.getenv("s3_index_prefix", ""), help="Key prefix of the index in S3.")
+    args = parser.parse_args()
+    main(args.index_path, bucket=args.s3_bucket, prefix=args.s3_prefix)
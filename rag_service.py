@@ -0,0 +1,122 @@
+# Async HTTP service for the retrieval and answer pipeline, shared by the Streamlit app and other front ends
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from util.batch_util import question_id
+from util.retrieval_util import selected_categories
+from util.service_util import RequestCoalescer, run_pipeline
+from util.tracing_util import start_metrics_endpoint
+from util.vectorstore_util import load_serving_vectorstore
+
+load_dotenv()
+
+# Pipeline runs in progress at once; each holds a worker thread while it waits on the upstreams
+SERVICE_WORKERS = int(os.getenv("SERVICE_WORKERS", "32"))
+
+EXECUTOR = web.AppKey("executor", ThreadPoolExecutor)
+COALESCER = web.AppKey("coalescer", RequestCoalescer)
+SHARED_STORE = web.AppKey("shared_store", dict)
+
+
+def read_request(body):
+    """Validates an answer request. Returns (question, include_infopedia, include_textbooks, include_roots)."""
+    question = str(body.get("question") or "").strip()
+    if not question:
+        raise web.HTTPBadRequest(text="question is required")
+    return (
+        question,
+        bool(body.get("include_infopedia", True)),
+        bool(body.get("include_textbooks", True)),
+        bool(body.get("include_roots", True)),
+    )
+
+
+def join_pipeline(app, request_args):
+    """Returns the shared event stream for this question, starting a pipeline run unless one is already in flight."""
+    question, include_infopedia, include_textbooks, include_roots = request_args
+    key = question_id(question, selected_categories(include_infopedia, include_textbooks, include_roots))
+    return app[COALESCER].join(key, run_pipeline, app[SHARED_STORE]["store"], *request_args)
+
+
+async def answer(request):
+    """POST /answer: the whole response as JSON; with_evaluation also waits for the source evaluation."""
+    body = await request.json()
+    stream = join_pipeline(request.app, read_request(body))
+    response = None
+    # The evaluation can arrive before "done" (e.g. when every source's verdict was cached)
+    evaluation = None
+    async for event in stream.subscribe():
+        if event["event"] == "error":
+            raise web.HTTPBadGateway(text=event["message"])
+        if event["event"] == "evaluation":
+            evaluation = event["text"]
+        elif event["event"] == "done":
+            response = event["response"]
+            if not body.get("with_evaluation") or not response["context"]:
+                break
+        if response is not None and (evaluation is not None or response.get("evaluation") is not None):
+            break
+    if evaluation is not None and response is not None and body.get("with_evaluation"):
+        response = {**response, "evaluation": evaluation}
+    return web.json_response(response, dumps=lambda data: json.dumps(data, default=str))
+
+
+async def answer_stream(request):
+    """POST /answer/stream: the pipeline's events as JSON lines, the answer streamed token by token."""
+    stream = join_pipeline(request.app, read_request(await request.json()))
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    async for event in stream.subscribe():
+        await response.write((json.dumps(event, default=str) + "\n").encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
+async def health(request):
+    coalescer = request.app[COALESCER]
+    return web.json_response({
+        "status": "ok",
+        "vectors": request.app[SHARED_STORE]["store"].index.ntotal,
+        "in_flight": len(coalescer.in_flight),
+        "runs_started": coalescer.started,
+        "requests_coalesced": coalescer.coalesced,
+    })
+
+
+async def on_startup(app):
+    executor = ThreadPoolExecutor(max_workers=SERVICE_WORKERS, thread_name_prefix="pipeline")
+    app[EXECUTOR] = executor
+    app[COALESCER] = RequestCoalescer(executor)
+    # Loading the index blocks, so do it off the event loop
+    app[SHARED_STORE] = await asyncio.get_running_loop().run_in_executor(executor, load_serving_vectorstore)
+    start_metrics_endpoint()
+
+
+async def on_cleanup(app):
+    app[EXECUTOR].shutdown(wait=False, cancel_futures=True)
+
+
+def create_app():
+    app = web.Application()
+    app.add_routes([
+        web.post("/answer", answer),
+        web.post("/answer/stream", answer_stream),
+        web.get("/healthz", health),
+    ])
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the retrieval and answer pipeline over HTTP.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    web.run_app(create_app(), host=args.host, port=args.port)
@@ -0,0 +1,16 @@
+# Starts the Streamlit app with the warm-up already running, so the index is loaded before the first visitor arrives
+# (streamlit run only runs the script, and so starts the warm-up, when a session connects).
+# Extra arguments are passed on to streamlit run, e.g. python serve_app.py --server.port 8501
+import sys
+
+from dotenv import load_dotenv
+from streamlit.web import cli as stcli
+
+from util.warmup_util import start_app_warmup
+
+if __name__ == "__main__":
+    load_dotenv(".env")
+    # Same process as the Streamlit server, so the script picks up this warm-up instead of starting its own
+    start_app_warmup()
+    sys.argv = ["streamlit", "run", "History_Assistant.py", *sys.argv[1:]]
+    sys.exit(stcli.main())
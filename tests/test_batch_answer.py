@@ -0,0 +1,51 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+import pandas as pd
+
+import batch_answer
+from util.batch_util import completed_ids, read_questions
+from util.rag_util import wait_for_evaluation
+
+
+class BatchAnswerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_questions_are_read_from_xlsx(self):
+        path = os.path.join(self.tmp, "questions.xlsx")
+        pd.DataFrame({"Inquiry question": ["Who founded Singapore?", None, "Why did the merger fail?"]}).to_excel(
+            path, index=False
+        )
+        self.assertEqual([row["question"] for row in read_questions(path)],
+                         ["Who founded Singapore?", "Why did the merger fail?"])
+
+    def test_failed_source_evaluation_is_retried(self):
+        failed = Future()
+        failed.set_exception(TimeoutError("gpt-4o timed out"))
+
+        def answer(*args, **kwargs):
+            response = {"answer": "Perspective 1: Raffles.", "context": [], "retrieval": {}}
+            wait_for_evaluation(response, failed)
+            return response
+
+        row = {"id": "q1", "question": "Who founded Singapore?", "input": {}}
+        with mock.patch.object(batch_answer, "answer_question_hybrid_search", answer):
+            record = batch_answer.answer_one(None, row, None, True, True, True)
+        self.assertEqual(record["error"], "source evaluation failed")
+        self.assertIn("gpt-4o timed out", record["evaluation"])
+
+        output_path = os.path.join(self.tmp, "answers.jsonl")
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+        self.assertEqual(completed_ids(output_path), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+
+import numpy as np
+
+from util.cache_util import AnswerCache
+
+FILTERS = ["infopedia", "textbooks"]
+
+
+class AnswerCacheSimilarityTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = AnswerCache()
+        self.vector = np.array([1.0, 0.0, 0.0])
+        # Near enough to the cached question's embedding to pass the similarity threshold
+        self.near = np.array([1.0, 0.1, 0.0])
+        self.cache.put("What caused the 1964 race riots?", FILTERS, {"answer": "1964", "context": []}, self.vector)
+
+    def test_similar_question_is_served(self):
+        response = self.cache.get_similar("Why did the 1964 race riots happen?", self.near, FILTERS)
+        self.assertEqual(response["answer"], "1964")
+
+    def test_different_numbers_are_not_served(self):
+        for question in ("What caused the 1969 race riots?", "What caused the race riots?",
+                         "What caused the 1964 and 1969 race riots?"):
+            self.assertIsNone(self.cache.get_similar(question, self.near, FILTERS), question)
+
+    def test_matching_numbers_pick_among_similar_entries(self):
+        self.cache.put("What caused the 1969 race riots?", FILTERS, {"answer": "1969", "context": []}, self.near)
+        response = self.cache.get_similar("Causes of the 1969 riots", self.vector, FILTERS)
+        self.assertEqual(response["answer"], "1969")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from util.embedding_util import BatchEmbedder, FakeEmbeddings
+from util.index_util import EmbeddingCache, embed_with_cache
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class FlakyEmbeddings(FakeEmbeddings):
+    """Fake embeddings that raise the given errors on the first calls, and record the texts of every call."""
+
+    def __init__(self, errors=()):
+        super().__init__(size=8)
+        self.errors = list(errors)
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        if self.errors:
+            raise self.errors.pop(0)
+        return super().embed_documents(texts)
+
+
+def shards(count, size=4):
+    return [[f"shard {shard} chunk {chunk}" for chunk in range(size)] for shard in range(count)]
+
+
+class BatchEmbedderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        sleep = mock.patch("util.embedding_util.time.sleep")
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def embedder(self, backend, **kwargs):
+        return BatchEmbedder(backend, batch_size=4, max_workers=1, tokens_per_minute=0, **kwargs)
+
+    def test_rerun_skips_cached_shards(self):
+        cache = EmbeddingCache(os.path.join(self.tmp, "cache.sqlite"), "fake")
+        self.addCleanup(cache.close)
+        # The first build dies on its third shard
+        backend = FlakyEmbeddings()
+        embedder = self.embedder(backend)
+        for shard in shards(2):
+            embed_with_cache(shard, embedder, cache)
+        backend.errors = [HTTPError(401)]
+        with self.assertRaises(HTTPError):
+            embed_with_cache(shards(3)[2], embedder, cache)
+
+        rerun = FlakyEmbeddings()
+        vectors = [embed_with_cache(shard, self.embedder(rerun), cache) for shard in shards(3)]
+        self.assertEqual(rerun.calls, [shards(3)[2]])
+        self.assertEqual(vectors, [FlakyEmbeddings().embed_documents(shard) for shard in shards(3)])
+
+    def test_rerun_resumes_from_checkpointed_batches(self):
+        checkpoint_dir = os.path.join(self.tmp, "checkpoints")
+        texts = [text for shard in shards(3) for text in shard]
+        backend = FlakyEmbeddings()
+        backend.embed_documents = mock.Mock(side_effect=[FakeEmbeddings(size=8).embed_documents(texts[:4]),
+                                                         HTTPError(400)])
+        with self.assertRaises(HTTPError):
+            self.embedder(backend, checkpoint_dir=checkpoint_dir).embed_documents(texts)
+
+        rerun = FlakyEmbeddings()
+        vectors = self.embedder(rerun, checkpoint_dir=checkpoint_dir).embed_documents(texts)
+        # The first batch finished before the failure, so it is read back instead of embedded again
+        self.assertNotIn(texts[:4], rerun.calls)
+        self.assertIn(texts[4:8], rerun.calls)
+        self.assertEqual(vectors, FakeEmbeddings(size=8).embed_documents(texts))
+        self.assertEqual(os.listdir(checkpoint_dir), [])
+
+    def test_transient_failures_are_retried_with_backoff(self):
+        for error in (HTTPError(429), HTTPError(503), ConnectionError("connection reset")):
+            backend = FlakyEmbeddings([error, error])
+            self.sleep.reset_mock()
+            vectors = self.embedder(backend).embed_documents(shards(1)[0])
+            self.assertEqual(len(vectors), 4)
+            self.assertEqual(len(backend.calls), 3)
+            delays = [call.args[0] for call in self.sleep.call_args_list]
+            self.assertEqual(len(delays), 2)
+            self.assertGreater(delays[1], delays[0], error)
+
+    def test_client_errors_are_not_retried(self):
+        for status in (400, 401):
+            backend = FlakyEmbeddings([HTTPError(status)])
+            self.sleep.reset_mock()
+            with self.assertRaises(HTTPError):
+                self.embedder(backend).embed_documents(shards(1)[0])
+            self.assertEqual(len(backend.calls), 1)
+            self.sleep.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from util.llm_util import (
+    PARTIAL_ANSWER_CHECK_CHARS, SourceEvaluationCache, evaluate_sources_cached, parse_answer_format,
+    validate_answer_format, validate_partial_answer_format,
+)
+
+VALID_ANSWERS = [
+    # The format the prompt asks for
+    "Perspective 1: Raffles founded modern Singapore in 1819.\n"
+    "Page: 12, Book Title: Sec1\n"
+    "Perspective 2: Sang Nila Utama founded Singapura in the 13th century.\n"
+    "Website Link: https://www.roots.gov.sg/\n\n"
+    "Discussion Questions:\n1. Who should be called the founder?\n2. Why do accounts differ?\n",
+    # Bold headings with a dash, which the page has always displayed
+    "**Perspective 1** - " + "Raffles and the British East India Company set up a trading post in 1819. " * 8
+    + "\n**Perspective 2** - " + "The Malay Annals credit Sang Nila Utama. " * 8
+    + "\n\n**Discussion Questions**\n- Who was there before 1819?\n",
+    # Markdown headings with the summary on the next line
+    "### Perspective 1:\nThe Japanese Occupation ended British claims of invincibility.\n\n"
+    "### Perspective 2:\nIt also left lasting scars on the population.\n",
+    # The off-topic refusal
+    "I'm sorry, I don't have the available information. Please refer to other resources.",
+    "",
+]
+
+MALFORMED_ANSWERS = [
+    # A long essay with no perspectives at all
+    "Singapore's founding is usually dated to 1819, when Stamford Raffles signed a treaty. " * 20,
+    # Numbered points instead of perspective headings
+    "".join(f"{number}. One view is that the founding of Singapore was shaped by factor {number}.\n" for number in range(1, 12)),
+    # Mentions perspectives only in passing, never as a heading
+    "There are several perspectives on this question, and Perspective 1 of the textbook is one of them. " * 6,
+]
+
+
+class AnswerFormatTest(unittest.TestCase):
+    def test_valid_answers_pass(self):
+        for answer in VALID_ANSWERS:
+            self.assertTrue(validate_answer_format(answer), answer)
+
+    def test_malformed_answers_fail(self):
+        for answer in MALFORMED_ANSWERS:
+            self.assertFalse(validate_answer_format(answer), answer)
+
+    def test_both_heading_styles_are_parsed(self):
+        self.assertEqual(len(parse_answer_format(VALID_ANSWERS[0])["perspectives"]), 2)
+        self.assertEqual(len(parse_answer_format(VALID_ANSWERS[1])["perspectives"]), 2)
+        self.assertEqual(len(parse_answer_format(VALID_ANSWERS[2])["perspectives"]), 2)
+
+
+class PartialAnswerFormatTest(unittest.TestCase):
+    def test_no_prefix_of_a_valid_answer_is_rejected(self):
+        for answer in VALID_ANSWERS:
+            for end in range(len(answer) + 1):
+                self.assertTrue(validate_partial_answer_format(answer[:end]), answer[:end])
+
+    def test_malformed_answers_are_rejected_while_streaming(self):
+        for answer in MALFORMED_ANSWERS:
+            self.assertTrue(validate_partial_answer_format(answer[:PARTIAL_ANSWER_CHECK_CHARS - 1]))
+            self.assertFalse(validate_partial_answer_format(answer[:PARTIAL_ANSWER_CHECK_CHARS]), answer)
+            # Once rejected, a longer prefix stays rejected
+            self.assertFalse(validate_partial_answer_format(answer))
+
+    def test_late_heading_is_rejected(self):
+        answer = "Some background first. " * 30 + "\nPerspective 1: Raffles founded modern Singapore.\n"
+        self.assertFalse(validate_partial_answer_format(answer[:PARTIAL_ANSWER_CHECK_CHARS]))
+
+
+class SourceEvaluationTest(unittest.TestCase):
+    ROWS = [
+        {"Source": "Infopedia", "Title": "Raffles", "URL": "https://www.nlb.gov.sg/raffles"},
+        {"Source": "Sec1", "Title": "Founding", "Page": 12},
+        {"Source": "Infopedia", "Title": "Raffles", "URL": "https://www.nlb.gov.sg/raffles"},
+        {"Source": "Roots", "Title": "Temasek", "URL": "https://www.roots.gov.sg/temasek"},
+    ]
+
+    def test_verdicts_are_numbered_by_table_row(self):
+        cache = SourceEvaluationCache(":memory:")
+        cache.put_many({"https://www.roots.gov.sg/temasek": "### Source 1: Temasek\nReliability: High"})
+        # Only the two unseen sources are sent, numbered 1 and 2
+        llm = FakeListChatModel(responses=[
+            "### Source 1: Raffles\nReliability: High\n\n### Source 2: Founding\nReliability: High"
+        ])
+        evaluation = evaluate_sources_cached(self.ROWS, cache, llm=llm)
+        self.assertEqual(
+            [line for line in evaluation.splitlines() if line.startswith("###")],
+            ["### Source 1: Raffles", "### Source 2: Founding", "### Source 3: Raffles", "### Source 4: Temasek"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import moto
+except ImportError:  # the S3 tests need moto (pip install moto)
+    moto = None
+
+from util.s3_util import MANIFEST_KEY, S3IndexFetcher, make_s3_client, upload_index
+
+BUCKET = "index-bucket"
+
+
+def write_index(folder, content):
+    os.makedirs(folder, exist_ok=True)
+    for name in ("index.faiss", "index.pkl"):
+        with open(os.path.join(folder, name), "w", encoding="utf-8") as f:
+            f.write(f"{name} {content}")
+    return folder
+
+
+def read_index(path):
+    with open(os.path.join(path, "index.faiss"), encoding="utf-8") as f:
+        return f.read()
+
+
+@unittest.skipUnless(moto, "moto is not installed")
+class S3IndexFetcherTest(unittest.TestCase):
+    def setUp(self):
+        for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+            os.environ.setdefault(name, "testing")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        self.mock = moto.mock_aws()
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+        self.client = make_s3_client()
+        self.client.create_bucket(Bucket=BUCKET)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.fetcher = S3IndexFetcher(BUCKET, local_root=os.path.join(self.tmp, "local"), client=self.client)
+
+    def publish(self, content):
+        return upload_index(write_index(os.path.join(self.tmp, content), content), BUCKET, client=self.client)
+
+    def test_new_version_is_swapped_in_after_prepare(self):
+        first = self.publish("v1")
+        path, is_new, prepared = self.fetcher.fetch(prepare=read_index)
+        self.assertEqual((self.fetcher.current_version(), is_new, prepared), (first, True, "index.faiss v1"))
+
+        second = self.publish("v2")
+        prepared_versions = []
+
+        def prepare(new_path):
+            # The old version is still current while the new one is being validated
+            prepared_versions.append(self.fetcher.current_version())
+            return read_index(new_path)
+
+        path, is_new, prepared = self.fetcher.fetch(prepare=prepare)
+        self.assertEqual(prepared_versions, [first])
+        self.assertEqual((self.fetcher.current_version(), is_new, prepared), (second, True, "index.faiss v2"))
+        self.assertEqual(path, self.fetcher.version_path(second))
+        # Nothing left half-downloaded, and a fetch with nothing new is a no-op
+        self.assertEqual(sorted(os.listdir(self.fetcher.local_root)), ["CURRENT", "locks", "versions"])
+        self.assertEqual(self.fetcher.fetch(prepare=prepare)[1], False)
+
+    def test_checksum_mismatch_keeps_current_version(self):
+        first = self.publish("v1")
+        self.fetcher.fetch()
+        second = self.publish("v2")
+        # A file replaced after the manifest was written
+        self.client.put_object(Bucket=BUCKET, Key=f"versions/{second}/index.pkl", Body=b"index.pkl v3")
+
+        with self.assertRaisesRegex(IOError, "does not match the manifest"):
+            self.fetcher.fetch()
+        self.assertEqual(self.fetcher.current_version(), first)
+        self.assertFalse(os.path.exists(self.fetcher.version_path(second)))
+        self.assertEqual(sorted(os.listdir(self.fetcher.local_root)), ["CURRENT", "locks", "versions"])
+
+    def test_rejected_version_is_not_retried(self):
+        first = self.publish("v1")
+        self.fetcher.fetch()
+        second = self.publish("v2")
+        calls = []
+
+        def failing_prepare(path):
+            calls.append(path)
+            raise ValueError("the index has no vectors")
+
+        with self.assertRaises(ValueError):
+            self.fetcher.fetch(prepare=failing_prepare)
+        self.assertEqual(self.fetcher.current_version(), first)
+        self.assertFalse(os.path.exists(self.fetcher.version_path(second)))
+
+        # Later polls keep serving the current version without downloading the rejected one again
+        path, is_new, _ = self.fetcher.fetch(prepare=failing_prepare)
+        self.assertEqual((path, is_new, len(calls)), (self.fetcher.version_path(first), False, 1))
+
+        # Until a new version is published
+        third = self.publish("v3")
+        self.fetcher.fetch(prepare=read_index)
+        self.assertEqual(self.fetcher.current_version(), third)
+
+    def test_old_version_is_kept_while_leased(self):
+        first = self.publish("v1")
+        self.fetcher.fetch()
+        lease = self.fetcher.lease(first)
+        self.publish("v2")
+        self.fetcher.fetch()
+        third = self.publish("v3")
+        self.fetcher.fetch()
+        self.assertTrue(os.path.isdir(self.fetcher.version_path(first)))
+
+        lease.release()
+        self.publish("v4")
+        self.fetcher.fetch()
+        self.assertFalse(os.path.exists(self.fetcher.version_path(first)))
+        self.assertTrue(os.path.isdir(self.fetcher.version_path(third)))
+
+    def test_legacy_root_layout_is_read(self):
+        # Buckets published before LATEST.json kept the files at the root
+        folder = write_index(os.path.join(self.tmp, "legacy"), "legacy")
+        for name in ("index.faiss", "index.pkl"):
+            self.client.upload_file(os.path.join(folder, name), BUCKET, name)
+
+        path, is_new, prepared = self.fetcher.fetch(prepare=read_index)
+        self.assertTrue(is_new)
+        self.assertTrue(self.fetcher.current_version().startswith("legacy-"))
+        self.assertEqual(prepared, "index.faiss legacy")
+        self.assertFalse(self.fetcher.fetch()[1])
+
+        # A download that doesn't match the object's ETag is rejected
+        self.client.put_object(Bucket=BUCKET, Key="index.pkl", Body=b"index.pkl legacX")
+        with self.assertRaisesRegex(IOError, "ETag"):
+            S3IndexFetcher._verify(os.path.join(folder, "index.pkl"), self.fetcher.remote_manifest()["files"]["index.pkl"])
+
+        # Publishing a manifest takes over from the root files
+        version = self.publish("v1")
+        self.fetcher.fetch()
+        self.assertEqual(self.fetcher.current_version(), version)
+        self.client.head_object(Bucket=BUCKET, Key=MANIFEST_KEY)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+# filename: batch_util.py
+import hashlib
+import json
+import os
+
+from util.cache_util import normalise_question
+
+# """
+# Helpers for answering question lists in bulk.
+# Reads questions from CSV/XLSX/JSONL/text files and tracks which ones already have
+# an answer in the JSONL output, so an interrupted batch can be rerun and only the
+# remaining questions are answered.
+# """
+
+
+def question_id(question, filters):
+    """Stable ID for a question asked with a set of source filters."""
+    key = f"{','.join(sorted(filters))}|{normalise_question(question)}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def read_questions(path):
+    """Reads questions from JSONL ({"question": ...} per line), CSV/XLSX (a "question" column, else the first
+    column) or plain text (one per line). Returns a list of dicts with "question" and any other fields given."""
+    if path.endswith(".jsonl"):
+        with open(path, "r", encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    elif path.endswith((".csv", ".xlsx", ".xls")):
+        import pandas as pd
+        frame = pd.read_csv(path) if path.endswith(".csv") else pd.read_excel(path)
+        if "question" not in frame.columns:
+            frame = frame.rename(columns={frame.columns[0]: "question"})
+        frame = frame.dropna(subset=["question"])
+        rows = frame.astype(object).where(frame.notna(), None).to_dict("records")
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            rows = [{"question": line.strip()} for line in f if line.strip()]
+    return [row for row in rows if str(row["question"]).strip()]
+
+
+def completed_ids(output_path):
+    """Returns the IDs of questions already answered successfully in a JSONL output file."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short when the previous run was killed
+            if not record.get("error"):
+                done.add(record["id"])
+    return done
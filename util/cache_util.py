@@ -0,0 +1,155 @@
+# filename: cache_util.py
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from langchain.schema import Document
+
+# """
+# Process-wide answer cache.
+# Answers are keyed by the normalised question plus the active source filters. A
+# lookup tries an exact match first, then falls back to the most similar cached
+# question (by embedding cosine similarity) above a configurable threshold that
+# mentions the same numbers (years, counts), which embeddings barely tell apart.
+# Entries expire after a TTL, the least recently used are evicted first, and the
+# cache can optionally be backed by SQLite so it survives restarts.
+# """
+
+
+def normalise_question(question):
+    """Lowercases the question and strips punctuation and extra whitespace."""
+    question = re.sub(r"[^\w\s]", " ", question.lower())
+    return re.sub(r"\s+", " ", question).strip()
+
+
+def question_numbers(question):
+    """The numbers in a question (years, counts, "19th" century), in order; a similar cached question must match them."""
+    return re.findall(r"\d+", normalise_question(question))
+
+
+def _filters_key(filters):
+    return ",".join(sorted(filters))
+
+
+def _serialise_response(response):
+    return json.dumps({
+        **response,
+        "context": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in response["context"]],
+    }, default=str)
+
+
+def _deserialise_response(blob):
+    response = json.loads(blob)
+    response["context"] = [Document(**doc) for doc in response["context"]]
+    return response
+
+
+class AnswerCache:
+    """LRU + TTL cache of answers with exact and embedding-similarity lookup."""
+
+    def __init__(self, max_entries=512, ttl_seconds=86400, similarity_threshold=0.92, disk_path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.lock = threading.Lock()
+        # key -> {"filters", "created", "embedding", "response"}
+        self.entries = OrderedDict()
+        self.conn = None
+        if disk_path:
+            self.conn = sqlite3.connect(disk_path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers "
+                "(key TEXT PRIMARY KEY, filters TEXT, created REAL, embedding BLOB, response TEXT)"
+            )
+            self.conn.commit()
+            self._load_from_disk()
+
+    def _key(self, question, filters):
+        return f"{_filters_key(filters)}|{normalise_question(question)}"
+
+    def _load_from_disk(self):
+        rows = self.conn.execute(
+            "SELECT key, filters, created, embedding, response FROM answers WHERE created > ? "
+            "ORDER BY created DESC LIMIT ?",
+            (time.time() - self.ttl_seconds, self.max_entries),
+        ).fetchall()
+        for key, filters, created, embedding, response in reversed(rows):
+            self.entries[key] = {
+                "filters": filters,
+                "created": created,
+                "embedding": np.frombuffer(embedding, dtype=np.float32) if embedding else None,
+                "response": _deserialise_response(response),
+            }
+
+    def _expired(self, entry):
+        return time.time() - entry["created"] > self.ttl_seconds
+
+    def _evict(self, key):
+        del self.entries[key]
+        if self.conn:
+            self.conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def get(self, question, filters):
+        """Returns the cached response for exactly this (normalised) question and filters, or None."""
+        key = self._key(question, filters)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry):
+                self._evict(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry["response"]
+
+    def get_similar(self, question, query_vector, filters):
+        """Returns the cached response for the most similar question asked with the same filters and mentioning
+        the same numbers, or None."""
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        filters_key = _filters_key(filters)
+        numbers = question_numbers(question)
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if self._expired(entry)]:
+                self._evict(key)
+            candidates = [
+                (key, entry) for key, entry in self.entries.items()
+                if entry["filters"] == filters_key and entry["embedding"] is not None
+                # "the 1964 riots" and "the 1969 riots" embed almost identically but have different answers
+                and question_numbers(key.split("|", 1)[1]) == numbers
+            ]
+            if not candidates:
+                return None
+            similarities = np.stack([entry["embedding"] for _, entry in candidates]) @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                return None
+            key, entry = candidates[best]
+            self.entries.move_to_end(key)
+            return entry["response"]
+
+    def put(self, question, filters, response, query_vector=None):
+        """Caches a response for the question and filters."""
+        key = self._key(question, filters)
+        embedding = None
+        if query_vector is not None:
+            embedding = np.asarray(query_vector, dtype=np.float32)
+            embedding = embedding / (np.linalg.norm(embedding) or 1.0)
+        entry = {"filters": _filters_key(filters), "created": time.time(), "embedding": embedding, "response": response}
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO answers (key, filters, created, embedding, response) VALUES (?, ?, ?, ?, ?)",
+                    (key, entry["filters"], entry["created"],
+                     embedding.tobytes() if embedding is not None else None, _serialise_response(response)),
+                )
+                self.conn.commit()
+            while len(self.entries) > self.max_entries:
+                self._evict(next(iter(self.entries)))
@@ -0,0 +1,160 @@
+# filename: context_util.py
+import math
+import os
+import re
+
+from util.tracing_util import count_tokens
+
+# """
+# Builds the context section of the answer prompt within a token budget.
+# Neighbouring chunks of the same source overlap (the splitter repeats up to 100
+# characters), so chunks that follow each other are joined back into one passage
+# with the overlap removed. Near-duplicate passages (the same text syndicated or
+# quoted in several sources) are dropped, metadata is cut down to what the answer
+# needs for citations, and passages are added in relevance order until the budget
+# measured with tiktoken is used up.
+# """
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2500"))
+# The splitter's chunk_overlap is 100 characters; allow for it landing on a word boundary
+MAX_OVERLAP_CHARS = 200
+MIN_OVERLAP_CHARS = 20
+# Passages whose word 5-grams overlap at least this much count as the same text
+DUPLICATE_THRESHOLD = 0.8
+# Do not bother adding a cut-down passage with less room than this
+MIN_PASSAGE_TOKENS = 60
+
+CITATION_FIELDS = (("title", "Title"), ("source", "Source"), ("page", "Page"), ("url", "URL"))
+SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s+|\n+")
+
+
+def _present(value):
+    return value is not None and not (isinstance(value, float) and math.isnan(value)) \
+        and str(value).strip() not in ("", "N/A", "Unknown", "nan", "No URL")
+
+
+def source_key(metadata):
+    """Chunks with the same key come from the same document (and page, for the textbooks)."""
+    return tuple(str(metadata.get(field)) for field, _ in CITATION_FIELDS)
+
+
+def citation_header(metadata):
+    """Only the metadata the answer cites (title, source, page, URL), skipping empty values."""
+    header = " | ".join(
+        f"{label}: {metadata[field]}" for field, label in CITATION_FIELDS if _present(metadata.get(field))
+    )
+    if metadata.get("duplicate_sources"):
+        # The same passage also appears in these sources (merged at build time)
+        header += " | Also in: " + "; ".join(metadata["duplicate_sources"][:3])
+    return header
+
+
+def join_overlapping(first, second):
+    """Joins two consecutive chunks, removing the text the splitter repeated at the start of the second."""
+    for length in range(min(len(first), len(second), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:length]):
+            return first + second[length:]
+    return first.rstrip() + " " + second.lstrip()
+
+
+def _shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < 5:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + 5]) for i in range(len(words) - 4)}
+
+
+def is_near_duplicate(shingles, kept_shingles):
+    """True if most of the smaller passage's 5-grams also appear in the other one."""
+    overlap = len(shingles & kept_shingles)
+    return overlap >= DUPLICATE_THRESHOLD * min(len(shingles), len(kept_shingles))
+
+
+def merge_passages(docs):
+    """Groups docs (best first) by source and joins consecutive chunks.
+
+    Returns [(metadata, [passage texts])] ordered by each source's best-ranked chunk.
+    """
+    groups = {}
+    for doc in docs:
+        groups.setdefault(source_key(doc.metadata), []).append(doc)
+
+    merged = []
+    for group in groups.values():
+        passages = []
+        previous_index = None
+        # Within a source, put chunks back in document order so neighbours can be joined
+        for doc in sorted(group, key=lambda doc: doc.metadata.get("chunk_index", math.inf)):
+            chunk_index = doc.metadata.get("chunk_index")
+            if passages and chunk_index is not None and previous_index is not None and chunk_index == previous_index + 1:
+                passages[-1] = join_overlapping(passages[-1], doc.page_content)
+            elif passages and chunk_index is not None and chunk_index == previous_index:
+                pass  # the same chunk retrieved twice
+            else:
+                passages.append(doc.page_content)
+            previous_index = chunk_index
+        merged.append((group[0].metadata, passages))
+    return merged
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cuts text to at most max_tokens, ending on a sentence boundary where possible."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    # Start from a character estimate and shrink until it fits
+    cut = text[:max_tokens * 4]
+    while cut and count_tokens(cut) > max_tokens:
+        cut = cut[:int(len(cut) * 0.9)]
+    boundaries = [match.start() for match in SENTENCE_END.finditer(cut)]
+    if boundaries and boundaries[-1] > len(cut) // 2:
+        cut = cut[:boundaries[-1]]
+    return cut.rstrip() + " ..."
+
+
+def pack_context(docs, token_budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Formats docs (best first) into the context section of the answer prompt, within token_budget tokens.
+
+    Returns (context text, stats) where stats counts the sources and tokens used and what was dropped.
+    """
+    blocks = []
+    kept_shingles = []
+    used_tokens = 0
+    duplicates = truncated = over_budget = 0
+
+    for metadata, passages in merge_passages(docs):
+        texts = []
+        for passage in passages:
+            shingles = _shingles(passage)
+            if any(is_near_duplicate(shingles, kept) for kept in kept_shingles):
+                duplicates += 1
+                continue
+            kept_shingles.append(shingles)
+            texts.append(passage.strip())
+        if not texts:
+            continue
+
+        header = citation_header(metadata)
+        block = f"{header}\n" + "\n...\n".join(texts)
+        block_tokens = count_tokens(block)
+        remaining = token_budget - used_tokens
+        if block_tokens > remaining:
+            header_tokens = count_tokens(header) + 1
+            if remaining - header_tokens < MIN_PASSAGE_TOKENS:
+                # A later, shorter source may still fit
+                over_budget += 1
+                continue
+            block = f"{header}\n" + truncate_to_tokens("\n...\n".join(texts), remaining - header_tokens)
+            block_tokens = count_tokens(block)
+            truncated += 1
+        blocks.append(block)
+        used_tokens += block_tokens
+
+    stats = {
+        "context_sources": len(blocks),
+        "context_tokens": used_tokens,
+        "context_duplicates_dropped": duplicates,
+        "context_truncated": truncated,
+        "context_over_budget": over_budget,
+    }
+    return "\n\n".join(blocks), stats
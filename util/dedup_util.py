@@ -0,0 +1,166 @@
+# filename: dedup_util.py
+import json
+import re
+import sqlite3
+import zlib
+
+import numpy as np
+
+# """
+# Near-duplicate chunk detection for index builds.
+# Each chunk gets a MinHash signature over its word 5-grams; locality-sensitive
+# hashing on bands of the signature finds candidate pairs without comparing every
+# chunk with every other one, and candidates are confirmed by the share of matching
+# signature values (an estimate of their Jaccard similarity). The LSH buckets, one
+# signature per cluster and a short provenance record (category and source label)
+# per chunk are kept in SQLite, so the pass runs in constant memory however large
+# the corpus, and the chunk texts are never kept at all.
+# """
+
+SHINGLE_WORDS = 5
+NUM_PERM = 128
+BANDS = 16  # 16 bands of 8 rows: pairs above about 0.7 similarity are very likely to share a band
+
+# Which copy of a duplicated passage to keep: the most authoritative source
+CATEGORY_PRIORITY = {"textbooks": 3, "infopedia": 2, "roots": 1}
+MAX_PROVENANCE = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (band_key BLOB NOT NULL, cluster INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS buckets_by_key ON buckets (band_key);
+CREATE TABLE IF NOT EXISTS clusters (cluster INTEGER PRIMARY KEY, signature BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS members (
+    chunk_id TEXT NOT NULL,
+    cluster INTEGER NOT NULL,
+    priority INTEGER NOT NULL,
+    provenance TEXT
+);
+"""
+
+
+def shingle_hashes(text):
+    """Returns the CRC32 hashes of the text's word 5-grams (or of the whole text, if it is shorter)."""
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_WORDS:
+        shingles = {" ".join(words)}
+    else:
+        shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    return np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64)
+
+
+class NearDuplicateFinder:
+    """Groups chunks whose estimated Jaccard similarity is at least threshold into clusters.
+
+    State lives in a SQLite database at path (a temporary file for builds; in memory by default).
+    Call resolve() after the last add() and then look chunks up with duplicate_of() and copies_of().
+    """
+
+    def __init__(self, threshold=0.8, num_perm=NUM_PERM, bands=BANDS, seed=1, path=":memory:"):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing: ((a * x + b) mod 2^64) >> 32 with odd a, one (a, b) per permutation
+        self.a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+        self.conn = sqlite3.connect(path)
+        # Scratch state for one build, rebuilt from scratch if the build is interrupted
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.executescript(SCHEMA)
+
+    def signature(self, text):
+        hashes = shingle_hashes(text)
+        with np.errstate(over="ignore"):
+            permuted = (hashes[:, None] * self.a[None, :] + self.b[None, :]) >> np.uint64(32)
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def add(self, chunk_id, text, priority=0, provenance=None):
+        """Adds a chunk, joining the first cluster it is a near duplicate of, or starting a new one."""
+        signature = self.signature(text)
+        band_keys = [
+            bytes([band]) + signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)
+        ]
+        # Candidates in band order, then in the order they joined the bucket; the first similar enough one wins
+        band_of = {key: band for band, key in enumerate(band_keys)}
+        candidates = sorted(
+            self.conn.execute(
+                "SELECT b.band_key, b.rowid, b.cluster, c.signature FROM buckets b "
+                f"JOIN clusters c ON c.cluster = b.cluster WHERE b.band_key IN ({','.join('?' * len(band_keys))})",
+                band_keys,
+            ),
+            key=lambda row: (band_of[row[0]], row[1]),
+        )
+        cluster = next((
+            candidate for _, _, candidate, candidate_signature in candidates
+            if np.mean(np.frombuffer(candidate_signature, dtype=np.uint32) == signature) >= self.threshold
+        ), None)
+        if cluster is None:
+            cluster = self.conn.execute("INSERT INTO clusters (signature) VALUES (?)", (signature.tobytes(),)).lastrowid
+            self.conn.executemany("INSERT INTO buckets (band_key, cluster) VALUES (?, ?)",
+                                  [(key, cluster) for key in band_keys])
+        self.conn.execute(
+            "INSERT INTO members (chunk_id, cluster, priority, provenance) VALUES (?, ?, ?, ?)",
+            (chunk_id, cluster, priority, json.dumps(provenance))
+        )
+        return cluster
+
+    def resolve(self):
+        """Picks the chunk kept for each cluster: its highest-priority member (the earliest one on ties).
+
+        Returns (number of duplicates dropped, number of kept chunks that stand in for copies).
+        """
+        self.conn.executescript("""
+            DROP TABLE IF EXISTS kept;
+            CREATE TABLE kept AS
+                SELECT cluster, chunk_id, copies FROM (
+                    SELECT cluster, chunk_id, COUNT(*) OVER (PARTITION BY cluster) - 1 AS copies,
+                           ROW_NUMBER() OVER (PARTITION BY cluster ORDER BY priority DESC, rowid) AS rank
+                    FROM members
+                ) WHERE rank = 1 AND copies > 0;
+            CREATE INDEX IF NOT EXISTS members_by_chunk ON members (chunk_id);
+            CREATE INDEX kept_by_chunk ON kept (chunk_id);
+        """)
+        self.conn.commit()
+        return self.conn.execute("SELECT COALESCE(SUM(copies), 0), COUNT(*) FROM kept").fetchone()
+
+    def duplicate_of(self, chunk_id):
+        """The ID of the chunk kept in place of chunk_id, or None if chunk_id is kept."""
+        row = self.conn.execute(
+            "SELECT k.chunk_id FROM members m JOIN kept k ON k.cluster = m.cluster WHERE m.chunk_id = ?", (chunk_id,)
+        ).fetchone()
+        return row[0] if row is not None and row[0] != chunk_id else None
+
+    def copies_of(self, chunk_id):
+        """The provenance of the dropped copies of a kept chunk ([] if it has none)."""
+        rows = self.conn.execute(
+            "SELECT m.provenance FROM kept k JOIN members m ON m.cluster = k.cluster "
+            "WHERE k.chunk_id = ? AND m.chunk_id != k.chunk_id ORDER BY m.rowid", (chunk_id,)
+        )
+        return [json.loads(provenance) for (provenance,) in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+def chunk_provenance(metadata):
+    """The part of a chunk's metadata that says where it came from."""
+    return {
+        "category": metadata.get("source_category"),
+        "label": " | ".join(
+            str(metadata[field]) for field in ("source", "title", "url", "page")
+            if metadata.get(field) not in (None, "", "Unknown", "No URL")
+        ),
+    }
+
+
+def merge_provenance(metadata, duplicate_provenance):
+    """Adds the sources of a chunk's dropped copies to its metadata."""
+    categories = sorted({item["category"] for item in duplicate_provenance} - {metadata.get("source_category"), None})
+    labels = list(dict.fromkeys(item["label"] for item in duplicate_provenance))
+    merged = {**metadata, "duplicate_count": len(duplicate_provenance), "duplicate_sources": labels[:MAX_PROVENANCE]}
+    if categories:
+        # The chunk stays searchable under every source filter one of its copies belonged to
+        merged["duplicate_categories"] = categories
+    return merged
@@ -0,0 +1,176 @@
+# filename: docstore_util.py
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+from langchain.schema import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+from util.retrieval_util import document_categories
+
+# """
+# SQLite docstore for the FAISS vector store.
+# Replaces the pickled index.pkl: opening it is constant time, each query only reads
+# the rows for the vector IDs it returned, and the metadata shared by every chunk of
+# a source row (title, source, URL...) is stored once and referenced by ID.
+# """
+
+DOCSTORE_FILE = "docstore.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    id INTEGER PRIMARY KEY,
+    json TEXT UNIQUE NOT NULL,
+    category TEXT  -- comma-separated when near-duplicate copies from other categories were merged in
+);
+CREATE TABLE IF NOT EXISTS documents (
+    doc_id TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    metadata_id INTEGER NOT NULL REFERENCES metadata(id),
+    chunk_index INTEGER
+);
+CREATE TABLE IF NOT EXISTS vectors (
+    position INTEGER PRIMARY KEY,
+    doc_id TEXT NOT NULL
+);
+"""
+
+
+class SQLiteDocstore(Docstore, AddableMixin):
+    """LangChain docstore backed by a SQLite file, with one connection per thread."""
+
+    def __init__(self, path, read_only=True):
+        self.path = path
+        self.read_only = read_only
+        self._local = threading.local()
+        if not read_only:
+            self.conn.executescript(SCHEMA)
+            self.conn.commit()
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.read_only:
+                conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def _to_document(self, content, metadata_json, chunk_index):
+        metadata = json.loads(metadata_json)
+        if chunk_index is not None:
+            metadata["chunk_index"] = chunk_index
+        return Document(page_content=content, metadata=metadata)
+
+    def search(self, search):
+        """Returns the Document for a docstore ID, or an error string like InMemoryDocstore."""
+        row = self.conn.execute(
+            "SELECT d.content, m.json, d.chunk_index FROM documents d JOIN metadata m ON m.id = d.metadata_id "
+            "WHERE d.doc_id = ?", (search,)
+        ).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return self._to_document(*row)
+
+    def _metadata_id(self, metadata):
+        metadata_json = json.dumps(metadata, sort_keys=True)
+        category = ",".join(sorted(document_categories(metadata)))
+        self.conn.execute("INSERT OR IGNORE INTO metadata (json, category) VALUES (?, ?)", (metadata_json, category))
+        return self.conn.execute("SELECT id FROM metadata WHERE json = ?", (metadata_json,)).fetchone()[0]
+
+    def add(self, texts):
+        """Adds {doc_id: Document} to the store."""
+        rows = []
+        for doc_id, doc in texts.items():
+            metadata = dict(doc.metadata)
+            chunk_index = metadata.pop("chunk_index", None)
+            rows.append((doc_id, doc.page_content, self._metadata_id(metadata), chunk_index))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO documents (doc_id, content, metadata_id, chunk_index) VALUES (?, ?, ?, ?)", rows
+        )
+        self.conn.commit()
+
+    def delete(self, ids):
+        self.conn.executemany("DELETE FROM documents WHERE doc_id = ?", [(doc_id,) for doc_id in ids])
+        self.conn.commit()
+
+    def add_positions(self, positions):
+        """Maps FAISS positions to docstore IDs, from (position, doc_id) pairs."""
+        self.conn.executemany("INSERT INTO vectors (position, doc_id) VALUES (?, ?)", positions)
+        self.conn.commit()
+
+    def replace_positions(self, positions):
+        """Replaces the whole position mapping, e.g. after vectors were deleted and the rest renumbered."""
+        self.conn.execute("DELETE FROM vectors")
+        self.add_positions(positions)
+
+    def compact(self):
+        """Rewrites the database file without free pages, once it is complete."""
+        self.conn.execute("VACUUM")
+
+    def category_positions(self):
+        """Returns {category: [FAISS positions]} straight from the database."""
+        grouped = {}
+        rows = self.conn.execute(
+            "SELECT v.position, m.category FROM vectors v JOIN documents d ON d.doc_id = v.doc_id "
+            "JOIN metadata m ON m.id = d.metadata_id"
+        )
+        for position, categories in rows:
+            for category in (categories or "").split(","):
+                grouped.setdefault(category, []).append(position)
+        return grouped
+
+
+class SQLiteIndexMapping(MutableMapping):
+    """FAISS position -> docstore ID mapping read lazily from the docstore's vectors table."""
+
+    def __init__(self, docstore):
+        self.docstore = docstore
+
+    def __getitem__(self, position):
+        row = self.docstore.conn.execute(
+            "SELECT doc_id FROM vectors WHERE position = ?", (int(position),)
+        ).fetchone()
+        if row is None:
+            raise KeyError(position)
+        return row[0]
+
+    def __setitem__(self, position, doc_id):
+        self.docstore.conn.execute(
+            "INSERT OR REPLACE INTO vectors (position, doc_id) VALUES (?, ?)", (int(position), doc_id)
+        )
+        self.docstore.conn.commit()
+
+    def __delitem__(self, position):
+        self.docstore.conn.execute("DELETE FROM vectors WHERE position = ?", (int(position),))
+        self.docstore.conn.commit()
+
+    def __iter__(self):
+        for (position,) in self.docstore.conn.execute("SELECT position FROM vectors ORDER BY position"):
+            yield position
+
+    def __len__(self):
+        return self.docstore.conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+
+def write_sqlite_docstore(vector_store, folder_path):
+    """Writes the docstore and position mapping of an in-memory FAISS vector store to docstore.sqlite."""
+    path = os.path.join(folder_path, DOCSTORE_FILE)
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    docstore = SQLiteDocstore(tmp_path, read_only=False)
+    positions = sorted(vector_store.index_to_docstore_id.items())
+    for start in range(0, len(positions), 5000):
+        batch = positions[start:start + 5000]
+        docstore.add({doc_id: vector_store.docstore.search(doc_id) for _, doc_id in batch})
+        docstore.add_positions(batch)
+    docstore.compact()
+    docstore.conn.close()
+    # Swap the finished file in, so a reader never sees a half-written docstore
+    os.replace(tmp_path, path)
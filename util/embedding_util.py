@@ -0,0 +1,172 @@
+# filename: embedding_util.py
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tiktoken
+from langchain_core.embeddings import Embeddings
+
+# """
+# Embedding stage for index builds.
+# Splits texts into batches, runs a bounded number of batches in parallel under a
+# tokens-per-minute budget, retries rate-limited and other transient failures with
+# backoff (but not client errors such as a bad request or a wrong API key) and
+# checkpoints finished batches to disk so a killed build can resume.
+# """
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic local embeddings for offline builds and tests.
+
+    The same text always maps to the same unit vector, so builds are reproducible.
+    """
+
+    def __init__(self, size=1536, latency=0.0):
+        self.size = size
+        self.latency = latency
+
+    def _embed(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.size).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class TokenBudget:
+    """Sliding one-minute window that blocks until there is room for more tokens."""
+
+    def __init__(self, tokens_per_minute):
+        self.tokens_per_minute = tokens_per_minute
+        self.window = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        if not self.tokens_per_minute:
+            return
+        # A single batch larger than the budget is still allowed through on an empty window
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.window and now - self.window[0][0] >= 60:
+                    self.window.popleft()
+                used = sum(count for _, count in self.window)
+                if used + tokens <= self.tokens_per_minute:
+                    self.window.append((now, tokens))
+                    return
+                wait = 60 - (now - self.window[0][0])
+            time.sleep(max(wait, 0.05))
+
+
+def is_rate_limit_error(error):
+    """Returns True if the error looks like an HTTP 429 from the embedding provider."""
+    return getattr(error, "status_code", None) == 429 or "RateLimit" in type(error).__name__
+
+
+def is_retryable_error(error):
+    """Returns False for HTTP client errors that fail the same way every time (400 bad request, 401 bad API key,
+    404 unknown model...); rate limits, timeouts, server errors and connection failures are worth retrying."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if not isinstance(status, int):
+        return True
+    return status in (408, 409, 429) or status >= 500
+
+
+class BatchEmbedder:
+    """Embeds texts in concurrent, throttled, checkpointed batches using any LangChain embeddings backend."""
+
+    def __init__(self, backend, batch_size=256, max_workers=4, tokens_per_minute=1_000_000,
+                 checkpoint_dir=None, max_retries=6):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.budget = TokenBudget(tokens_per_minute)
+        self.checkpoint_dir = checkpoint_dir
+        self.max_retries = max_retries
+        self._encoding = None
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def count_tokens(self, text):
+        """Counts tokens with tiktoken, falling back to a rough estimate when the encoding cannot be loaded offline."""
+        if self._encoding is None:
+            try:
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                self._encoding = False
+        if self._encoding:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return len(text) // 4 + 1
+
+    def _checkpoint_path(self, batch):
+        model = getattr(self.backend, "model", type(self.backend).__name__)
+        digest = hashlib.sha256("\0".join([model, *batch]).encode("utf-8")).hexdigest()
+        return os.path.join(self.checkpoint_dir, f"batch_{digest[:24]}.npy")
+
+    def _embed_batch(self, batch):
+        checkpoint = self._checkpoint_path(batch) if self.checkpoint_dir else None
+        if checkpoint and os.path.exists(checkpoint):
+            return np.load(checkpoint).tolist(), 0, True
+
+        tokens = sum(self.count_tokens(text) for text in batch)
+        for attempt in range(self.max_retries + 1):
+            self.budget.acquire(tokens)
+            try:
+                vectors = self.backend.embed_documents(batch)
+                break
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable_error(e):
+                    raise
+                # Back off harder on rate limits than on other transient failures
+                delay = (2 ** attempt) * (2.0 if is_rate_limit_error(e) else 0.5)
+                print(f"Embedding batch failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay + random.uniform(0, delay / 2))
+
+        if checkpoint:
+            # Write to a temporary file first so a crash never leaves a half-written checkpoint
+            tmp_path = checkpoint[:-len(".npy")] + ".tmp.npy"
+            np.save(tmp_path, np.asarray(vectors, dtype=np.float32))
+            os.replace(tmp_path, checkpoint)
+        return vectors, tokens, False
+
+    def embed_documents(self, texts):
+        """Embeds texts, returning vectors in the same order."""
+        texts = list(texts)
+        if not texts:
+            return []
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(self._embed_batch, batches))
+        elapsed = time.perf_counter() - start
+
+        # Every batch finished, so the checkpoints have served their purpose
+        if self.checkpoint_dir:
+            for batch in batches:
+                checkpoint = self._checkpoint_path(batch)
+                if os.path.exists(checkpoint):
+                    os.remove(checkpoint)
+
+        resumed = sum(1 for _, _, from_checkpoint in results if from_checkpoint)
+        tokens = sum(batch_tokens for _, batch_tokens, _ in results)
+        print(f"Embedded {len(texts)} texts in {len(batches)} batches ({resumed} resumed from checkpoint) "
+              f"in {elapsed:.1f}s: {len(texts) / max(elapsed, 1e-9):.0f} texts/s, "
+              f"{tokens / max(elapsed, 1e-9):.0f} tokens/s")
+        return [vector for vectors, _, _ in results for vector in vectors]
+
+    def embed_query(self, text):
+        return self.backend.embed_query(text)
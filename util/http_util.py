@@ -0,0 +1,91 @@
+# filename: http_util.py
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+from tavily import TavilyClient
+
+from util.tracing_util import current_trace
+
+# """
+# Pooled HTTP connections and concurrency caps for the upstream providers.
+# Each upstream (OpenAI chat, OpenAI embeddings, Tavily) gets one connection pool
+# per process, so requests reuse warm keep-alive connections instead of paying a
+# TCP/TLS handshake each time, and a semaphore of the same size, so a burst of users
+# queues here rather than tripping the provider's rate limits.
+# """
+
+UPSTREAM_LIMITS = {
+    "openai": int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")),
+    "embeddings": int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "16")),
+    "tavily": int(os.getenv("TAVILY_MAX_CONCURRENCY", "4")),
+}
+
+_semaphores = {name: threading.BoundedSemaphore(limit) for name, limit in UPSTREAM_LIMITS.items()}
+
+
+@contextmanager
+def upstream_slot(name):
+    """Holds one of the upstream's concurrency slots; time spent queueing is added to the trace as <name>_wait_ms."""
+    semaphore = _semaphores[name]
+    if not semaphore.acquire(blocking=False):
+        start = time.perf_counter()
+        semaphore.acquire()
+        current_trace().increment(f"{name}_wait_ms", round((time.perf_counter() - start) * 1000, 2))
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def try_upstream_slot(name):
+    """Takes one of the upstream's concurrency slots if one is free, without waiting. Returns whether it did;
+    a slot taken this way is given back with release_upstream_slot (from any thread)."""
+    return _semaphores[name].acquire(blocking=False)
+
+
+def release_upstream_slot(name):
+    _semaphores[name].release()
+
+
+def pooled_http_client(upstream, timeout=60.0):
+    """An httpx client keeping up to the upstream's concurrency limit of connections alive, for the OpenAI SDK."""
+    limit = UPSTREAM_LIMITS[upstream]
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+        timeout=httpx.Timeout(timeout, connect=10.0)
+    )
+
+
+def openai_clients(upstream, api_key=None):
+    """OpenAI SDK clients for LangChain's client/async_client, the sync one on the upstream's pooled connections.
+
+    LangChain passes http_client to both the sync and the async SDK client, which rejects an httpx.Client,
+    so the clients are built here instead.
+    """
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    return openai.OpenAI(api_key=api_key, http_client=pooled_http_client(upstream)), openai.AsyncOpenAI(api_key=api_key)
+
+
+class PooledTavilyClient(TavilyClient):
+    """TavilyClient whose searches go through one pooled requests session (the SDK opens a new connection per call)."""
+
+    def __init__(self, api_key=None, timeout=30.0):
+        super().__init__(api_key=api_key)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_LIMITS["tavily"])
+        self.session.mount("https://", adapter)
+        self.session.headers.update(self.headers)
+
+    def search(self, query, search_depth="basic", max_results=5, **kwargs):
+        data = {"query": query, "search_depth": search_depth, "max_results": max_results, **kwargs}
+        response = self.session.post(self.base_url + "/search", data=json.dumps(data), timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
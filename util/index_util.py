@@ -0,0 +1,212 @@
+# filename: index_util.py
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import struct
+
+import faiss
+import numpy as np
+
+# """
+# Helpers for incremental vector store builds.
+# This includes the content-hashed embedding cache, the build manifest that
+# records which source rows produced which vector IDs, and a writer that appends
+# vectors to an exact FAISS index file on disk as they are embedded.
+# """
+
+
+def text_hash(text, model=""):
+    """Returns a stable hash of the text (and embedding model, if given)."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def chunk_id(source_key, chunk_index, text):
+    """Returns the vector ID for a chunk, derived from where it came from and what it says."""
+    return text_hash(f"{source_key}\0{chunk_index}\0{text}")[:32]
+
+
+class EmbeddingCache:
+    """Persistent embedding cache keyed by a hash of the chunk text and embedding model."""
+
+    def __init__(self, path, model):
+        self.path = path
+        self.model = model
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.conn.commit()
+
+    def get_many(self, texts):
+        """Returns {text: vector} for every text already in the cache."""
+        keys = {text_hash(text, self.model): text for text in texts}
+        found = {}
+        key_list = list(keys)
+        # SQLite limits the number of bound parameters, so look up in slices
+        for start in range(0, len(key_list), 500):
+            batch = key_list[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+            )
+            for key, blob in rows:
+                found[keys[key]] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, text_vectors):
+        """Stores (text, vector) pairs in the cache."""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+            [(text_hash(text, self.model), np.asarray(vector, dtype=np.float32).tobytes())
+             for text, vector in text_vectors],
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def embed_with_cache(texts, embeddings, cache):
+    """Embeds texts, only sending the ones missing from the cache to the embedding model."""
+    cached = cache.get_many(texts)
+    missing = list(dict.fromkeys(text for text in texts if text not in cached))
+    if missing:
+        vectors = embeddings.embed_documents(missing)
+        cache.put_many(zip(missing, vectors))
+        cached.update(zip(missing, vectors))
+    print(f"Embeddings: {len(texts) - len(missing)} from cache, {len(missing)} newly embedded")
+    return [cached[text] for text in texts]
+
+
+def load_manifest(path):
+    """Loads the build manifest, or returns None if there is no previous build."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(path, embedding_model, sources):
+    """Saves the build manifest mapping each source key to the vector IDs it produced."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"embedding_model": embedding_model, "sources": sources}, f)
+
+
+def diff_manifest(old_sources, new_sources):
+    """Returns (ids to add, ids to delete) between two {source_key: [vector IDs]} mappings."""
+    old_ids = {vector_id for ids in old_sources.values() for vector_id in ids}
+    new_ids = {vector_id for ids in new_sources.values() for vector_id in ids}
+    return new_ids - old_ids, old_ids - new_ids
+
+
+class FlatIndexWriter:
+    """Writes an exact (IndexFlatL2) FAISS index file by appending vectors to it, never holding the index in memory.
+
+    The file is laid out exactly as faiss.write_index writes an IndexFlatL2: a header (dimension, vector
+    count, ...), the number of floats stored and then the vectors themselves. The header is written when
+    the first vectors arrive and its counts are filled in by close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.dimension = None
+        self.ntotal = 0
+
+    def add(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.file is None:
+            self.dimension = vectors.shape[1]
+            self.header = flat_index_header(self.dimension)
+            self.file = open(self.path, "wb")
+            self.file.write(self.header)
+        elif vectors.shape[1] != self.dimension:
+            raise ValueError(f"expected vectors of dimension {self.dimension}, got {vectors.shape[1]}")
+        self.file.write(vectors.tobytes())
+        self.ntotal += len(vectors)
+
+    def close(self):
+        if self.file is None:
+            raise ValueError("No vectors were written to the index.")
+        # ntotal sits right after the fourcc and dimension; the float count closes the header
+        self.file.seek(8)
+        self.file.write(struct.pack("<q", self.ntotal))
+        self.file.seek(len(self.header) - 8)
+        self.file.write(struct.pack("<Q", self.ntotal * self.dimension))
+        self.file.close()
+
+
+def flat_index_header(dimension):
+    """The bytes faiss.write_index puts before the vectors of an IndexFlatL2, with the counts left at zero.
+
+    Taken from FAISS itself and checked against an index with vectors in it, so a FAISS release that
+    changes the format fails here instead of producing an unreadable file.
+    """
+    header = faiss.serialize_index(faiss.IndexFlatL2(dimension)).tobytes()
+    probe = np.arange(2 * dimension, dtype=np.float32).reshape(2, dimension)
+    expected = faiss.IndexFlatL2(dimension)
+    expected.add(probe)
+    written = io.BytesIO(header)
+    written.seek(8)
+    written.write(struct.pack("<q", 2))
+    written.seek(len(header) - 8)
+    written.write(struct.pack("<Q", probe.size))
+    if written.getvalue() + probe.tobytes() != faiss.serialize_index(expected).tobytes():
+        raise RuntimeError(f"this FAISS build ({faiss.__version__}) writes flat indexes in an unexpected format")
+    return header
+
+
+def read_flat_vectors(path):
+    """Memory-maps the vectors of an IndexFlatL2 file written by faiss.write_index or FlatIndexWriter."""
+    with open(path, "rb") as f:
+        fourcc, dimension, ntotal = struct.unpack("<4siq", f.read(16))
+    if fourcc != b"IxF2":
+        raise ValueError(f"{path} is not an exact (IndexFlatL2) index")
+    header_length = len(flat_index_header(dimension))
+    return np.memmap(path, dtype=np.float32, mode="r", offset=header_length, shape=(ntotal, dimension))
+
+
+INDEX_TYPES = ("flat", "hnsw", "ivfflat", "ivfpq", "ivfsq8")
+EXACT_INDEX_FILE = "exact.faiss"
+
+
+def build_ann_index(vectors, index_type, hnsw_m=32, ef_construction=200, ef_search=64,
+                    nlist=None, nprobe=16, pq_m=64, pq_bits=8):
+    """Builds an approximate FAISS index of the given type over vectors (row i keeps position i).
+
+    - hnsw: graph index; ef_search trades latency for recall at query time
+    - ivfflat: inverted lists of full vectors; nprobe lists are scanned per query
+    - ivfpq: inverted lists of product-quantized codes (pq_m sub-vectors of pq_bits each)
+    - ivfsq8: inverted lists of 8-bit scalar-quantized vectors
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, d = vectors.shape
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(d)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, hnsw_m)
+        index.hnsw.efConstruction = ef_construction
+        index.hnsw.efSearch = ef_search
+    elif index_type in ("ivfflat", "ivfpq", "ivfsq8"):
+        # Rule of thumb: about 4 * sqrt(n) lists, with enough training points per list
+        nlist = nlist or max(1, min(int(4 * np.sqrt(n)), n // 39))
+        quantizer = faiss.IndexFlatL2(d)
+        if index_type == "ivfflat":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist)
+        elif index_type == "ivfpq":
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, pq_m, pq_bits)
+        else:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, d, nlist, faiss.ScalarQuantizer.QT_8bit)
+        index.train(vectors)
+        index.nprobe = nprobe
+        # The quantizer must outlive this function together with the index
+        index.own_fields = True
+        quantizer.this.disown()
+    else:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+    index.add(vectors)
+    return index
+
+
+def index_memory_bytes(index):
+    """Returns the serialized size of a FAISS index, a close proxy for its resident memory."""
+    return int(faiss.serialize_index(index).nbytes)
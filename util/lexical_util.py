@@ -0,0 +1,111 @@
+# filename: lexical_util.py
+import os
+import re
+import sqlite3
+import threading
+
+from util.retrieval_util import document_categories
+
+# """
+# Local BM25 keyword index over the same chunks as the FAISS index.
+# Uses SQLite's FTS5 full-text index, which stores a compact on-disk inverted index
+# and ranks matches with BM25. Exact names, dates and Malay terms are matched as
+# words; Chinese text has no spaces, so each CJK character is indexed as its own
+# token and a run of characters is searched as a phrase.
+# """
+
+LEXICAL_FILE = "lexical.sqlite"
+
+CJK_CHARACTER = r"[㐀-䶿一-鿿豈-﫿]"
+QUERY_TOKEN = re.compile(rf"{CJK_CHARACTER}+|[^\W_]+")
+
+
+def spread_cjk(text):
+    """Puts spaces around CJK characters so FTS5's unicode61 tokenizer indexes them one by one."""
+    return re.sub(f"({CJK_CHARACTER})", r" \1 ", text)
+
+
+def build_match_query(query):
+    """Turns free text into an FTS5 query matching any of its words (CJK runs as phrases)."""
+    terms = []
+    for token in QUERY_TOKEN.findall(query):
+        if re.match(CJK_CHARACTER, token):
+            terms.append('"' + " ".join(token) + '"')
+        else:
+            terms.append(f'"{token}"')
+    return " OR ".join(terms)
+
+
+class LexicalIndex:
+    """BM25 search over the chunk texts, returning docstore IDs."""
+
+    def __init__(self, path, read_only=True):
+        self.path = path
+        self.read_only = read_only
+        self._local = threading.local()
+        if not read_only:
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5("
+                "content, doc_id UNINDEXED, category UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+            )
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.read_only:
+                conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def add(self, rows):
+        """Adds (doc_id, text, category) rows."""
+        self.conn.executemany(
+            "INSERT INTO chunks (content, doc_id, category) VALUES (?, ?, ?)",
+            [(spread_cjk(text), doc_id, category) for doc_id, text, category in rows],
+        )
+        self.conn.commit()
+
+    def compact(self):
+        """Merges the FTS5 b-trees so the on-disk index is compact and fast to query, once it is complete."""
+        self.conn.execute("INSERT INTO chunks (chunks) VALUES ('optimize')")
+        self.conn.commit()
+        self.conn.execute("VACUUM")
+
+    def search(self, query, categories, k=10):
+        """Returns up to k (doc_id, BM25 score) pairs in the given categories, best first (higher is better)."""
+        match_query = build_match_query(query)
+        if not match_query or not categories:
+            return []
+        # category is comma-separated for chunks that stand in for near-duplicates from other categories
+        patterns = [f"%,{category},%" for category in sorted(categories)]
+        category_filter = " OR ".join(["(',' || category || ',') LIKE ?"] * len(patterns))
+        rows = self.conn.execute(
+            f"SELECT doc_id, bm25(chunks) FROM chunks WHERE chunks MATCH ? "
+            f"AND ({category_filter}) ORDER BY bm25(chunks) LIMIT ?",
+            (match_query, *patterns, k),
+        ).fetchall()
+        # SQLite reports BM25 as a negative number where lower is better
+        return [(doc_id, -score) for doc_id, score in rows]
+
+
+def write_lexical_index(vector_store, folder_path):
+    """Builds lexical.sqlite from the documents of a FAISS vector store."""
+    path = os.path.join(folder_path, LEXICAL_FILE)
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    lexical_index = LexicalIndex(tmp_path, read_only=False)
+    doc_ids = list(vector_store.index_to_docstore_id.values())
+    for start in range(0, len(doc_ids), 5000):
+        rows = []
+        for doc_id in doc_ids[start:start + 5000]:
+            doc = vector_store.docstore.search(doc_id)
+            rows.append((doc_id, doc.page_content, ",".join(sorted(document_categories(doc.metadata)))))
+        lexical_index.add(rows)
+    lexical_index.compact()
+    lexical_index.conn.close()
+    os.replace(tmp_path, path)
@@ -1,9 +1,15 @@
 from langchain.prompts import PromptTemplate
 from langchain.chat_models import ChatOpenAI
 from langchain.schema.runnable import RunnableLambda
+import math
 import os
 import re
-from pydantic import BaseModel, ValidationError
+import sqlite3
+import threading
+import time
+from pydantic import BaseModel, Field, ValidationError
+from util.http_util import upstream_slot
+from util.tracing_util import count_tokens, current_trace
 
 # Define prompt templates
 
@@ -26,6 +32,8 @@ For each source, provide:
 2. **Justification** (explain why you assigned this rating)  
 3. **Any Potential Biases or Limitations**  
 
+Start each source's evaluation with a heading of the form "### Source <number>: <title>", using the numbers given above, and evaluate every source exactly once.
+
 Ensure that your evaluation is structured, concise, and consistent across all sources.
 """)
 
@@ -76,29 +84,152 @@ Question: {question}
 
 
 
-def evaluate_sources(sources_text):
+def evaluate_sources(sources_text, llm=None):
     """Evaluates the reliability of sources."""
     chain = (
         RunnableLambda(lambda x: {"sources": x["sources"]})
         | EVALUATE_SOURCES_PROMPT
-        | ChatOpenAI(model="gpt-4o", temperature=0, openai_api_key=os.getenv("OPENAI_API_KEY"))
+        | (llm or ChatOpenAI(model="gpt-4o", temperature=0, openai_api_key=os.getenv("OPENAI_API_KEY")))
     )
-    result = chain.invoke({"sources": sources_text})
+    trace = current_trace()
+    with upstream_slot("openai"), trace.stage("evaluate sources"):
+        result = chain.invoke({"sources": sources_text})
+    trace.add_tokens("gpt-4o", count_tokens(EVALUATE_SOURCES_PROMPT.format(sources=sources_text)), count_tokens(result.content))
     return result.content
 
 
+def _present(value):
+    return value is not None and not (isinstance(value, float) and math.isnan(value)) \
+        and str(value) not in ("", "N/A", "No URL", "Unknown", "nan")
+
+
+def source_identity(source_row):
+    """Identifies a source across questions: its URL, or its source name and page (e.g. a Sec1 textbook page)."""
+    if _present(source_row.get("URL")):
+        return str(source_row["URL"])
+    if _present(source_row.get("Source")) and str(source_row["Source"]).startswith("http"):
+        return str(source_row["Source"])
+    return f"{source_row.get('Source', 'Unknown')} | page {source_row.get('Page', 'N/A')} | {source_row.get('Title', 'Unknown')}"
+
+
+class SourceEvaluationCache:
+    """Persistent cache of per-source reliability verdicts, so a source is only evaluated once."""
+
+    def __init__(self, path, ttl_seconds=30 * 86400):
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS verdicts (source TEXT PRIMARY KEY, verdict TEXT, created REAL)")
+        self.conn.commit()
+
+    def get_many(self, identities):
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT source, verdict FROM verdicts WHERE created > ? AND source IN ({','.join('?' * len(identities))})",
+                (time.time() - self.ttl_seconds, *identities),
+            ).fetchall()
+        return dict(rows)
+
+    def put_many(self, verdicts):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO verdicts (source, verdict, created) VALUES (?, ?, ?)",
+                [(identity, verdict, time.time()) for identity, verdict in verdicts.items()],
+            )
+            self.conn.commit()
+
+
+def format_sources_for_evaluation(source_rows):
+    """Numbers the sources so each verdict in the LLM output can be matched back to its source."""
+    return "\n\n".join(
+        f"Source {number}:\n" + "\n".join(f"{key}: {value}" for key, value in row.items())
+        for number, row in enumerate(source_rows, start=1)
+    )
+
+
+def split_evaluation(evaluation, count):
+    """Splits an evaluation into {source number: section}, or returns None if it is not one section per source."""
+    parts = re.split(r"^#+\s*Source\s+(\d+)\b", evaluation, flags=re.MULTILINE)
+    sections = {}
+    for number, body in zip(parts[1::2], parts[2::2]):
+        sections[int(number)] = f"### Source {number}{body}".strip()
+    return sections if sorted(sections) == list(range(1, count + 1)) else None
+
+
+def evaluate_sources_cached(source_rows, cache, llm=None):
+    """
+    Evaluates the reliability of sources (a list of dicts like the Referenced Sources table rows),
+    reusing cached verdicts and sending only unseen sources to the LLM.
+    """
+    identities = [source_identity(row) for row in source_rows]
+    cached = cache.get_many(list(set(identities)))
+
+    # Each unseen source is evaluated once, even if several retrieved chunks come from it
+    new_rows = {}
+    for identity, row in zip(identities, source_rows):
+        if identity not in cached and identity not in new_rows:
+            new_rows[identity] = row
+
+    current_trace().set(source_verdicts_cached=len(set(identities)) - len(new_rows), sources_evaluated=len(new_rows))
+    verdicts = dict(cached)
+    if new_rows:
+        evaluation = evaluate_sources(format_sources_for_evaluation(list(new_rows.values())), llm=llm)
+        sections = split_evaluation(evaluation, len(new_rows))
+        if sections is None:
+            # The output could not be split per source, so show it as-is and cache nothing
+            return evaluation
+        new_verdicts = {identity: sections[number] for number, identity in enumerate(new_rows, start=1)}
+        cache.put_many(new_verdicts)
+        verdicts.update(new_verdicts)
+
+    # Number the verdicts by row of the sources table; rows from the same source repeat its verdict
+    ordered = []
+    for number, identity in enumerate(identities, start=1):
+        ordered.append(re.sub(r"^### Source \d+", f"### Source {number}", verdicts[identity]))
+    return "\n\n".join(ordered)
+
+
+
+# A perspective heading as the prompt asks for it ("Perspective 1: ...") or as gpt-4o often writes it in
+# markdown ("**Perspective 1** - ...", "### Perspective 1: ..."); group 1 is the rest of the heading line
+PERSPECTIVE_HEADING = re.compile(
+    r"^[ \t]*(?:#+[ \t]*)?(?:\*\*)?Perspective[ \t]+\d+\b(?:\*\*)?[ \t]*[:.\-\u2013\u2014]?[ \t]*(?:\*\*)?[ \t]*(.*)$",
+    re.MULTILINE,
+)
+
+# A streamed answer this long with no perspective heading is not going to match the expected format.
+# Shorter answers with no heading (e.g. the off-topic refusal) are accepted as they are.
+PARTIAL_ANSWER_CHECK_CHARS = 400
+
 
 class AnswerFormat(BaseModel):
-    perspectives: list[str]
+    perspectives: list[str] = Field(min_length=1)
     discussion_questions: list[str]
 
+def parse_answer_format(answer: str) -> dict:
+    """Pulls the perspectives and discussion questions out of an answer."""
+    perspectives = PERSPECTIVE_HEADING.findall(answer)
+    discussion_questions = re.findall(r"\d+\. (.*?)\n", answer.split("Discussion Questions:")[1] if "Discussion Questions:" in answer else "")
+    return {"perspectives": perspectives, "discussion_questions": discussion_questions}
+
+def is_short_reply(answer: str) -> bool:
+    """True for an answer too short to need perspectives, such as the refusal of an off-topic question."""
+    return len(answer) < PARTIAL_ANSWER_CHECK_CHARS and PERSPECTIVE_HEADING.search(answer) is None
+
 def validate_answer_format(answer: str) -> bool:
     """Validates the LLM output format."""
-    perspectives = re.findall(r"Perspective \d+: (.*?)\n", answer)
-    discussion_questions = re.findall(r"\d+\. (.*?)\n", answer.split("Discussion Questions:")[1] if "Discussion Questions:" in answer else "")
-    
+    if is_short_reply(answer):
+        return True
     try:
-        AnswerFormat(perspectives=perspectives, discussion_questions=discussion_questions)
+        AnswerFormat(**parse_answer_format(answer))
         return True
     except ValidationError:
         return False
+
+
+def validate_partial_answer_format(partial_answer: str) -> bool:
+    """Checks a partially streamed answer, returning False once it is clearly malformed:
+    PARTIAL_ANSWER_CHECK_CHARS characters have streamed without a perspective heading."""
+    if len(partial_answer) < PARTIAL_ANSWER_CHECK_CHARS:
+        return True
+    return PERSPECTIVE_HEADING.search(partial_answer) is not None
@@ -0,0 +1,502 @@
+# filename: rag_util.py
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+
+import numpy as np
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import Document
+from langchain.schema.runnable import RunnableLambda
+
+from util.cache_util import AnswerCache
+from util.context_util import pack_context
+from util.http_util import (
+    UPSTREAM_LIMITS, PooledTavilyClient, openai_clients, release_upstream_slot, try_upstream_slot, upstream_slot
+)
+from util.llm_util import (
+    ANSWER_QUESTION_PROMPT, SourceEvaluationCache, evaluate_sources_cached, validate_answer_format,
+    validate_partial_answer_format
+)
+from util.rerank_util import (
+    RERANK_CANDIDATES, RERANK_TOP_K, distance_to_similarity, rerank, retrieval_scores, with_score
+)
+from util.retrieval_util import (
+    document_key, lexical_search, partitioned_search, reciprocal_rank_fusion, selected_categories, stored_vectors
+)
+from util.tracing_util import count_tokens, current_trace, finish_trace, stage, start_trace, submit_in_context
+
+# """
+# The retrieval and answer pipeline behind the History Assistant page.
+# Kept free of Streamlit so the app, the benchmarks and headless tools share one code
+# path. The LLM, Tavily client, thread pools and caches are created once per process
+# on first use; configure() swaps any of them out, e.g. for offline stand-ins.
+# """
+
+# Deadlines (in seconds) for each retrieval stage; whatever finishes in time is used for the answer.
+# The knowledge base deadline covers embedding the question as well as the FAISS search.
+FAISS_TIMEOUT_S = float(os.getenv("FAISS_TIMEOUT_S", "5"))
+TAVILY_TIMEOUT_S = float(os.getenv("TAVILY_TIMEOUT_S", "6"))
+
+# When to search the web: "always" (alongside local search), "fallback" (only when local results are weak) or "off"
+TAVILY_MODE = os.getenv("TAVILY_MODE", "fallback").lower()
+# Local results count as weak when the best knowledge-base hit is less similar than this (cosine)
+LOCAL_MIN_SIMILARITY = float(os.getenv("LOCAL_MIN_SIMILARITY", "0.4"))
+
+MAX_ANSWER_ATTEMPTS = 2
+
+_resources = {}
+_resources_lock = threading.Lock()
+
+
+def configure(**resources):
+    """Replaces process-wide resources: chat_model, tavily_client, retrieval_executor, tavily_executor,
+    llm_executor, answer_cache or source_evaluation_cache."""
+    with _resources_lock:
+        _resources.update(resources)
+
+
+def _get_resource(name, factory):
+    with _resources_lock:
+        if name not in _resources:
+            _resources[name] = factory()
+        return _resources[name]
+
+
+def _create_chat_model():
+    client, async_client = openai_clients("openai")
+    return ChatOpenAI(
+        model="gpt-4o", temperature=0, openai_api_key=os.getenv("OPENAI_API_KEY"),
+        client=client.chat.completions, async_client=async_client.chat.completions
+    )
+
+
+def get_chat_model():
+    return _get_resource("chat_model", _create_chat_model)
+
+
+def get_tavily_client():
+    # A call still running at the deadline is abandoned, so the HTTP timeout matches it
+    return _get_resource(
+        "tavily_client", lambda: PooledTavilyClient(api_key=os.getenv("TAVILY_API_KEY"), timeout=TAVILY_TIMEOUT_S)
+    )
+
+
+def get_retrieval_executor():
+    """Thread pool shared by all sessions for running the retrieval stages side by side."""
+    return _get_resource(
+        "retrieval_executor", lambda: ThreadPoolExecutor(max_workers=16, thread_name_prefix="retrieval")
+    )
+
+
+def get_tavily_executor():
+    """Thread pool for Tavily calls, kept apart so slow web searches never hold up the local retrieval stages."""
+    return _get_resource(
+        "tavily_executor",
+        lambda: ThreadPoolExecutor(max_workers=UPSTREAM_LIMITS["tavily"], thread_name_prefix="tavily")
+    )
+
+
+def get_llm_executor():
+    """Thread pool shared by all sessions for LLM calls that run alongside answer generation."""
+    return _get_resource("llm_executor", lambda: ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm"))
+
+
+def get_answer_cache():
+    """Answer cache shared by every session in this process."""
+    return _get_resource("answer_cache", lambda: AnswerCache(
+        max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512")),
+        ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL_S", "86400")),
+        similarity_threshold=float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.92")),
+        disk_path=os.getenv("ANSWER_CACHE_PATH") or None
+    ))
+
+
+def get_source_evaluation_cache():
+    """Reliability verdicts per source (URL or textbook page), kept across questions and restarts."""
+    return _get_resource(
+        "source_evaluation_cache",
+        lambda: SourceEvaluationCache(os.getenv("SOURCE_EVAL_CACHE_PATH", "source_evaluations.sqlite"))
+    )
+
+
+def faiss_search(vector_store, query, categories, faiss_top_k, query_vector=None):
+    """Retrieves the top (document, L2 distance, FAISS position) triples from the selected partitions of the FAISS index."""
+    with stage("faiss search"):
+        return partitioned_search(
+            vector_store, query, categories, k=faiss_top_k, query_vector=query_vector, with_positions=True
+        )
+
+
+def keyword_search(vector_store, query, categories, top_k):
+    """Retrieves the top (document, BM25 score) pairs from the local keyword index."""
+    with stage("keyword search"):
+        return lexical_search(vector_store, query, categories, k=top_k)
+
+
+def tavily_search(query, tavily_top_k):
+    """Retrieves real-time web results from Tavily."""
+    with stage("tavily search"):
+        tavily_response = get_tavily_client().search(query, search_depth="advanced")
+    tavily_results = tavily_response.get("results", [])[:tavily_top_k]
+
+    # Convert Tavily results into Document format
+    return [
+        Document(page_content=entry["content"], metadata={"source": entry["url"], "score": entry["score"]})
+        for entry in tavily_results
+    ]
+
+
+def submit_tavily_search(query, tavily_top_k):
+    """Starts a Tavily search on its own pool. Returns the future, or None if every Tavily slot is in use,
+    in which case the web search is skipped rather than queued behind the running ones."""
+    if not try_upstream_slot("tavily"):
+        current_trace().increment("tavily_skipped_busy")
+        return None
+    try:
+        future = submit_in_context(get_tavily_executor(), tavily_search, query, tavily_top_k)
+    except Exception:
+        release_upstream_slot("tavily")
+        raise
+    future.add_done_callback(lambda _: release_upstream_slot("tavily"))
+    return future
+
+
+def _embed_query(vector_store, query):
+    with upstream_slot("embeddings"), stage("embed query"):
+        query_vector = vector_store.embeddings.embed_query(query)
+    current_trace().add_tokens("text-embedding-3-small", count_tokens(query))
+    return query_vector
+
+
+def embed_query_by(vector_store, query, deadline):
+    """Embeds the question on the retrieval pool, waiting until the deadline. Returns (vector or None, status)."""
+    future = submit_in_context(get_retrieval_executor(), _embed_query, vector_store, query)
+    try:
+        return future.result(timeout=max(deadline - time.monotonic(), 0)), "embedded"
+    except FuturesTimeoutError:
+        future.cancel()
+        return None, "timed out"
+    except Exception as e:
+        return None, f"failed ({type(e).__name__})"
+
+
+def retrieval_degraded(retrieval_status):
+    """The retrieval sources that timed out, failed or were skipped as busy, i.e. the answer was built from partial results."""
+    return [source for source, status in retrieval_status.items()
+            if status in ("timed out", "skipped (busy)") or status.startswith("failed")]
+
+
+def collect_result(future, deadline):
+    """Waits for a retrieval future until the deadline. Returns (results, status)."""
+    try:
+        results = future.result(timeout=max(deadline - time.monotonic(), 0))
+        return results, f"{len(results)} results"
+    except FuturesTimeoutError:
+        future.cancel()
+        return [], "timed out"
+    except Exception as e:
+        return [], f"failed ({type(e).__name__})"
+
+
+def candidate_vectors(vector_store, candidates, faiss_hits):
+    """Embeddings of the candidates: the stored FAISS vectors where possible, the rest embedded in one request."""
+    positions = {document_key(doc): position for doc, _, position in faiss_hits}
+    vectors = [None] * len(candidates)
+    stored_indices = [i for i, doc in enumerate(candidates) if document_key(doc) in positions]
+    stored = stored_vectors(vector_store.index, [positions[document_key(candidates[i])] for i in stored_indices])
+    if stored is not None:
+        for i, vector in zip(stored_indices, stored):
+            vectors[i] = vector
+
+    # Keyword-only hits and web results have no stored vector
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        texts = [candidates[i].page_content for i in missing]
+        with upstream_slot("embeddings"), stage("embed candidates"):
+            embedded = vector_store.embeddings.embed_documents(texts)
+        current_trace().add_tokens("text-embedding-3-small", sum(count_tokens(text) for text in texts))
+        for i, vector in zip(missing, embedded):
+            vectors[i] = vector
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def rerank_results(vector_store, query_vector, candidates, scores, faiss_hits, top_k):
+    """Re-ranks the candidate pool by retrieval score and embedding similarity with MMR and keeps the best top_k.
+
+    Falls back to the normalised retrieval scores if the question or the candidates cannot be embedded.
+    Returns (documents best first, method used).
+    """
+    try:
+        if query_vector is None:
+            raise RuntimeError("the question could not be embedded in time")
+        vectors = candidate_vectors(vector_store, candidates, faiss_hits)
+    except Exception as e:
+        print(f"Re-ranking failed, using retrieval scores: {type(e).__name__}: {e}")
+        ranked = sorted(candidates, key=lambda doc: scores[document_key(doc)], reverse=True)[:top_k]
+        return [with_score(doc, scores[document_key(doc)]) for doc in ranked], "retrieval scores"
+    retrieval = [scores[document_key(doc)] for doc in candidates]
+    return rerank(query_vector, candidates, vectors, retrieval, k=top_k), "blended MMR"
+
+
+def hybrid_search(vector_store, query, include_infopedia, include_textbooks, include_roots,
+                  faiss_top_k=RERANK_CANDIDATES, tavily_top_k=5, query_vector=None, top_k=RERANK_TOP_K,
+                  started=None):
+    """
+    Combines dense retrieval from FAISS and BM25 keyword retrieval, merged with reciprocal rank fusion,
+    with real-time search from Tavily. All stages run concurrently, each with its own deadline.
+    In "fallback" mode Tavily is only called when the local results are weak.
+
+    The candidates from every source are re-ranked on one relevance scale and only the best top_k
+    are returned, best first, with a {retrieval source: status} dict saying which sources contributed.
+    started (time.monotonic()) is when retrieval began, if the question was embedded before calling this,
+    so the knowledge base deadline includes the embedding.
+    """
+    # Search only the partitions of the index for the user-selected sources, so we always get faiss_top_k hits
+    categories = selected_categories(include_infopedia, include_textbooks, include_roots)
+    executor = get_retrieval_executor()
+    start = started if started is not None else time.monotonic()
+    keyword_future = submit_in_context(executor, keyword_search, vector_store, query, categories, faiss_top_k)
+    # Keyword search does not need the embedding, so its deadline runs from when it starts
+    keyword_deadline = time.monotonic() + FAISS_TIMEOUT_S
+    tavily_future = submit_tavily_search(query, tavily_top_k) if TAVILY_MODE == "always" else None
+    tavily_deadline = start + TAVILY_TIMEOUT_S
+    tavily_wanted = TAVILY_MODE == "always"
+
+    embedding_status = "embedded"
+    if query_vector is None:
+        # Used by both the FAISS search and the re-ranking
+        query_vector, embedding_status = embed_query_by(vector_store, query, start + FAISS_TIMEOUT_S)
+    if query_vector is not None:
+        faiss_future = submit_in_context(
+            executor, faiss_search, vector_store, query, categories, faiss_top_k, query_vector
+        )
+        faiss_hits, faiss_status = collect_result(faiss_future, start + FAISS_TIMEOUT_S)
+    else:
+        # Without the question's embedding there is nothing to search FAISS with
+        faiss_hits, faiss_status = [], embedding_status
+    keyword_hits, keyword_status = collect_result(keyword_future, keyword_deadline)
+
+    # Merge the dense and keyword rankings into the local candidate pool
+    local_results = reciprocal_rank_fusion(
+        [[doc for doc, _, _ in faiss_hits], [doc for doc, _ in keyword_hits]], k=faiss_top_k
+    )
+
+    best_similarity = max((distance_to_similarity(distance) for _, distance, _ in faiss_hits), default=0.0)
+    local_results_weak = best_similarity < LOCAL_MIN_SIMILARITY or len(local_results) < 3
+    if TAVILY_MODE == "fallback" and local_results_weak:
+        tavily_future = submit_tavily_search(query, tavily_top_k)
+        tavily_deadline = time.monotonic() + TAVILY_TIMEOUT_S
+        tavily_wanted = True
+
+    if tavily_future is not None:
+        tavily_docs, tavily_status = collect_result(tavily_future, tavily_deadline)
+    elif tavily_wanted:
+        tavily_docs, tavily_status = [], "skipped (busy)"
+    else:
+        tavily_docs, tavily_status = [], "not needed" if TAVILY_MODE == "fallback" else "off"
+
+    # Put every source's scores on one 0-1 scale, then re-rank the whole pool against the query
+    candidates = local_results + tavily_docs
+    scores = retrieval_scores([(doc, distance) for doc, distance, _ in faiss_hits], keyword_hits, tavily_docs)
+    with stage("rerank"):
+        results, rerank_method = rerank_results(vector_store, query_vector, candidates, scores, faiss_hits, top_k)
+
+    retrieval_status = {
+        "Knowledge base": faiss_status,
+        "Keyword search": keyword_status,
+        "Web search (Tavily)": tavily_status
+    }
+    current_trace().set(
+        retrieval=retrieval_status, faiss_hits=len(faiss_hits), keyword_hits=len(keyword_hits),
+        fused_local_results=len(local_results), tavily_results=len(tavily_docs), candidates=len(candidates),
+        rerank=rerank_method, documents=len(results)
+    )
+    return results, retrieval_status
+
+
+def sources_table(docs):
+    """Rows of the Referenced Sources table; also what the source evaluation is based on."""
+    sources_data = []
+    for doc in docs:
+        source_info = {
+            "Title": doc.metadata.get("title", "Unknown"),
+            "Source": doc.metadata.get("source", "Unknown"),
+            "Page": doc.metadata.get("page", "N/A"),  # Include Page Number
+            "Page Content": doc.page_content[:300] + "...",
+            "URL": doc.metadata.get("url","N/A")
+        }
+        sources_data.append(source_info)
+    return sources_data
+
+
+def format_context(docs):
+    """Formats the retrieved documents into the context section of the answer prompt, within the token budget."""
+    context, stats = pack_context(docs)
+    current_trace().set(**stats)
+    return context
+
+
+def answer_chain():
+    """The answer prompt piped into the chat model; takes {"context", "question"}."""
+    return (
+        RunnableLambda(lambda x: {"context": x["context"], "question": x["question"]})
+        | ANSWER_QUESTION_PROMPT
+        | get_chat_model()
+    )
+
+
+def submit_evaluation(docs):
+    """Starts the source evaluation in the background. Returns a future resolving to the evaluation text.
+
+    The current trace is only finished once the evaluation is done too.
+    """
+    trace = current_trace()
+    trace.hold()
+    future = submit_in_context(
+        get_llm_executor(), evaluate_sources_cached, sources_table(docs), get_source_evaluation_cache(), get_chat_model()
+    )
+    future.add_done_callback(lambda _: trace.release())
+    return future
+
+
+def stream_answer_hybrid_search(vector_store, input_question, include_infopedia, include_textbooks, include_roots,
+                                query_vector=None):
+    """
+    Retrieves sources and streams the gpt-4o answer. The source evaluation only depends on the
+    retrieved documents, so it starts as soon as retrieval finishes and runs alongside generation.
+
+    Yields (event, value) pairs:
+    - ("evaluation", future) once retrieval is done, resolving to the source evaluation text
+    - ("token", answer so far) as each chunk of the answer arrives
+    - ("retry", None) when the partial answer is malformed and generation restarts
+    - ("done", response) once, with the final response dict
+
+    query_vector can be passed in when the question was already embedded (e.g. in a batch).
+    """
+    filters = selected_categories(include_infopedia, include_textbooks, include_roots)
+    trace = start_trace("answer", filters=sorted(filters), question_chars=len(input_question))
+    try:
+        yield from _stream_answer(trace, vector_store, input_question, filters, include_infopedia, include_textbooks,
+                                  include_roots, query_vector)
+    finally:
+        # Finishes the trace unless the source evaluation is still running (it releases the trace itself)
+        finish_trace(trace)
+
+
+def _stream_answer(trace, vector_store, input_question, filters, include_infopedia, include_textbooks, include_roots,
+                   query_vector):
+    # Serve repeated and near-identical questions from the cache, skipping retrieval and the LLM
+    answer_cache = get_answer_cache()
+    with trace.stage("cache lookup"):
+        cached_response = answer_cache.get(input_question, filters)
+    retrieval_start = time.monotonic()
+    if cached_response is None:
+        if query_vector is None:
+            # Counts toward the knowledge base deadline; if it misses it, retrieval goes ahead without FAISS
+            query_vector, _ = embed_query_by(vector_store, input_question, retrieval_start + FAISS_TIMEOUT_S)
+        if query_vector is not None:
+            with trace.stage("cache lookup"):
+                cached_response = answer_cache.get_similar(input_question, query_vector, filters)
+    trace.set(answer_cache="miss" if cached_response is None else "hit")
+    if cached_response is not None:
+        trace.set(outcome="cached")
+        if cached_response.get("evaluation") is None and cached_response.get("context"):
+            # Cached before its evaluation finished; per-source verdicts are cached, so this is usually cheap
+            yield "evaluation", submit_evaluation(cached_response["context"])
+        yield "done", {**cached_response, "cached": True}
+        return
+
+    with trace.stage("retrieval"):
+        retrieved_docs, retrieval_status = hybrid_search(
+            vector_store, input_question, include_infopedia, include_textbooks, include_roots,
+            query_vector=query_vector, started=retrieval_start
+        )
+
+    if not retrieved_docs:
+        trace.set(outcome="no sources")
+        yield "done", {"answer": "No relevant sources found based on your filters.", "context": [], "retrieval": retrieval_status}
+        return
+
+    evaluation_future = submit_evaluation(retrieved_docs)
+    yield "evaluation", evaluation_future
+
+    with trace.stage("format context"):
+        formatted_context = format_context(retrieved_docs)
+    rag_chain = answer_chain()
+    prompt_tokens = count_tokens(ANSWER_QUESTION_PROMPT.format(context=formatted_context, question=input_question))
+
+    for attempt in range(MAX_ANSWER_ATTEMPTS):
+        answer = ""
+        malformed = False
+        generation_start = time.perf_counter()
+        # Time spent in the caller between tokens (e.g. rendering) is not generation time
+        paused = 0.0
+        with upstream_slot("openai"):
+            for chunk in rag_chain.stream({"context": formatted_context, "question": input_question}):
+                if not answer and attempt == 0:
+                    trace.record_stage("first token", (time.perf_counter() - generation_start) * 1000)
+                answer += chunk.content
+                if not validate_partial_answer_format(answer):
+                    # Stop paying for a generation that will fail validation anyway
+                    malformed = True
+                    break
+                pause_start = time.perf_counter()
+                yield "token", answer
+                paused += time.perf_counter() - pause_start
+        trace.record_stage("generation", (time.perf_counter() - generation_start - paused) * 1000)
+        trace.add_tokens("gpt-4o", prompt_tokens, count_tokens(answer))
+
+        with trace.stage("validation"):
+            valid = not malformed and validate_answer_format(answer)
+        if valid:
+            response = {"answer": answer, "context": retrieved_docs, "retrieval": retrieval_status}
+            if retrieval_degraded(retrieval_status):
+                # Built from partial results; the next asker should get a fresh retrieval, not this answer
+                trace.set(answer_cache_skipped="degraded retrieval")
+            else:
+                answer_cache.put(input_question, filters, response, query_vector)
+                # Cache the evaluation with the answer once it is ready, so cache hits skip it as well
+                evaluation_future.add_done_callback(
+                    lambda future: future.exception() is None and answer_cache.put(
+                        input_question, filters, {**response, "evaluation": future.result()}, query_vector
+                    )
+                )
+            trace.set(outcome="answered")
+            yield "done", response
+            return
+        trace.increment("validation_failures")
+        if attempt + 1 < MAX_ANSWER_ATTEMPTS:
+            yield "retry", None
+
+    trace.set(outcome="validation failed")
+    yield "done", {"answer": "Validation failed. Please try again.", "context": [], "retrieval": retrieval_status,
+                   "validation_failed": True}
+
+
+def answer_question_hybrid_search(vector_store, input_question, include_infopedia, include_textbooks, include_roots,
+                                  query_vector=None, with_evaluation=False):
+    """Answers a question without streaming. with_evaluation waits for the source evaluation and adds it to the response."""
+    evaluation_future = None
+    for event, value in stream_answer_hybrid_search(
+        vector_store, input_question, include_infopedia, include_textbooks, include_roots, query_vector=query_vector
+    ):
+        if event == "evaluation":
+            evaluation_future = value
+        elif event == "done":
+            if with_evaluation and value["context"]:
+                value = {**value}
+                wait_for_evaluation(value, evaluation_future)
+            return value
+
+
+def wait_for_evaluation(response, evaluation_future):
+    """Returns the source evaluation for a response, waiting for the background evaluation if needed.
+    If it failed, the response is marked with evaluation_failed and the evaluation says why."""
+    if response.get("evaluation") is None and evaluation_future is not None:
+        try:
+            response["evaluation"] = evaluation_future.result()
+        except Exception as e:
+            response["evaluation"] = f"Source evaluation failed: {e}"
+            response["evaluation_failed"] = True
+    return response.get("evaluation")
@@ -0,0 +1,103 @@
+# filename: rerank_util.py
+import os
+
+import numpy as np
+from langchain.schema import Document
+
+from util.retrieval_util import document_key
+
+# """
+# Relevance scoring and re-ranking of retrieved candidates.
+# FAISS, BM25 and Tavily each score on their own scale (L2 distance, unbounded BM25,
+# Tavily's 0-1 relevance), so a merged list cannot be sorted by their raw scores.
+# Each candidate first gets a 0-1 retrieval score: cosine similarity for FAISS hits,
+# Tavily's own score for web results and a fixed saturating transform of BM25 for
+# keyword hits (so a weak best keyword match stays weak). Its relevance blends that
+# score with the cosine similarity of its embedding to the query embedding, so a
+# keyword hit the dense search missed is not judged by the embedding alone, and the
+# final few are picked with maximal marginal relevance so near-identical passages
+# don't crowd out other sources.
+# """
+
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "30"))
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "8"))
+# 1.0 ranks by relevance alone; lower values favour candidates unlike the ones already picked
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.5"))
+# Share of a candidate's relevance that comes from its retrieval score; the rest is embedding similarity
+RERANK_RETRIEVAL_WEIGHT = float(os.getenv("RERANK_RETRIEVAL_WEIGHT", "0.5"))
+# BM25 score that maps to a retrieval score of 0.5. On this corpus the best keyword hit for an on-topic
+# question scores about 15-30 and for an off-topic one about 10
+BM25_HALF_SCORE = float(os.getenv("BM25_HALF_SCORE", "12"))
+
+
+def distance_to_similarity(distance):
+    """Embeddings are unit length, so FAISS's squared L2 distance d corresponds to cosine similarity 1 - d / 2."""
+    return 1 - distance / 2
+
+
+def bm25_to_similarity(score):
+    """Maps a BM25 score (0 to unbounded) to 0-1 with the same curve for every query, 0.5 at BM25_HALF_SCORE."""
+    score = max(float(score), 0.0)
+    return score / (score + BM25_HALF_SCORE)
+
+
+def retrieval_scores(faiss_hits, keyword_hits, web_docs):
+    """Puts every retriever's scores on a 0-1 scale. Returns {document key: best score across retrievers}."""
+    scores = {}
+
+    def add(doc, score):
+        key = document_key(doc)
+        scores[key] = max(scores.get(key, 0.0), float(score))
+
+    for doc, distance in faiss_hits:
+        add(doc, distance_to_similarity(distance))
+    for doc, score in keyword_hits:
+        add(doc, bm25_to_similarity(score))
+    for doc in web_docs:
+        add(doc, doc.metadata.get("score", 0.0))
+    return scores
+
+
+def with_score(doc, score):
+    """A copy of doc with its relevance in metadata["score"] (docstore documents can be shared between requests)."""
+    return Document(page_content=doc.page_content, metadata={**doc.metadata, "score": round(float(score), 4)})
+
+
+def cosine_similarities(query_vector, vectors):
+    """Cosine similarity of each row of vectors to query_vector."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    query = np.asarray(query_vector, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+    return vectors @ query / np.maximum(norms, 1e-12)
+
+
+def mmr_select(relevance, vectors, k, lambda_mult=MMR_LAMBDA):
+    """Greedy maximal marginal relevance. Returns the indices of up to k candidates, in the order picked."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    relevance = np.asarray(relevance, dtype=np.float64)
+    # Highest similarity of each candidate to anything picked so far
+    redundancy = np.zeros(len(relevance))
+    available = np.ones(len(relevance), dtype=bool)
+    picked = []
+    for _ in range(min(k, len(relevance))):
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, vectors @ vectors[best])
+    return picked
+
+
+def rerank(query_vector, candidates, vectors, retrieval, k=RERANK_TOP_K, lambda_mult=MMR_LAMBDA,
+           retrieval_weight=RERANK_RETRIEVAL_WEIGHT):
+    """Re-scores candidates by their retrieval score blended with embedding similarity and picks k with MMR.
+
+    retrieval holds each candidate's 0-1 retrieval score (see retrieval_scores).
+    Returns copies of the picked documents, best first, with their blended relevance as metadata["score"].
+    """
+    if not candidates:
+        return []
+    relevance = (retrieval_weight * np.asarray(retrieval, dtype=np.float64)
+                 + (1 - retrieval_weight) * cosine_similarities(query_vector, vectors))
+    return [with_score(candidates[i], relevance[i]) for i in mmr_select(relevance, vectors, k, lambda_mult)]
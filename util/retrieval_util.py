@@ -0,0 +1,170 @@
+# filename: retrieval_util.py
+import threading
+
+import faiss
+import numpy as np
+
+# """
+# Source-partitioned retrieval.
+# Every vector carries a source category (Infopedia, textbooks or Roots). A bitmap of
+# the vectors in each allowed combination of categories is built once per vector
+# store, and FAISS searches only inside it, so filtered queries still return k hits.
+# """
+
+SOURCE_CATEGORIES = ("infopedia", "textbooks", "roots")
+
+
+def source_category(source):
+    """Maps a document's source metadata to one of SOURCE_CATEGORIES, or None if it matches none."""
+    source = str(source or "").lower().strip()
+    if "infopedia" in source:
+        return "infopedia"
+    if "sec1" in source or "sec2" in source or "textbook" in source:
+        return "textbooks"
+    if "roots website" in source:
+        return "roots"
+    return None
+
+
+def document_categories(metadata):
+    """The categories a chunk is searchable under: its own, plus those of near-duplicate copies merged into it."""
+    categories = {metadata.get("source_category") or source_category(metadata.get("source"))}
+    categories.update(metadata.get("duplicate_categories") or ())
+    categories.discard(None)
+    return categories
+
+
+def selected_categories(include_infopedia, include_textbooks, include_roots):
+    """Returns the set of source categories ticked in the UI filters."""
+    flags = (include_infopedia, include_textbooks, include_roots)
+    return frozenset(category for category, include in zip(SOURCE_CATEGORIES, flags) if include)
+
+
+_partition_lock = threading.Lock()
+
+
+def category_positions(vector_store):
+    """Returns {category: array of FAISS positions}, computed once per vector store."""
+    positions = getattr(vector_store, "_category_positions", None)
+    if positions is not None:
+        return positions
+    with _partition_lock:
+        positions = getattr(vector_store, "_category_positions", None)
+        if positions is None:
+            if hasattr(vector_store.docstore, "category_positions"):
+                # The SQLite docstore can answer this with one query instead of reading every document
+                stored = vector_store.docstore.category_positions()
+                grouped = {category: stored.get(category, []) for category in SOURCE_CATEGORIES}
+            else:
+                grouped = {category: [] for category in SOURCE_CATEGORIES}
+                for position, doc_id in vector_store.index_to_docstore_id.items():
+                    for category in document_categories(vector_store.docstore.search(doc_id).metadata):
+                        if category in grouped:
+                            grouped[category].append(position)
+            positions = {category: np.asarray(ids, dtype=np.int64) for category, ids in grouped.items()}
+            vector_store._category_positions = positions
+            vector_store._category_bitmaps = {}
+    return positions
+
+
+def category_bitmap(vector_store, categories):
+    """Returns a packed bitmap of the vectors in the given categories, or None if every vector is allowed."""
+    positions = category_positions(vector_store)
+    bitmaps = vector_store._category_bitmaps
+    if categories not in bitmaps:
+        allowed = np.zeros(vector_store.index.ntotal, dtype=bool)
+        for category in categories:
+            allowed[positions[category]] = True
+        bitmaps[categories] = None if allowed.all() else np.packbits(allowed, bitorder="little")
+    return bitmaps[categories]
+
+
+def search_parameters(index, selector):
+    """Builds the FAISS search parameters for the index type, restricted to the selector."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def partitioned_search(vector_store, query, categories, k=10, query_vector=None, with_positions=False):
+    """Searches only the vectors whose source category is in categories.
+
+    Pass query_vector to reuse an embedding of the query that was already computed.
+    Returns up to k (Document, L2 distance) pairs, nearest first, or (Document, L2 distance,
+    FAISS position) triples with with_positions.
+    """
+    if not categories:
+        return []
+
+    if query_vector is None:
+        query_vector = vector_store._embed_query(query)
+    vector = np.array([query_vector], dtype=np.float32)
+    if vector_store._normalize_L2:
+        faiss.normalize_L2(vector)
+
+    bitmap = category_bitmap(vector_store, frozenset(categories))
+    if bitmap is None:
+        scores, indices = vector_store.index.search(vector, k)
+    else:
+        selector = faiss.IDSelectorBitmap(vector_store.index.ntotal, faiss.swig_ptr(bitmap))
+        scores, indices = vector_store.index.search(
+            vector, k, params=search_parameters(vector_store.index, selector)
+        )
+
+    results = []
+    for score, position in zip(scores[0], indices[0]):
+        if position == -1:
+            # This happens when the allowed partitions hold fewer than k vectors
+            continue
+        doc = vector_store.docstore.search(vector_store.index_to_docstore_id[position])
+        results.append((doc, float(score), int(position)) if with_positions else (doc, float(score)))
+    return results
+
+
+def stored_vectors(index, positions):
+    """Reads the stored vectors at the given FAISS positions, or returns None if the index cannot reconstruct them.
+
+    Exact for flat and HNSW indexes, approximate for compressed (PQ/SQ) ones.
+    """
+    if not positions:
+        return np.zeros((0, index.d), dtype=np.float32)
+    try:
+        return index.reconstruct_batch(np.asarray(positions, dtype=np.int64))
+    except RuntimeError:
+        pass
+    try:
+        # IVF indexes need a direct map from position to inverted list entry first
+        with _partition_lock:
+            faiss.extract_index_ivf(index).make_direct_map()
+        return index.reconstruct_batch(np.asarray(positions, dtype=np.int64))
+    except RuntimeError:
+        return None
+
+
+def lexical_search(vector_store, query, categories, k=10):
+    """BM25 keyword search over the vector store's chunks. Returns up to k (Document, BM25 score) pairs."""
+    lexical_index = getattr(vector_store, "lexical_index", None)
+    if lexical_index is None:
+        return []
+    return [(vector_store.docstore.search(doc_id), score) for doc_id, score in lexical_index.search(query, categories, k)]
+
+
+def document_key(doc):
+    """Identifies the same chunk across result lists."""
+    return doc.metadata.get("source"), doc.metadata.get("chunk_index"), doc.page_content
+
+
+def reciprocal_rank_fusion(result_lists, k=10, rank_constant=60):
+    """Merges ranked lists of documents, scoring each by the sum of 1 / (rank_constant + rank)."""
+    scores = {}
+    docs = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results, start=1):
+            key = document_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rank_constant + rank)
+            docs.setdefault(key, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [docs[key] for key in ranked[:k]]
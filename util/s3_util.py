@@ -0,0 +1,317 @@
+# filename: s3_util.py
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, so old versions are never deleted
+    fcntl = None
+
+# """
+# Versioned S3 fetch of the vector store.
+# Each upload goes to its own prefix, versions/<version>/, named after the files'
+# checksums, and only when every file is there is one pointer object (LATEST.json)
+# rewritten listing the version, each file's key, size, SHA-256 and S3 version ID.
+# Readers only ever go through that pointer, so a poll during an upload sees either
+# the whole old version or the whole new one. A new version is downloaded with
+# parallel ranged GETs into a staging directory, checked against the pointer's sizes
+# and checksums, optionally validated by the caller, and only then made current by
+# atomically rewriting a local pointer file, so a crash mid-download never leaves a
+# half-written index in use.
+# Worker processes on one host share the local versions; each holds a shared lock on
+# the version it serves, and a version is only deleted once no process holds one.
+# Buckets published before LATEST.json existed (index.faiss and index.pkl at the prefix
+# root) are still read: their manifest is built from the objects' sizes and ETags.
+# """
+
+REQUIRED_FILES = ("index.faiss",)
+# A version needs one of these: builds write docstore.sqlite, older builds wrote index.pkl
+DOCSTORE_FILES = ("docstore.sqlite", "index.pkl")
+OPTIONAL_FILES = DOCSTORE_FILES + ("lexical.sqlite",)
+MANIFEST_KEY = "LATEST.json"
+CURRENT_POINTER = "CURRENT"
+CHECKSUM_METADATA_KEY = "sha256"
+
+
+def file_sha256(path):
+    return _file_digest(path, hashlib.sha256())
+
+
+def _file_digest(path, digest):
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def missing_files(names):
+    """The required index files (or the docstore) missing from names."""
+    missing = [name for name in REQUIRED_FILES if name not in names]
+    if not any(name in names for name in DOCSTORE_FILES):
+        missing.append(" or ".join(DOCSTORE_FILES))
+    return missing
+
+
+def make_s3_client(endpoint_url=None):
+    """Creates an S3 client; endpoint_url points it at a local stand-in such as MinIO or moto."""
+    return boto3.client("s3", endpoint_url=endpoint_url or os.getenv("S3_ENDPOINT_URL") or None)
+
+
+def upload_index(folder_path, bucket, prefix="", client=None):
+    """Uploads the index files under a new version prefix, then points LATEST.json at them. Returns the version."""
+    client = client or make_s3_client()
+    checksums = {
+        name: file_sha256(os.path.join(folder_path, name))
+        for name in REQUIRED_FILES + OPTIONAL_FILES if os.path.exists(os.path.join(folder_path, name))
+    }
+    missing = missing_files(checksums)
+    if missing:
+        raise FileNotFoundError(f"{folder_path} has no {', '.join(missing)}")
+    # Named after the contents, so uploading the same build twice publishes the same version
+    version = hashlib.sha256(
+        "\n".join(f"{name}={sha256}" for name, sha256 in sorted(checksums.items())).encode("utf-8")
+    ).hexdigest()[:16]
+
+    files = {}
+    for name, sha256 in checksums.items():
+        path = os.path.join(folder_path, name)
+        key = f"{prefix}versions/{version}/{name}"
+        client.upload_file(path, bucket, key, ExtraArgs={"Metadata": {CHECKSUM_METADATA_KEY: sha256}})
+        head = client.head_object(Bucket=bucket, Key=key)
+        files[name] = {"key": key, "size": os.path.getsize(path), "sha256": sha256, "version_id": head.get("VersionId")}
+
+    # Written last: until now readers still see the previous version in full
+    manifest = {"version": version, "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "files": files}
+    client.put_object(Bucket=bucket, Key=f"{prefix}{MANIFEST_KEY}", Body=json.dumps(manifest, indent=2).encode("utf-8"),
+                      ContentType="application/json")
+    return version
+
+
+class VersionLease:
+    """A shared lock on a local version, held while a process serves it so other processes don't delete it."""
+
+    def __init__(self, lock_path):
+        self.file = open(lock_path, "a+")
+        if fcntl:
+            fcntl.flock(self.file, fcntl.LOCK_SH)
+
+    def release(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class S3IndexFetcher:
+    """Downloads new versions of the index from S3 and swaps them in atomically."""
+
+    def __init__(self, bucket, local_root="nhb_vectorstore", prefix="", client=None,
+                 max_concurrency=8, chunk_size=8 * 1024 * 1024):
+        self.bucket = bucket
+        self.local_root = local_root
+        self.prefix = prefix
+        self.client = client or make_s3_client()
+        self.transfer_config = TransferConfig(
+            multipart_threshold=chunk_size, multipart_chunksize=chunk_size, max_concurrency=max_concurrency
+        )
+        self._poller = None
+        # Versions whose prepare step failed in this process; they are not downloaded again
+        self._rejected = set()
+
+    def remote_manifest(self):
+        """Returns the published version's manifest: {"version", "created", "files": {name: {...}}}."""
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=f"{self.prefix}{MANIFEST_KEY}")["Body"].read()
+        except self.client.exceptions.NoSuchKey:
+            return self._legacy_manifest()
+        manifest = json.loads(body)
+        missing = missing_files(manifest["files"])
+        if missing:
+            raise IOError(f"the published manifest lists no {', '.join(missing)}")
+        return manifest
+
+    def _legacy_manifest(self):
+        """Builds a manifest for index files kept at the prefix root, the layout used before LATEST.json."""
+        files = {}
+        for name in REQUIRED_FILES + OPTIONAL_FILES:
+            key = f"{self.prefix}{name}"
+            try:
+                head = self.client.head_object(Bucket=self.bucket, Key=key)
+            except self.client.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] not in ("404", "NoSuchKey") or name in REQUIRED_FILES:
+                    raise
+                continue
+            files[name] = {
+                "key": key,
+                "size": head["ContentLength"],
+                # Set by upload_index before versioned prefixes; older uploads are checked by ETag instead
+                "sha256": head.get("Metadata", {}).get(CHECKSUM_METADATA_KEY),
+                "etag": head["ETag"].strip('"'),
+                "version_id": head.get("VersionId"),
+            }
+        missing = missing_files(files)
+        if missing:
+            raise IOError(f"s3://{self.bucket}/{self.prefix} has no LATEST.json and no {', '.join(missing)}")
+        # The ETags change whenever a file is replaced, so they name the version
+        version = "legacy-" + hashlib.sha256(
+            "\n".join(f"{name}={entry['etag']}" for name, entry in sorted(files.items())).encode("utf-8")
+        ).hexdigest()[:16]
+        return {"version": version, "created": None, "files": files}
+
+    def current_version(self):
+        pointer = os.path.join(self.local_root, CURRENT_POINTER)
+        if not os.path.exists(pointer):
+            return None
+        with open(pointer, "r", encoding="utf-8") as f:
+            version = f.read().strip()
+        return version if os.path.isdir(self.version_path(version)) else None
+
+    def version_path(self, version):
+        return os.path.join(self.local_root, "versions", version)
+
+    def _lock_path(self, version):
+        locks_dir = os.path.join(self.local_root, "locks")
+        os.makedirs(locks_dir, exist_ok=True)
+        return os.path.join(locks_dir, f"{version}.lock")
+
+    def lease(self, version):
+        """Marks a local version as in use by this process until the lease is released (or the process exits)."""
+        lease = VersionLease(self._lock_path(version))
+        if not os.path.isdir(self.version_path(version)):
+            lease.release()
+            raise FileNotFoundError(f"version {version} is no longer on disk")
+        return lease
+
+    def _download(self, name, entry, staging):
+        path = os.path.join(staging, name)
+        extra_args = {"VersionId": entry["version_id"]} if entry.get("version_id") else None
+        # download_file splits large objects into ranged GETs run in parallel
+        self.client.download_file(self.bucket, entry["key"], path, ExtraArgs=extra_args, Config=self.transfer_config)
+        self._verify(path, entry)
+
+    @staticmethod
+    def _verify(path, entry):
+        if os.path.getsize(path) != entry["size"]:
+            raise IOError(f"{path}: size {os.path.getsize(path)} does not match the manifest ({entry['size']})")
+        if entry.get("sha256"):
+            if file_sha256(path) != entry["sha256"]:
+                raise IOError(f"{path}: SHA-256 does not match the manifest")
+        elif "-" not in entry["etag"]:
+            # A single-part upload's ETag is the MD5 of its contents (a multipart one is not, so only the size is checked)
+            if _file_digest(path, hashlib.md5()) != entry["etag"]:
+                raise IOError(f"{path}: MD5 does not match the object's ETag")
+
+    def fetch(self, prepare=None):
+        """Makes the latest published version current locally.
+
+        prepare(path), if given, is called on a newly downloaded version before it is made current
+        (e.g. to load and validate it); if it raises, the version is discarded and the current one kept.
+        Returns (path, True if a new version was installed, what prepare returned or None).
+        """
+        manifest = self.remote_manifest()
+        version = manifest["version"]
+        if self.current_version() == version:
+            return self.version_path(version), False, None
+        if version in self._rejected:
+            current = self.current_version()
+            if current is None:
+                raise IOError(f"version {version} failed validation and there is no earlier version")
+            # Already reported when it failed; keep serving the current version until a new one is published
+            return self.version_path(current), False, None
+
+        final_path = self.version_path(version)
+        if not os.path.isdir(final_path):
+            self._install(version, manifest["files"])
+        # Held while preparing, so another process's clean-up can't delete the version under us
+        lease = self.lease(version)
+        try:
+            prepared = prepare(final_path) if prepare else None
+        except Exception:
+            self._rejected.add(version)
+            lease.release()
+            # Never made current, so no other process serves it
+            self._remove_version(version)
+            raise
+        lease.release()
+
+        previous = self.current_version()
+        self._set_current(version)
+        self._remove_old_versions(keep={version, previous})
+        return final_path, True, prepared
+
+    def _install(self, version, files):
+        """Downloads and verifies a version in a staging directory, then moves it into versions/."""
+        staging = os.path.join(self.local_root, f"staging-{version}-{os.getpid()}")
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        try:
+            # Files download side by side, and each large file is itself split into parallel ranged GETs
+            with ThreadPoolExecutor(max_workers=len(files)) as executor:
+                futures = [executor.submit(self._download, name, entry, staging) for name, entry in files.items()]
+                for future in futures:
+                    future.result()
+
+            final_path = self.version_path(version)
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            try:
+                os.rename(staging, final_path)
+            except OSError:
+                # Another process on this host installed the same version first
+                if not os.path.isdir(final_path):
+                    raise
+                shutil.rmtree(staging)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    def _set_current(self, version):
+        pointer = os.path.join(self.local_root, CURRENT_POINTER)
+        tmp_pointer = f"{pointer}.{os.getpid()}.tmp"
+        with open(tmp_pointer, "w", encoding="utf-8") as f:
+            f.write(version)
+        # os.replace is atomic, so readers see either the old version or the new one
+        os.replace(tmp_pointer, pointer)
+
+    def _remove_old_versions(self, keep):
+        """Deletes versions no process on this host is serving, besides the ones in keep."""
+        versions_dir = os.path.join(self.local_root, "versions")
+        for entry in os.scandir(versions_dir):
+            if entry.is_dir() and entry.name not in keep:
+                self._remove_version(entry.name)
+
+    def _remove_version(self, version):
+        """Deletes a local version unless a process holds a lease on it (never, without advisory locks)."""
+        if fcntl is None:
+            return
+        with open(self._lock_path(version), "a+") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            shutil.rmtree(self.version_path(version), ignore_errors=True)
+            os.remove(lock.name)
+
+    def start_polling(self, interval_seconds, on_new_version, prepare=None):
+        """Checks S3 for a new version every interval_seconds, calling on_new_version(path, prepared) after
+        installing it (see fetch for prepare)."""
+        if self._poller is not None:
+            return
+
+        def poll():
+            while True:
+                time.sleep(interval_seconds)
+                try:
+                    path, is_new, prepared = self.fetch(prepare)
+                    if is_new:
+                        on_new_version(path, prepared)
+                except Exception as e:
+                    print(f"Vector store update check failed: {e}")
+
+        self._poller = threading.Thread(target=poll, name="s3-index-poller", daemon=True)
+        self._poller.start()
@@ -0,0 +1,208 @@
+# filename: service_util.py
+import asyncio
+import json
+import threading
+from concurrent.futures import Future
+
+import httpx
+from langchain.schema import Document
+
+from util.rag_util import stream_answer_hybrid_search, wait_for_evaluation
+
+# """
+# Pieces of the answer service (rag_service.py) and its client.
+# The service runs each pipeline request once and fans its events out to every
+# HTTP request asking the same question with the same filters while it is in
+# flight, so a class typing the teacher's prompt together costs one Tavily search
+# and one gpt-4o answer. Events go over the wire as JSON lines; the client turns
+# them back into the (event, value) pairs of rag_util.stream_answer_hybrid_search,
+# so the Streamlit page renders a remote answer exactly like a local one.
+# """
+
+
+class SharedStream:
+    """The events of one pipeline run, replayed from the start to every request that subscribes to it."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.events = []
+        self.finished = False
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+
+    def publish(self, event):
+        """Adds an event; safe to call from the worker thread running the pipeline."""
+        self.loop.call_soon_threadsafe(self._append, event)
+
+    def finish(self):
+        self.loop.call_soon_threadsafe(self._append, None)
+
+    def _append(self, event):
+        if event is None:
+            self.finished = True
+        else:
+            self.events.append(event)
+        # Wake every waiting subscriber; later waits use a fresh event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self):
+        self.subscribers += 1
+        position = 0
+        while True:
+            while position < len(self.events):
+                yield self.events[position]
+                position += 1
+            if self.finished:
+                return
+            await self._changed.wait()
+
+
+class RequestCoalescer:
+    """Shares one in-flight pipeline run between all requests with the same key."""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.in_flight = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def join(self, key, produce, *args):
+        """Returns the stream for key, starting produce(stream, *args) on the executor if none is in flight."""
+        stream = self.in_flight.get(key)
+        if stream is not None:
+            self.coalesced += 1
+            return stream
+        loop = asyncio.get_running_loop()
+        stream = SharedStream(loop)
+        self.in_flight[key] = stream
+        self.started += 1
+        future = loop.run_in_executor(self.executor, produce, stream, *args)
+        # Later requests start a new run (and will usually hit the answer cache)
+        future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return stream
+
+
+def serialize_response(response):
+    """The JSON form of a pipeline response; documents become {"page_content", "metadata"}."""
+    return {
+        **response,
+        "context": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in response["context"]],
+    }
+
+
+def deserialize_response(data):
+    return {**data, "context": [Document(**doc) for doc in data["context"]]}
+
+
+def run_pipeline(stream, vector_store, question, include_infopedia, include_textbooks, include_roots):
+    """Runs the answer pipeline in a worker thread, publishing its events as JSON-ready dicts.
+
+    Tokens are sent as the text added since the previous token. The source evaluation is
+    published as soon as it is ready, which may be after "done".
+    """
+    evaluation_future = None
+    evaluation_sent = False
+    answer = ""
+    try:
+        for event, value in stream_answer_hybrid_search(
+            vector_store, question, include_infopedia, include_textbooks, include_roots
+        ):
+            if event == "evaluation":
+                evaluation_future = value
+                stream.publish({"event": "evaluation_pending"})
+            elif event == "token":
+                stream.publish({"event": "token", "text": value[len(answer):]})
+                answer = value
+            elif event == "retry":
+                answer = ""
+                stream.publish({"event": "retry"})
+            elif event == "done":
+                stream.publish({"event": "done", "response": serialize_response(value)})
+            if evaluation_future is not None and evaluation_future.done() and not evaluation_sent:
+                stream.publish({"event": "evaluation", "text": wait_for_evaluation({}, evaluation_future)})
+                evaluation_sent = True
+        if evaluation_future is not None and not evaluation_sent:
+            stream.publish({"event": "evaluation", "text": wait_for_evaluation({}, evaluation_future)})
+    except Exception as e:
+        stream.publish({"event": "error", "message": f"{type(e).__name__}: {e}"})
+    finally:
+        stream.finish()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_service_client():
+    """One pooled HTTP client per process for calls to the answer service."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(timeout=httpx.Timeout(120.0, connect=5.0))
+        return _client
+
+
+def _finish_evaluation(response, lines, evaluation_future):
+    """Reads the rest of the stream after "done" until the source evaluation arrives."""
+    try:
+        for line in lines:
+            event = json.loads(line) if line.strip() else {}
+            if event.get("event") == "evaluation":
+                evaluation_future.set_result(event["text"])
+                return
+    finally:
+        if not evaluation_future.done():
+            evaluation_future.set_exception(RuntimeError("the answer service did not send a source evaluation"))
+        response.close()
+
+
+def stream_answer_remote(service_url, input_question, include_infopedia, include_textbooks, include_roots):
+    """Streams an answer from the answer service, yielding the same events as stream_answer_hybrid_search."""
+    client = get_service_client()
+    request = client.build_request("POST", service_url.rstrip("/") + "/answer/stream", json={
+        "question": input_question,
+        "include_infopedia": include_infopedia,
+        "include_textbooks": include_textbooks,
+        "include_roots": include_roots,
+    })
+    response = client.send(request, stream=True)
+    handed_off = False
+    try:
+        if response.status_code != 200:
+            response.read()
+            raise RuntimeError(f"Answer service error {response.status_code}: {response.text}")
+        lines = response.iter_lines()
+        evaluation_future = None
+        answer = ""
+        for line in lines:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            kind = event["event"]
+            if kind == "evaluation_pending":
+                evaluation_future = Future()
+                yield "evaluation", evaluation_future
+            elif kind == "evaluation" and evaluation_future is not None:
+                evaluation_future.set_result(event["text"])
+            elif kind == "token":
+                answer += event["text"]
+                yield "token", answer
+            elif kind == "retry":
+                answer = ""
+                yield "retry", None
+            elif kind == "error":
+                raise RuntimeError(f"Answer service error: {event['message']}")
+            elif kind == "done":
+                if evaluation_future is not None and not evaluation_future.done():
+                    # Keep reading in the background so the evaluation can still arrive
+                    threading.Thread(
+                        target=_finish_evaluation, args=(response, lines, evaluation_future), daemon=True
+                    ).start()
+                    handed_off = True
+                yield "done", deserialize_response(event["response"])
+                return
+        raise RuntimeError("The answer service closed the stream before the answer was done")
+    finally:
+        if not handed_off:
+            response.close()
@@ -0,0 +1,279 @@
+# filename: tracing_util.py
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+import tiktoken
+
+# """
+# Per-request tracing and metrics for the answer pipeline.
+# A trace records how long each stage took (FAISS, keyword search, Tavily, gpt-4o
+# generation, validation, source evaluation), how many documents each retrieval
+# returned, prompt/completion tokens with an estimated cost, and cache hits.
+# Finished traces are written as one JSON line to stdout (unless TRACE_STDOUT=0) and
+# to TRACE_LOG_PATH if set, kept in a rolling in-process window for the admin page
+# and, when METRICS_PORT is set, exported as Prometheus metrics.
+# """
+
+# USD per million tokens (input, output)
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "text-embedding-3-small": (0.02, 0.0),
+}
+
+RECENT_TRACES = deque(maxlen=int(os.getenv("TRACE_WINDOW", "1000")))
+_recent_lock = threading.Lock()
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_encoding = None
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def count_tokens(text):
+    """Counts gpt-4o tokens with tiktoken, falling back to a rough estimate when the encoding cannot be loaded offline."""
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return max(1, len(text) // 4)
+
+
+class RequestTrace:
+    """Timings and counters for one request. Finishes once every holder (e.g. a background evaluation) releases it."""
+
+    def __init__(self, name, **attributes):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.stages = {}
+        self.attributes = dict(attributes)
+        self.tokens = {}
+        self.cost_usd = 0.0
+        self.lock = threading.Lock()
+        self._holders = 1
+        self.finished = False
+        # Set by start_trace when the trace is made current
+        self.context_token = None
+
+    @contextmanager
+    def stage(self, name):
+        """Times a stage; a stage run more than once (e.g. a regenerated answer) adds up."""
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.record_stage(name, (time.perf_counter() - start) * 1000)
+
+    def record_stage(self, name, milliseconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + milliseconds
+
+    def set(self, **attributes):
+        with self.lock:
+            self.attributes.update(attributes)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.attributes[name] = self.attributes.get(name, 0) + amount
+
+    def add_tokens(self, model, prompt_tokens, completion_tokens=0):
+        input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        with self.lock:
+            counts = self.tokens.setdefault(model, {"prompt": 0, "completion": 0})
+            counts["prompt"] += prompt_tokens
+            counts["completion"] += completion_tokens
+            self.cost_usd += (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+
+    def hold(self):
+        with self.lock:
+            self._holders += 1
+
+    def release(self):
+        with self.lock:
+            self._holders -= 1
+            done = self._holders == 0 and not self.finished
+            if done:
+                self.finished = True
+        if done:
+            _emit(self)
+
+    def to_record(self):
+        with self.lock:
+            return {
+                "trace_id": self.id,
+                "name": self.name,
+                "started": self.started,
+                "duration_ms": round((time.perf_counter() - self._start) * 1000, 2),
+                "stages_ms": {name: round(value, 2) for name, value in self.stages.items()},
+                "tokens": {model: dict(counts) for model, counts in self.tokens.items()},
+                "cost_usd": round(self.cost_usd, 6),
+                **self.attributes,
+            }
+
+
+class _NullTrace:
+    """Stands in when no request is being traced, so instrumented code needs no checks."""
+
+    id = None
+
+    @contextmanager
+    def stage(self, name):
+        yield self
+
+    def record_stage(self, name, milliseconds):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+    def increment(self, name, amount=1):
+        pass
+
+    def add_tokens(self, model, prompt_tokens, completion_tokens=0):
+        pass
+
+    def hold(self):
+        pass
+
+    def release(self):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+def start_trace(name, **attributes):
+    """Starts a trace and makes it current for this thread (and work submitted with submit_in_context).
+
+    End it with finish_trace, which makes the previous trace (usually none) current again.
+    """
+    trace = RequestTrace(name, **attributes)
+    trace.context_token = _current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace):
+    """Stops trace being the current one and releases the starter's hold on it.
+
+    Work still holding the trace (e.g. a background evaluation) keeps adding to it until it releases it.
+    """
+    if trace.context_token is not None and _current_trace.get() is trace:
+        try:
+            _current_trace.reset(trace.context_token)
+        except ValueError:
+            # Finished from a different context than it was started in (e.g. a generator closed elsewhere)
+            _current_trace.set(None)
+    trace.release()
+
+
+def current_trace():
+    return _current_trace.get() or NULL_TRACE
+
+
+def stage(name):
+    """Times a stage of the current trace."""
+    return current_trace().stage(name)
+
+
+def submit_in_context(executor, fn, *args):
+    """Submits fn to a thread pool, carrying over the current trace."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def start_metrics_endpoint():
+    """Creates the Prometheus metrics and starts the scrape endpoint on METRICS_PORT, once per process.
+
+    Returns the metrics, or None if METRICS_PORT is unset or the endpoint could not be started
+    (e.g. another process on the host already has the port); that is logged once and never raises.
+    """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            try:
+                _metrics = _create_metrics(os.getenv("METRICS_PORT"))
+            except Exception as e:
+                print(f"Metrics endpoint not started, metrics are off in this process: {type(e).__name__}: {e}")
+                _metrics = False
+    return _metrics or None
+
+
+def _create_metrics(port):
+    if not port:
+        return False
+    # Imported only when metrics are on
+    import prometheus_client
+
+    # Bound before the metrics are registered, so a port that is taken leaves nothing half-registered
+    prometheus_client.start_http_server(int(port))
+    return {
+        "requests": prometheus_client.Counter("rag_requests_total", "Traced requests", ["name", "outcome"]),
+        "duration": prometheus_client.Histogram(
+            "rag_request_seconds", "End-to-end request duration", ["name"],
+            buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+        ),
+        "stage": prometheus_client.Histogram(
+            "rag_stage_seconds", "Duration of each pipeline stage", ["stage"],
+            buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+        ),
+        "tokens": prometheus_client.Counter("rag_tokens_total", "LLM and embedding tokens", ["model", "kind"]),
+        "cost": prometheus_client.Counter("rag_cost_usd_total", "Estimated LLM and embedding cost in USD"),
+        "cache": prometheus_client.Counter("rag_answer_cache_total", "Answer cache lookups", ["result"]),
+    }
+
+
+def _emit(trace):
+    record = trace.to_record()
+    line = json.dumps(record, default=str, ensure_ascii=False)
+    if os.getenv("TRACE_STDOUT", "1") != "0":
+        print(line, flush=True)
+    log_path = os.getenv("TRACE_LOG_PATH")
+    if log_path:
+        try:
+            with _recent_lock, open(log_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"Writing the trace to {log_path} failed: {e}")
+    with _recent_lock:
+        RECENT_TRACES.append(record)
+
+    metrics = start_metrics_endpoint()
+    if metrics:
+        try:
+            _export(metrics, record)
+        except Exception as e:
+            # Metrics must never break the request that is being traced
+            print(f"Exporting trace metrics failed: {type(e).__name__}: {e}")
+
+
+def _export(metrics, record):
+    metrics["requests"].labels(record["name"], record.get("outcome", "unknown")).inc()
+    metrics["duration"].labels(record["name"]).observe(record["duration_ms"] / 1000)
+    for name, milliseconds in record["stages_ms"].items():
+        metrics["stage"].labels(name).observe(milliseconds / 1000)
+    for model, counts in record["tokens"].items():
+        metrics["tokens"].labels(model, "prompt").inc(counts["prompt"])
+        metrics["tokens"].labels(model, "completion").inc(counts["completion"])
+    metrics["cost"].inc(record["cost_usd"])
+    if "answer_cache" in record:
+        metrics["cache"].labels(record["answer_cache"]).inc()
+
+
+def recent_traces():
+    """Returns the finished traces: from TRACE_LOG_PATH if set (covers every worker process), else this process's window."""
+    log_path = os.getenv("TRACE_LOG_PATH")
+    if log_path and os.path.exists(log_path):
+        with open(log_path, "r", encoding="utf-8") as f:
+            lines = deque(f, maxlen=RECENT_TRACES.maxlen)
+        return [json.loads(line) for line in lines if line.strip()]
+    with _recent_lock:
+        return list(RECENT_TRACES)
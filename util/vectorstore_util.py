@@ -0,0 +1,202 @@
+# filename: vectorstore_util.py
+import os
+import pickle
+
+import faiss
+import numpy as np
+from langchain.embeddings import OpenAIEmbeddings
+from langchain_community.vectorstores import FAISS
+
+from util.docstore_util import DOCSTORE_FILE, SQLiteDocstore, SQLiteIndexMapping
+from util.http_util import openai_clients
+from util.lexical_util import LEXICAL_FILE, LexicalIndex
+from util.retrieval_util import category_positions, stored_vectors
+
+# """
+# Loading the FAISS vector store.
+# IVF indexes can be opened memory-mapped, so several worker processes on one host
+# share their inverted lists through the OS page cache instead of each holding a
+# private copy. The pinned FAISS (1.10) reads flat and HNSW indexes into each
+# process's own memory whether or not mapping is asked for.
+# """
+
+
+def read_faiss_index(path, mmap=False):
+    """Reads a FAISS index, memory-mapping it read-only when mmap is True.
+
+    FAISS 1.10 only maps the inverted lists of IVF indexes; other index types are read
+    into memory as usual, and a note is printed. Newer builds with IO_FLAG_MMAP_IFC map
+    flat indexes as well.
+    """
+    if not mmap:
+        return faiss.read_index(path)
+    flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    try:
+        index = faiss.read_index(path, flags)
+    except RuntimeError:
+        # This index type cannot be memory-mapped by this FAISS build
+        index = faiss.read_index(path)
+    if not is_memory_mapped(index):
+        print(f"FAISS_MMAP: this FAISS build cannot memory-map {type(index).__name__}, so each process holds "
+              f"its own copy of {path}; build with --index-type ivfflat or ivfsq8 to share it")
+    return index
+
+
+def is_memory_mapped(index):
+    """Whether the vectors of an index read with IO_FLAG_MMAP are served from the mapped file."""
+    if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        return isinstance(faiss.downcast_index(index), (faiss.IndexFlat, faiss.IndexIVF))
+    try:
+        inverted_lists = faiss.extract_index_ivf(index).invlists
+    except RuntimeError:
+        return False  # not an IVF index
+    return isinstance(faiss.downcast_InvertedLists(inverted_lists), faiss.OnDiskInvertedLists)
+
+
+def apply_search_params(index, nprobe=None, ef_search=None):
+    """Overrides the query-time recall/latency knobs of approximate indexes (ignored for flat indexes)."""
+    if nprobe:
+        try:
+            faiss.extract_index_ivf(index).nprobe = nprobe
+        except RuntimeError:
+            pass  # not an IVF index
+    if ef_search:
+        hnsw_index = faiss.downcast_index(index)
+        if isinstance(hnsw_index, faiss.IndexHNSW):
+            hnsw_index.hnsw.efSearch = ef_search
+
+
+def load_local_faiss(folder_path, embeddings, mmap=False, index_name="index"):
+    """Loads a vector store saved with FAISS.save_local, optionally memory-mapping the index.
+
+    If the build also wrote a SQLite docstore it is used instead of the pickle, so
+    documents are read lazily per query rather than all deserialised up front.
+    The BM25 keyword index, if present, is attached as vector_store.lexical_index.
+    """
+    index = read_faiss_index(os.path.join(folder_path, f"{index_name}.faiss"), mmap=mmap)
+    sqlite_path = os.path.join(folder_path, DOCSTORE_FILE)
+    if os.path.exists(sqlite_path):
+        docstore = SQLiteDocstore(sqlite_path)
+        vector_store = FAISS(embeddings, index, docstore, SQLiteIndexMapping(docstore))
+    else:
+        # The docstore pickle is written by our own generate_vectordb.py
+        with open(os.path.join(folder_path, f"{index_name}.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        vector_store = FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+    lexical_path = os.path.join(folder_path, LEXICAL_FILE)
+    vector_store.lexical_index = LexicalIndex(lexical_path) if os.path.exists(lexical_path) else None
+    return vector_store
+
+
+def open_vectorstore(path, embeddings=None):
+    """Opens the vector store saved in path with the settings from the environment (FAISS_MMAP, FAISS_NPROBE, FAISS_EF_SEARCH)."""
+    if embeddings is None:
+        client, async_client = openai_clients("embeddings")
+        embeddings = OpenAIEmbeddings(
+            model="text-embedding-3-small", openai_api_key=os.getenv("OPENAI_API_KEY"),
+            client=client.embeddings, async_client=async_client.embeddings
+        )
+    # Memory-map the index so worker processes on the same host share its pages (IVF indexes only with FAISS 1.10)
+    mmap = os.getenv("FAISS_MMAP", "").lower() in ("1", "true", "yes")
+    vector_store = load_local_faiss(path, embeddings, mmap=mmap)
+    # Query-time recall/latency trade-off for HNSW and IVF indexes (the build-time values are used if unset)
+    apply_search_params(
+        vector_store.index,
+        nprobe=int(os.getenv("FAISS_NPROBE", "0")),
+        ef_search=int(os.getenv("FAISS_EF_SEARCH", "0"))
+    )
+    return vector_store
+
+
+def validate_vectorstore(vector_store, samples=50):
+    """
+    Checks that a loaded vector store is complete and searchable: every vector maps to a document,
+    sampled documents can be read, sampled stored vectors find themselves, and every source has vectors.
+    Returns a summary dict; raises ValueError describing the first problem found.
+    """
+    index = vector_store.index
+    if index.ntotal == 0:
+        raise ValueError("the index has no vectors")
+    if len(vector_store.index_to_docstore_id) != index.ntotal:
+        raise ValueError(f"{index.ntotal} vectors but {len(vector_store.index_to_docstore_id)} docstore IDs")
+
+    positions = sorted({int(position) for position in np.linspace(0, index.ntotal - 1, min(samples, index.ntotal))})
+    for position in positions:
+        doc_id = vector_store.index_to_docstore_id[position]
+        if isinstance(vector_store.docstore.search(doc_id), str):
+            raise ValueError(f"vector {position} points to a missing document ({doc_id})")
+
+    vectors = stored_vectors(index, positions)
+    if vectors is not None:
+        _, found = index.search(vectors, 10)
+        # Approximate indexes may miss a few, but a vector that can't find itself usually means a corrupt index
+        self_recall = np.mean([position in row for position, row in zip(positions, found)])
+        if self_recall < 0.9:
+            raise ValueError(f"only {self_recall:.0%} of sampled vectors find themselves in a search")
+
+    categories = {category: len(ids) for category, ids in category_positions(vector_store).items()}
+    empty = [category for category, count in categories.items() if not count]
+    if empty:
+        raise ValueError(f"no vectors for source(s): {', '.join(empty)}")
+    return {
+        "vectors": index.ntotal,
+        "dimension": index.d,
+        "categories": categories,
+        "keyword_index": vector_store.lexical_index is not None,
+    }
+
+
+def open_validated_vectorstore(path):
+    """Opens the vector store in path and checks it with validate_vectorstore before anything serves it."""
+    vector_store = open_vectorstore(path)
+    validate_vectorstore(vector_store)
+    return vector_store
+
+
+def load_serving_vectorstore(default_path="faiss_index_infopedia"):
+    """
+    Opens the vector store the app serves: the latest verified version from S3 if s3_bucket_name is set,
+    otherwise the local folder. Returns {"store": vector store}; when S3_POLL_INTERVAL_S is set, new
+    versions are polled for, validated and swapped into the dict without a restart.
+    """
+    from util.s3_util import S3IndexFetcher
+
+    shared = {"store": None}
+    s3_bucket_name = os.getenv("s3_bucket_name")
+
+    if s3_bucket_name:
+        fetcher = S3IndexFetcher(
+            s3_bucket_name,
+            local_root="nhb_vectorstore",
+            prefix=os.getenv("s3_index_prefix", ""),
+            max_concurrency=int(os.getenv("S3_DOWNLOAD_CONCURRENCY", "8"))
+        )
+        try:
+            # A new version is loaded and validated before it is made current
+            local_path, _, vector_store = fetcher.fetch(prepare=open_validated_vectorstore)
+        except Exception as e:
+            # Keep serving the last verified version if S3 is unreachable or the new version is broken
+            if not fetcher.current_version():
+                raise
+            print(f"Could not install a new vector store from S3, using the local copy: {e}")
+            local_path, vector_store = fetcher.version_path(fetcher.current_version()), None
+        # Other worker processes on this host won't delete a version this one holds a lease on
+        leases = [fetcher.lease(os.path.basename(local_path))]
+        shared["store"] = vector_store or open_vectorstore(local_path)
+
+        poll_interval = float(os.getenv("S3_POLL_INTERVAL_S", "0"))
+        if poll_interval > 0:
+            def swap_in(new_path, new_store):
+                # The new store is fully loaded and validated before the reference is swapped,
+                # so queries never see a partial or broken index
+                leases.append(fetcher.lease(os.path.basename(new_path)))
+                shared.update(store=new_store)
+                # Requests that started on the previous version may still be reading it
+                while len(leases) > 2:
+                    leases.pop(0).release()
+
+            fetcher.start_polling(poll_interval, swap_in, prepare=open_validated_vectorstore)
+    else:
+        shared["store"] = open_vectorstore(default_path)
+    return shared
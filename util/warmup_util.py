@@ -0,0 +1,214 @@
+# filename: warmup_util.py
+import importlib
+import os
+import threading
+import time
+import traceback
+
+# """
+# Background warm-up of the app process.
+# The page renders as soon as Streamlit runs the script; the heavy work (importing
+# LangChain/OpenAI/Tavily, loading the index from S3 or disk, paging it in and
+# building the source partitions, loading the tokenizer) runs in a background
+# thread started once per process. Questions asked before it finishes wait for it.
+# A failed step (e.g. S3 or OpenAI briefly unreachable at container start) is retried
+# with exponential backoff, or straight away when a question is waiting for it.
+# When warm-up is done READY_FILE (if set) is written, for container health checks.
+# The time from process start to ready is traced ("startup" record), and so is the
+# time each session waits for its first page, from the start of its first script run
+# to the end of the render ("first page" records).
+# Only the standard library is imported at module level so importing this is cheap.
+# """
+
+READY_FILE = os.getenv("READY_FILE")
+# Longest pause (in seconds) between warm-up attempts; the pause doubles from 1s after each failure
+WARMUP_RETRY_MAX_S = float(os.getenv("WARMUP_RETRY_MAX_S", "60"))
+_import_time = time.time()
+
+
+def process_start_time():
+    """When this process started (seconds since the epoch), from /proc on Linux; else when this module was imported."""
+    try:
+        with open("/proc/self/stat", "r") as f:
+            # Fields after the command name; the start time (field 22) is the 20th of them, in clock ticks since boot
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - (uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return _import_time
+
+
+class Warmup:
+    """Runs named start-up steps in order in a background thread. Each step gets the results of the earlier ones.
+
+    If a step fails the thread retries from that step until every step has succeeded.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.results = {}
+        self.timings = {}
+        # The most recent failure; None once warm-up has succeeded
+        self.error = None
+        self.failed_attempts = 0
+        self.ready = threading.Event()
+        self._changed = threading.Condition()
+        self._retry_now = threading.Event()
+        self._backing_off = False
+        self.process_started = process_start_time()
+        self.ready_after = None
+        self.first_pages = 0
+        self._first_page_lock = threading.Lock()
+
+    def start(self):
+        if READY_FILE and os.path.exists(READY_FILE):
+            # Left over from an earlier run of this container
+            os.remove(READY_FILE)
+        threading.Thread(target=self._run, name="warmup", daemon=True).start()
+        return self
+
+    def _run_steps(self, trace):
+        for name, step in self.steps:
+            if name in self.results:
+                # Done in an earlier attempt
+                continue
+            start = time.perf_counter()
+            self.results[name] = step(self.results)
+            self.timings[name] = time.perf_counter() - start
+            trace.record_stage(name, self.timings[name] * 1000)
+
+    def _run(self):
+        from util.tracing_util import RequestTrace
+
+        # Not made the thread's current trace, so it cannot be mistaken for a request's
+        trace = RequestTrace("startup")
+        delay = 1.0
+        while True:
+            try:
+                self._run_steps(trace)
+                break
+            except Exception as e:
+                traceback.print_exc()
+                with self._changed:
+                    self.error = e
+                    self.failed_attempts += 1
+                    self._backing_off = True
+                    self._changed.notify_all()
+                print(f"Start-up failed ({type(e).__name__}: {e}); retrying in up to {delay:.0f}s")
+                # Back off, unless a question is waiting for the app
+                self._retry_now.wait(delay)
+                with self._changed:
+                    self._backing_off = False
+                    self._retry_now.clear()
+                delay = min(delay * 2, WARMUP_RETRY_MAX_S)
+
+        self.ready_after = time.time() - self.process_started
+        if READY_FILE:
+            with open(READY_FILE, "w", encoding="utf-8") as f:
+                f.write(f"{self.ready_after:.2f}\n")
+        with self._changed:
+            self.error = None
+            self.ready.set()
+            self._changed.notify_all()
+        trace.set(time_to_ready_s=round(self.ready_after, 3), failed_attempts=self.failed_attempts, outcome="ready")
+        trace.release()
+
+    def is_ready(self):
+        return self.ready.is_set()
+
+    def wait(self, timeout=None):
+        """Blocks until warm-up is done and returns the step results.
+
+        If the last attempt failed, the next one starts now instead of after the backoff. Raises if the
+        attempt being waited for fails (the next call tries again) or if warm-up is not done within timeout.
+        """
+        with self._changed:
+            if self.ready.is_set():
+                return self.results
+            attempts = self.failed_attempts
+            if self._backing_off:
+                self._retry_now.set()
+            self._changed.wait_for(lambda: self.ready.is_set() or self.failed_attempts > attempts, timeout)
+            if self.ready.is_set():
+                return self.results
+            if self.failed_attempts > attempts:
+                raise RuntimeError(f"Start-up failed: {self.error}") from self.error
+        raise TimeoutError(f"Start-up did not finish within {timeout}s")
+
+    def record_first_page(self, session_started):
+        """Records how long a session waited for its first page: from session_started (the start of its first
+        script run) to now, the end of that run's render. Call once per session.
+
+        The time since process start is not used, since the server can sit idle for hours before the first
+        visitor; it is kept in the record as process_uptime_s, with whether this was the process's first session.
+        """
+        now = time.time()
+        with self._first_page_lock:
+            self.first_pages += 1
+            first_in_process = self.first_pages == 1
+        # Imported here rather than at the top: tracing pulls in tiktoken, which should not delay the first page
+        from util.tracing_util import RequestTrace
+
+        RequestTrace(
+            "first page", first_page_render_s=round(now - session_started, 3), warm=self.is_ready(),
+            first_in_process=first_in_process, process_uptime_s=round(now - self.process_started, 3)
+        ).release()
+
+
+def _import_pipeline(results):
+    # The modules behind the answer pipeline: LangChain, OpenAI, Tavily, FAISS
+    for module in ("util.rag_util", "util.service_util", "util.vectorstore_util"):
+        importlib.import_module(module)
+
+
+def _load_index(results):
+    from util.vectorstore_util import load_serving_vectorstore
+
+    return load_serving_vectorstore()
+
+
+def _prepare_index(results):
+    """Pages the index in and builds the source partitions, which otherwise happens on the first question."""
+    import numpy as np
+
+    from util.retrieval_util import SOURCE_CATEGORIES, category_bitmap, category_positions
+
+    vector_store = results["load index"]["store"]
+    category_positions(vector_store)
+    category_bitmap(vector_store, frozenset(SOURCE_CATEGORIES))
+    vector_store.index.search(np.zeros((1, vector_store.index.d), dtype=np.float32), 1)
+    if vector_store.index.ntotal:
+        vector_store.docstore.search(vector_store.index_to_docstore_id[0])
+
+
+def _load_tokenizer(results):
+    from util.tracing_util import count_tokens
+
+    count_tokens("warm up")
+
+
+def _start_metrics(results):
+    from util.tracing_util import start_metrics_endpoint
+
+    start_metrics_endpoint()
+
+
+_app_warmup = None
+_app_warmup_lock = threading.Lock()
+
+
+def start_app_warmup():
+    """Starts the History Assistant's warm-up once per process and returns it.
+
+    With RAG_SERVICE_URL set the index lives in the answer service, so only the client side is warmed.
+    """
+    global _app_warmup
+    with _app_warmup_lock:
+        if _app_warmup is None:
+            steps = [("import pipeline", _import_pipeline)]
+            if not os.getenv("RAG_SERVICE_URL"):
+                steps += [("load index", _load_index), ("prepare index", _prepare_index),
+                          ("load tokenizer", _load_tokenizer), ("start metrics", _start_metrics)]
+            _app_warmup = Warmup(steps).start()
+        return _app_warmup